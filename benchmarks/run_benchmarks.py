@@ -0,0 +1,243 @@
+""" Benchmark harness for the sounding selection pipeline.
+
+    Each case runs in a fresh Python process (so peak memory is per case) on a synthetic survey generated by
+    synthetic.py, and the results are written as JSON so runs can be compared across commits:
+
+        python benchmarks/run_benchmarks.py run --sizes 10000 100000 --cases stages pipeline --output results.json
+        python benchmarks/run_benchmarks.py compare baseline.json results.json
+
+    The 'stages' case times the individual building blocks (reading, triangulation, quadtrees, critical points,
+    functionality validation); the 'pipeline' case runs main() end to end and reads
+    its per-stage times and counters from the metrics report. """
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def peak_memory_mb():
+    """ Peak resident set size of the current process in MB, or None where the resource module is unavailable. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+class Timer(object):
+    """ Accumulates wall and CPU time of named blocks: with timer.measure('name'): ... """
+
+    def __init__(self):
+        self.__results = dict()
+        self.__name = None
+        self.__start = None
+
+    def measure(self, name):
+        self.__name = name
+        return self
+
+    def __enter__(self):
+        self.__start = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall, cpu = time.perf_counter() - self.__start[0], time.process_time() - self.__start[1]
+        result = self.__results.setdefault(self.__name, {'wall_time_s': 0.0, 'cpu_time_s': 0.0})
+        result['wall_time_s'] += wall
+        result['cpu_time_s'] += cpu
+        return False
+
+    def get_results(self):
+        return self.__results
+
+
+def run_stages(paths, workers):
+    """ Times the pipeline building blocks on the generated files; setup work is not timed. """
+    from math import ceil
+    from sounding_selection.features import FeatureStore
+    from sounding_selection.reader import Reader
+    from sounding_selection.sounding_store import SoundingStore
+    from sounding_selection.tree import Tree
+    from sounding_selection.utilities import get_bathymetric_boundary, get_feature_segments, triangulate
+    from sounding_selection.validation import ValidationPool, validate_functionality_constraint
+
+    timer = Timer()
+    store = SoundingStore()
+    with timer.measure('read_soundings'):
+        source = Reader.read_xyz_to_vertex_list(paths['source'], store)
+    with timer.measure('feature_segments'):
+        features = FeatureStore(paths['depth_areas'], paths['depth_contours'])
+        depth_areas, contours = features.get_depth_areas(), features.get_depth_contours()
+        bathymetric_boundary = get_bathymetric_boundary(contours, depth_areas)
+        segment_vertices, idx_list, holes = get_feature_segments(contours, bathymetric_boundary, store=store)[:3]
+    with timer.measure('triangulation'):
+        tri = triangulate(source, segment_vertices, idx_list, holes)
+        tin = Reader.read_triangulation(tri, source + segment_vertices, store)
+    capacity = int(ceil(len(source) * 0.004))
+    with timer.measure('tin_tree'):
+        tin_tree = Tree(capacity)
+        tin_tree.build_tin_tree(tin)
+    with timer.measure('critical_points'):
+        tin_tree.crit_query(tin)
+    with timer.measure('point_tree'):
+        point_set = Reader.read_vertex_list_to_pointset(source, store)
+        point_tree = Tree(capacity)
+        point_tree.build_point_tree(point_set)
+
+    # Validate a coarse selection (every 20th sounding) against all the soundings
+    selection = source[::20]
+    selection_tri = triangulate(selection, segment_vertices, idx_list, holes)
+    selection_tin = Reader.read_triangulation(selection_tri, selection + segment_vertices, store)
+    with timer.measure('functionality_validation'), ValidationPool(workers, depth_areas) as pool:
+        for method in ('TRIANGLE', 'SURFACE'):
+            validate_functionality_constraint(selection_tin, point_tree, point_set, depth_areas, method, pool)
+
+    results = timer.get_results()
+    for stage in results:
+        results[stage]['throughput_soundings_per_s'] = len(source) / max(results[stage]['wall_time_s'], 1e-9)
+    return {'soundings': len(source), 'tin_triangles': tin.get_triangles_num(), 'stages': results}
+
+
+def run_pipeline(paths, scale, validation, workers):
+    """ Runs main() end to end; stage times and counters come from the metrics report written next to the log. """
+    sys.argv = ['sounding_selection', '-i', paths['source'], '-c', paths['enc'], '-r', str(scale), '-v', validation,
+                '-d', paths['depth_contours'], '-a', paths['depth_areas'], '-n', paths['dangers'], '-s', '43.03',
+                '-e', '1309.28', '-w', str(workers)]
+    from sounding_selection.main import main
+
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    main()
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+    with open('sounding_selection_metrics.json') as infile:
+        report = json.load(infile)
+    with open(paths['source']) as infile:
+        soundings = sum(1 for _ in infile)
+    stages = dict()
+    for stage in report['stages']:
+        stage['throughput_soundings_per_s'] = soundings / max(stage['wall_time_s'], 1e-9)
+        stages[stage.pop('stage')] = stage
+    return {'soundings': soundings, 'wall_time_s': wall, 'cpu_time_s': cpu,
+            'throughput_soundings_per_s': soundings / max(wall, 1e-9), 'stages': stages,
+            'counters': report['counters']}
+
+
+def run_case(case, size, seed, data_dir, scale, validation, workers):
+    """ Runs one case in this process and returns its result record. """
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from synthetic import generate
+
+    data_dir = os.path.join(data_dir, 'size_{}_seed_{}'.format(size, seed))
+    paths = generate(data_dir, size, seed)
+    # main() writes its outputs to the working directory
+    work_dir = tempfile.mkdtemp(prefix='{}_{}_'.format(case, size))
+    os.chdir(work_dir)
+
+    if case == 'stages':
+        result = run_stages(paths, workers)
+    elif case == 'pipeline':
+        result = run_pipeline(paths, scale, validation, workers)
+    else:
+        raise ValueError('Unknown benchmark case: {}'.format(case))
+    result.update({'case': case, 'size': size, 'seed': seed, 'workers': workers,
+                   'peak_memory_mb': peak_memory_mb(), 'work_dir': work_dir})
+    return result
+
+
+def environment():
+    import numpy
+    import shapely
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': numpy.__version__,
+            'shapely': shapely.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def run(args):
+    results = {'environment': environment(), 'results': list()}
+    for size in args.sizes:
+        for case in args.cases:
+            command = [sys.executable, os.path.abspath(__file__), '_case', case, str(size), '--seed', str(args.seed),
+                       '--data-dir', os.path.abspath(args.data_dir), '--scale', str(args.scale),
+                       '--validation', args.validation, '--workers', str(args.workers)]
+            print('Running {} on {} soundings'.format(case, size))
+            output = subprocess.check_output(command).decode()
+            record = json.loads(output.strip().splitlines()[-1])
+            print('\t{:.2f} s, peak {} MB'.format(record.get('wall_time_s', sum(
+                s['wall_time_s'] for s in record['stages'].values())), record['peak_memory_mb']))
+            results['results'].append(record)
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+    print('Results written to ' + args.output)
+
+
+def compare(args):
+    """ Prints the wall time ratio (new / old) of every stage present in both result files. """
+    with open(args.old) as infile:
+        old = json.load(infile)
+    with open(args.new) as infile:
+        new = json.load(infile)
+    old_results = {(r['case'], r['size']): r for r in old['results']}
+    print('{:<10} {:>10} {:<45} {:>10} {:>10} {:>7}'.format('case', 'size', 'stage', 'old (s)', 'new (s)', 'ratio'))
+    for record in new['results']:
+        key = (record['case'], record['size'])
+        if key not in old_results:
+            continue
+        rows = [('total', old_results[key].get('wall_time_s'), record.get('wall_time_s'))]
+        rows += [(stage, old_results[key]['stages'].get(stage, {}).get('wall_time_s'), times['wall_time_s'])
+                 for stage, times in record['stages'].items()]
+        for stage, old_time, new_time in rows:
+            if old_time and new_time:
+                print('{:<10} {:>10} {:<45} {:>10.3f} {:>10.3f} {:>7.2f}'.format(key[0], key[1], stage[:45], old_time,
+                                                                                 new_time, new_time / old_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sounding selection benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='run benchmark cases and write a JSON result file')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=[10000])
+    run_parser.add_argument('--cases', nargs='+', default=['stages'], choices=['stages', 'pipeline'])
+    run_parser.add_argument('--output', default='benchmark_results.json')
+    run_parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'sounding_selection_bench'))
+    for p in (run_parser, subparsers.add_parser('_case')):
+        p.add_argument('--seed', type=int, default=0)
+        p.add_argument('--scale', type=int, default=40000)
+        p.add_argument('--validation', default='TRIANGLE', choices=['TRIANGLE', 'SURFACE'])
+        p.add_argument('--workers', type=int, default=1)
+    case_parser = subparsers.choices['_case']
+    case_parser.add_argument('case')
+    case_parser.add_argument('size', type=int)
+    case_parser.add_argument('--data-dir', required=True)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two JSON result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        compare(args)
+    elif args.command == '_case':
+        record = run_case(args.case, args.size, args.seed, args.data_dir, args.scale, args.validation, args.workers)
+        sys.stdout.flush()
+        print(json.dumps(record))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+""" Synthetic bathymetry generator for the benchmarks.
+
+    A survey is sampled from an analytic depth surface (sloping seafloor, a meandering channel and random shoals, some of
+    them breaking the surface as islands) and written with matching ENC features:
+        <name>_Source_xyzc.txt: source soundings (x,y,-depth,CATZOC; a few points above the datum)
+        <name>_ENC_xyzc.txt: existing ENC soundings, sparser and rounded to the decimetre
+        <name>_DepthsA.shp: depth areas (DRVAL1, DRVAL2, FCSubtype) of the depth bands between contour levels
+        <name>_DepthsL.shp: depth contours (VALDCO) between the bands, VALDCO 0 being the shoreline
+        <name>_DangersP.shp: rocks, wrecks and obstructions (VALSOU, WATLEV, FCSUBTYPE, CATWRK) on the shoals
+    Depth areas and contours are built on a regular grid of cells, so they are blocky but topologically consistent. """
+import os
+import numpy as np
+import shapefile
+from shapely.geometry import box, MultiLineString
+from shapely.geometry.polygon import orient
+from shapely.ops import unary_union, linemerge
+
+CONTOUR_LEVELS = (0.0, 2.0, 5.0, 10.0, 20.0, 30.0, 50.0, 100.0, 200.0)
+ORIGIN = (400000.0, 3340000.0)  # UTM-like coordinates, meters
+SOUNDING_SPACING = 10.0  # Mean distance between source soundings, meters
+
+
+class SyntheticSurvey(object):
+    """ Depth surface (positive depths, meters) over a square of side length meters; shoals are random per seed. """
+
+    def __init__(self, soundings_num, seed=0, shoals_num=None):
+        self.__soundings_num = int(soundings_num)
+        self.__length = SOUNDING_SPACING * np.sqrt(self.__soundings_num)
+        self.__rng = np.random.default_rng(seed)
+        if shoals_num is None:
+            shoals_num = int(np.clip(np.sqrt(self.__soundings_num) / 10, 4, 400))
+        # Shoal centre, radius and height in unit coordinates; heights above the local depth make islands
+        self.__shoals = np.column_stack((self.__rng.uniform(0.15, 0.95, shoals_num),
+                                         self.__rng.uniform(0.05, 0.95, shoals_num),
+                                         self.__rng.uniform(0.01, 0.04, shoals_num),
+                                         self.__rng.uniform(0.3, 1.1, shoals_num)))
+
+    def get_length(self):
+        return self.__length
+
+    def get_rng(self):
+        return self.__rng
+
+    def get_shoals(self):
+        return self.__shoals
+
+    def depth(self, x, y):
+        u = (np.asarray(x) - ORIGIN[0]) / self.__length
+        v = (np.asarray(y) - ORIGIN[1]) / self.__length
+        # Seafloor sloping away from a western shore
+        depth = -3.0 + 60.0 * np.clip(u, 0.0, None) ** 0.8
+        # Meandering dredged-like channel
+        channel_v = 0.5 + 0.2 * np.sin(3.0 * np.pi * u)
+        depth = depth + 12.0 * np.exp(-((v - channel_v) / 0.04) ** 2) * (u > 0.08)
+        # Shoals rise a fraction of the local depth; the strongest ones break the surface
+        for s_u, s_v, radius, height in self.__shoals:
+            depth = depth - height * np.maximum(depth, 2.0) * np.exp(-((u - s_u) ** 2 + (v - s_v) ** 2) / radius ** 2)
+        return depth
+
+    def catzoc(self, x, y):
+        """ CATZOC mix: A1 along the channel, A2/B over most of the area, C and D offshore, some U. """
+        u = (np.asarray(x) - ORIGIN[0]) / self.__length
+        v = (np.asarray(y) - ORIGIN[1]) / self.__length
+        channel = np.abs(v - (0.5 + 0.2 * np.sin(3.0 * np.pi * u))) < 0.05
+        catzoc = np.where(u < 0.5, 2, 3)
+        catzoc = np.where(u > 0.8, 4, catzoc)
+        catzoc = np.where((u > 0.9) & (v > 0.7), 5, catzoc)
+        catzoc = np.where(self.__rng.random(len(catzoc)) < 0.02, 6, catzoc)
+        return np.where(channel, 1, catzoc)
+
+    def sample_soundings(self, soundings_num, noise=0.1):
+        x = ORIGIN[0] + self.__rng.uniform(0.0, self.__length, soundings_num)
+        y = ORIGIN[1] + self.__rng.uniform(0.0, self.__length, soundings_num)
+        z = self.depth(x, y) + self.__rng.normal(0.0, noise, soundings_num)
+        return x, y, z, self.catzoc(x, y)
+
+
+def write_xyzc(file_name, x, y, z, catzoc, decimals=2, chunk_size=1000000):
+    """ Writes x,y,z,c lines; depths below the datum are negative, as in the survey files the Reader expects. """
+    with open(file_name, 'w') as outfile:
+        for start in range(0, len(x), chunk_size):
+            end = start + chunk_size
+            block = np.column_stack((x[start:end], y[start:end], np.round(-z[start:end], decimals), catzoc[start:end]))
+            np.savetxt(outfile, block, fmt=['%.3f', '%.3f', '%.{}f'.format(decimals), '%d'], delimiter=',')
+
+
+def depth_bands(survey, cells_num):
+    """ Unions of grid cells by depth band: land (depth < 0) and one polygon per contour interval. """
+    length = survey.get_length()
+    cell = length / cells_num
+    centers = ORIGIN[0] + (np.arange(cells_num) + 0.5) * cell, ORIGIN[1] + (np.arange(cells_num) + 0.5) * cell
+    grid_x, grid_y = np.meshgrid(centers[0], centers[1])
+    band = np.searchsorted(CONTOUR_LEVELS, survey.depth(grid_x, grid_y), side='right') - 1  # -1 is land
+
+    bands = dict()
+    for b in np.unique(band):
+        rows, cols = np.nonzero(band == b)
+        cells = [box(ORIGIN[0] + c * cell, ORIGIN[1] + r * cell, ORIGIN[0] + (c + 1) * cell, ORIGIN[1] + (r + 1) * cell)
+                 for r, c in zip(rows, cols)]
+        bands[int(b)] = unary_union(cells).simplify(0)
+    return bands
+
+
+def polygon_parts(geometry):
+    if geometry.is_empty:
+        return []
+    return list(geometry.geoms) if geometry.geom_type == 'MultiPolygon' else [geometry]
+
+
+def line_parts(geometry):
+    if geometry.is_empty:
+        return []
+    if geometry.geom_type == 'LineString':
+        return [geometry]
+    lines = [g for g in getattr(geometry, 'geoms', []) if g.geom_type in ('LineString', 'MultiLineString')]
+    if len(lines) == 0:
+        return []
+    merged = linemerge(MultiLineString([c for g in lines for c in line_parts(g)]) if len(lines) > 1 else lines[0])
+    return list(merged.geoms) if merged.geom_type == 'MultiLineString' else [merged]
+
+
+def write_depth_areas(file_name, bands):
+    writer = shapefile.Writer(file_name, shapeType=shapefile.POLYGON)
+    writer.field('DRVAL1', 'N', 19, 11)
+    writer.field('DRVAL2', 'N', 19, 11)
+    writer.field('FCSubtype', 'N', 10, 0)
+    for b, geometry in sorted(bands.items()):
+        if b < 0:
+            continue
+        drval2 = CONTOUR_LEVELS[b + 1] if b + 1 < len(CONTOUR_LEVELS) else CONTOUR_LEVELS[b] * 2
+        for polygon in polygon_parts(geometry):
+            polygon = orient(polygon, sign=-1.0)  # Shapefile rings: clockwise exterior, counterclockwise holes
+            writer.poly([list(polygon.exterior.coords)] + [list(ring.coords) for ring in polygon.interiors])
+            writer.record(CONTOUR_LEVELS[b], drval2, 1)
+    writer.close()
+
+
+def write_depth_contours(file_name, bands):
+    """ The contour at a level is the shared boundary of the cells shallower and deeper than the level. """
+    writer = shapefile.Writer(file_name, shapeType=shapefile.POLYLINE)
+    writer.field('VALDCO', 'N', 19, 11)
+    for k, level in enumerate(CONTOUR_LEVELS):
+        shallower = unary_union([g for b, g in bands.items() if b < k])
+        deeper = unary_union([g for b, g in bands.items() if b >= k])
+        if shallower.is_empty or deeper.is_empty:
+            continue
+        for line in line_parts(shallower.boundary.intersection(deeper.boundary)):
+            writer.line([list(line.coords)])
+            writer.record(level)
+    writer.close()
+
+
+def write_dangers(file_name, survey, dangers_num):
+    """ Dangers sit near shoal crests: rocks (35) and obstructions (20) with WATLEV, wrecks (45) with CATWRK; about one
+        in five has an unknown VALSOU (-32767). """
+    rng, length = survey.get_rng(), survey.get_length()
+    shoals = survey.get_shoals()
+    picked = shoals[rng.integers(0, len(shoals), dangers_num)]
+    x = ORIGIN[0] + (picked[:, 0] + rng.normal(0.0, 0.5, dangers_num) * picked[:, 2]) * length
+    y = ORIGIN[1] + (picked[:, 1] + rng.normal(0.0, 0.5, dangers_num) * picked[:, 2]) * length
+    depth = survey.depth(x, y)
+
+    writer = shapefile.Writer(file_name, shapeType=shapefile.POINT)
+    writer.field('VALSOU', 'N', 19, 8)
+    writer.field('WATLEV', 'N', 10, 0)
+    writer.field('FCSUBTYPE', 'N', 10, 0)
+    writer.field('CATWRK', 'N', 10, 0)
+    for i in range(dangers_num):
+        subtype = int(rng.choice([20, 35, 45]))
+        valsou = -32767.0 if rng.random() < 0.2 else round(float(max(depth[i] - rng.uniform(0.0, 1.0), 0.1)), 1)
+        writer.point(float(x[i]), float(y[i]))
+        writer.record(valsou, 3, subtype, int(rng.choice([1, 2])) if subtype == 45 else 0)
+    writer.close()
+
+
+def generate(out_dir, soundings_num, seed=0, enc_ratio=0.02, cells_num=None, name=None):
+    """ Writes a synthetic survey and its ENC features to out_dir and returns the file paths by role. """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    name = 'Synthetic_{}'.format(soundings_num) if name is None else name
+    if cells_num is None:
+        cells_num = int(np.clip(np.sqrt(soundings_num) / 4, 24, 160))
+    survey = SyntheticSurvey(soundings_num, seed)
+    paths = {'source': os.path.join(out_dir, name + '_Source_xyzc.txt'),
+             'enc': os.path.join(out_dir, name + '_ENC_xyzc.txt'),
+             'depth_areas': os.path.join(out_dir, name + '_DepthsA.shp'),
+             'depth_contours': os.path.join(out_dir, name + '_DepthsL.shp'),
+             'dangers': os.path.join(out_dir, name + '_DangersP.shp')}
+
+    write_xyzc(paths['source'], *survey.sample_soundings(soundings_num))
+    x, y, z, catzoc = survey.sample_soundings(max(int(soundings_num * enc_ratio), 10), noise=0.0)
+    write_xyzc(paths['enc'], x, y, z, catzoc, decimals=1)
+
+    bands = depth_bands(survey, cells_num)
+    write_depth_areas(paths['depth_areas'][:-4], bands)
+    write_depth_contours(paths['depth_contours'][:-4], bands)
+    write_dangers(paths['dangers'][:-4], survey, int(np.clip(soundings_num / 2000, 5, 500)))
+    return paths
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Generate a synthetic survey with matching ENC features')
+    parser.add_argument('size', type=int, help='number of source soundings')
+    parser.add_argument('--out', default='.', help='output directory')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for role, path in sorted(generate(args.out, args.size, args.seed).items()):
+        print(role, path)
@@ -0,0 +1,146 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+from sounding_selection.logger import log
+from sounding_selection.metrics import metrics
+
+# Bumped whenever the content of a stage output changes, so entries of older versions are never loaded
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE_MB = 1024
+# Files a shapefile is made of, besides the .shp
+SHAPEFILE_PARTS = ('.shx', '.dbf', '.prj', '.cpg')
+
+# Stages loaded, computed, and verified, entries whose verification failed, and entries evicted
+cache_counts = {'hits': 0, 'misses': 0, 'verified': 0, 'mismatches': 0, 'evictions': 0}
+metrics.register('cache', cache_counts)
+
+
+class StageCache(object):
+    """ Content-addressed cache of pipeline stage outputs.
+
+        A stage output is a dict of NumPy arrays saved as one .npz file named after the stage and a SHA-256 key of
+        everything the stage depends on: the content of its input files, its parameters, and the keys of the stages
+        it builds on. A run with the same inputs loads the arrays instead of recomputing them. The directory is kept
+        under a size bound by evicting the least recently used entries. In verify mode every stage is recomputed and
+        compared with its cached output. Without a directory the cache is disabled and every stage is computed. """
+    def __init__(self, cache_dir=None, max_size_mb=DEFAULT_CACHE_SIZE_MB, verify=False):
+        self.__dir = cache_dir
+        self.__max_size = int(max_size_mb * 1024 * 1024)
+        self.__verify = verify
+        self.__digests = dict()  # File path -> content digest, hashed once per run
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def is_enabled(self):
+        return self.__dir is not None
+
+    def get_dir(self):
+        return self.__dir
+
+    def key(self, stage, *inputs):
+        """ Returns the key of a stage from its inputs: file paths (hashed by content, together with the other files
+            of a shapefile), arrays, other stage keys, and parameters. """
+        h = hashlib.sha256('{}:{}'.format(CACHE_VERSION, stage).encode())
+        for value in inputs:
+            if isinstance(value, np.ndarray):
+                h.update('{}{}'.format(value.dtype.str, value.shape).encode())
+                h.update(np.ascontiguousarray(value).tobytes())
+            elif isinstance(value, str) and os.path.isfile(value):
+                h.update(self.__file_digest(value).encode())
+            else:
+                h.update(repr(value).encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def __file_digest(self, path):
+        if path not in self.__digests:
+            h = hashlib.sha256()
+            paths = [path]
+            if path.lower().endswith('.shp'):
+                paths += [path[:-4] + part for part in SHAPEFILE_PARTS if os.path.isfile(path[:-4] + part)]
+            for part in paths:
+                h.update(os.path.basename(part)[-4:].encode())
+                with open(part, 'rb') as infile:
+                    for block in iter(lambda: infile.read(1 << 20), b''):
+                        h.update(block)
+            self.__digests[path] = h.hexdigest()
+        return self.__digests[path]
+
+    def __path(self, stage, key):
+        return os.path.join(self.__dir, '{}_{}.npz'.format(stage, key))
+
+    def load(self, stage, key):
+        """ Returns the cached arrays of a stage, or None. """
+        path = self.__path(stage, key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError) as e:
+            log.warning('\t\t--Discarding Unreadable Cache Entry {}: {}'.format(os.path.basename(path), e))
+            os.remove(path)
+            return None
+        os.utime(path)  # Recently used entries are evicted last
+        return arrays
+
+    def save(self, stage, key, arrays):
+        # Written under a temporary name first, so an interrupted run never leaves a truncated entry
+        handle, temp_path = tempfile.mkstemp(dir=self.__dir, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as outfile:
+            np.savez(outfile, **arrays)
+        os.replace(temp_path, self.__path(stage, key))
+        self.__evict()
+
+    def __evict(self):
+        entries = list()
+        for name in os.listdir(self.__dir):
+            if name.endswith('.npz'):
+                path = os.path.join(self.__dir, name)
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        # The newest entry is always kept, even if it exceeds the bound by itself
+        for _, entry_size, path in entries[:-1]:
+            if size <= self.__max_size:
+                break
+            os.remove(path)
+            size -= entry_size
+            cache_counts['evictions'] += 1
+
+    def run(self, stage, key, compute):
+        """ Returns the arrays of a stage: loaded from the cache when the key matches, otherwise computed by compute()
+            and saved. In verify mode cached stages are recomputed too; a mismatch is logged and the new output
+            replaces the cached one. """
+        if not self.is_enabled():
+            return compute()
+        cached = self.load(stage, key)
+        if cached is not None and not self.__verify:
+            cache_counts['hits'] += 1
+            log.info('\t\t--Loaded {} from Cache'.format(stage))
+            return cached
+
+        arrays = compute()
+        if cached is None:
+            cache_counts['misses'] += 1
+        else:
+            cache_counts['verified'] += 1
+            if same_arrays(cached, arrays):
+                return arrays
+            cache_counts['mismatches'] += 1
+            log.warning('\t\t--Cached {} Does Not Match Recomputed Output'.format(stage))
+        self.save(stage, key, arrays)
+        return arrays
+
+
+def same_arrays(a, b):
+    if sorted(a) != sorted(b):
+        return False
+    for name in a:
+        x, y = np.asarray(a[name]), np.asarray(b[name])
+        if x.shape != y.shape or x.dtype.kind != y.dtype.kind:
+            return False
+        if not np.array_equal(x, y, equal_nan=x.dtype.kind == 'f'):
+            return False
+    return True
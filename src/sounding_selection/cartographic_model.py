@@ -1,7 +1,12 @@
 import math
+import numpy as np
+from collections import OrderedDict
 from shapely.geometry import Polygon, Point
 from shapely.affinity import scale as shapely_scale
+from shapely.affinity import translate
+from sounding_selection.vertex import Vertex
 from sounding_selection.logger import log
+from sounding_selection.metrics import metrics
 
 # FCSubtype legend:
 # OBSTRN = 20
@@ -9,19 +14,194 @@ from sounding_selection.logger import log
 # WRECKS = 45
 
 
+class SymbolCache(object):
+    """ Bounded LRU cache of carto symbol templates. A template is the symbol built at the origin; its key holds
+        everything the symbol shape depends on (depth label, S-57 type/condition, scale, and label spacing), so a
+        cached symbol only needs to be translated to the sounding position. """
+
+    def __init__(self, max_size=4096):
+        self.__templates = OrderedDict()
+        self.__max_size = max_size
+        self.__hits = 0
+        self.__misses = 0
+
+    def get_hits(self):
+        return self.__hits
+
+    def get_misses(self):
+        return self.__misses
+
+    def get_size(self):
+        return len(self.__templates)
+
+    def clear(self):
+        self.__templates.clear()
+        self.__hits = 0
+        self.__misses = 0
+
+    def get_symbol(self, target_v, scale, horiz_spacing=None, vert_spacing=None):
+        """ Same output as build_carto_symbol: (window, label, depth label) for soundings and (window, symbol) for
+            dangers to navigation. """
+        template = self.__get_template(target_v, scale, horiz_spacing, vert_spacing)
+        x, y = target_v.x_value, target_v.y_value
+        if target_v.s57_type is None:
+            window_coords, label_coords, number = template[:3]
+            return Polygon(window_coords + (x, y)), Polygon(label_coords + (x, y)), number
+        else:
+            window, symbol = template[:2]
+            return translate(window, x, y), translate(symbol, x, y)
+
+    def get_boxes(self, target_v, scale, horiz_spacing=None, vert_spacing=None):
+        """ Returns the window and label of a sounding as (n, 4) arrays of [min_x, min_y, max_x, max_y] boxes whose
+            union is the symbol, or None for dangers to navigation (non-rectilinear symbols). """
+        template = self.__get_template(target_v, scale, horiz_spacing, vert_spacing)
+        if target_v.s57_type is not None:
+            return None
+        window_boxes, label_boxes = template[3:]
+        offset = np.array([target_v.x_value, target_v.y_value, target_v.x_value, target_v.y_value])
+        return window_boxes + offset, label_boxes + offset
+
+    def get_label_boxes(self, vertices, scale, horiz_spacing=None, vert_spacing=None):
+        """ Stacks the label boxes of the soundings in vertices; returns the (n, 4) boxes and, for each box, the
+            position in vertices of its sounding. Dangers to navigation are skipped. """
+        template_boxes, counts, xy, positions = list(), list(), list(), list()
+        for pos, v in enumerate(vertices):
+            if v.s57_type is None:
+                label_boxes = self.__get_template(v, scale, horiz_spacing, vert_spacing)[4]
+                template_boxes.append(label_boxes)
+                counts.append(len(label_boxes))
+                xy.append((v.x_value, v.y_value))
+                positions.append(pos)
+        if len(positions) == 0:
+            return np.empty((0, 4)), np.empty(0, dtype=np.int64)
+        offsets = np.repeat(np.array(xy), counts, axis=0)
+        boxes = np.concatenate(template_boxes) + np.tile(offsets, 2)
+        return boxes, np.repeat(np.array(positions, dtype=np.int64), counts)
+
+    def __get_template(self, target_v, scale, horiz_spacing, vert_spacing):
+        if target_v.s57_type is None:
+            key = (None, get_depth_label(target_v.z_value), scale, horiz_spacing, vert_spacing)
+        else:
+            if target_v.z_value is not None and target_v.z_value > 0:
+                depth_class = 1 if target_v.z_value < 20 else 2
+            else:
+                depth_class = 0
+            key = (target_v.s57_type, target_v.s57_condition, depth_class, scale)
+
+        template = self.__templates.get(key)
+        if template is not None:
+            self.__hits += 1
+            self.__templates.move_to_end(key)
+            return template
+
+        self.__misses += 1
+        origin_v = Vertex(0.0, 0.0, target_v.z_value, target_v.s57_type, target_v.s57_condition)
+        symbol = build_carto_symbol(origin_v, scale, horiz_spacing, vert_spacing)
+        if target_v.s57_type is None:
+            window, label, number = symbol
+            template = (np.asarray(window.exterior.coords), np.asarray(label.exterior.coords), number,
+                        rectilinear_boxes(window), rectilinear_boxes(label))
+        else:
+            template = symbol
+
+        self.__templates[key] = template
+        if len(self.__templates) > self.__max_size:
+            self.__templates.popitem(last=False)
+        return template
+
+
+symbol_cache = SymbolCache()
+symbol_counts = {'calls': 0}
+metrics.register('carto_symbol', lambda: {'calls': symbol_counts['calls'], 'cache_hits': symbol_cache.get_hits(),
+                                          'cache_misses': symbol_cache.get_misses()})
+
+
 def get_carto_symbol(target_v, scale, horiz_spacing=None, vert_spacing=None):
+    """ Returns the carto symbol of a sounding or danger to navigation from the shared template cache. """
+    symbol_counts['calls'] += 1
+    return symbol_cache.get_symbol(target_v, scale, horiz_spacing, vert_spacing)
+
+
+def boxes_intersect(target_boxes, boxes):
+    """ Flags each of the (n, 4) boxes that intersects any of the (k, 4) target boxes. Boxes are closed, so boxes
+        sharing only an edge or a corner intersect, as with Shapely's intersects. """
+    target = target_boxes[:, np.newaxis, :]
+    hits = (target[..., 0] <= boxes[:, 2]) & (boxes[:, 0] <= target[..., 2]) & \
+           (target[..., 1] <= boxes[:, 3]) & (boxes[:, 1] <= target[..., 3])
+    return hits.any(axis=0)
+
+
+def segments_intersect_boxes(segments, boxes):
+    """ Flags each pair of segment ([x0, y0, x1, y1] rows) and box ([min_x, min_y, max_x, max_y] rows) that intersect;
+        both closed, as with Shapely's intersects. They do unless their envelopes are apart or the four box corners
+        lie strictly on one side of the segment line. """
+    x0, y0, x1, y1 = segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]
+    hits = (np.minimum(x0, x1) <= boxes[:, 2]) & (boxes[:, 0] <= np.maximum(x0, x1)) & \
+           (np.minimum(y0, y1) <= boxes[:, 3]) & (boxes[:, 1] <= np.maximum(y0, y1))
+    sides = np.stack([(x1 - x0) * (boxes[:, c_y] - y0) - (y1 - y0) * (boxes[:, c_x] - x0)
+                      for c_x, c_y in ((0, 1), (2, 1), (2, 3), (0, 3))])
+    return hits & ~np.all(sides > 0, axis=0) & ~np.all(sides < 0, axis=0)
+
+
+def get_overlapping_symbols(target_v, vertices, scale, horiz_spacing=None, vert_spacing=None):
+    """ Flags the vertices whose symbol intersects the symbol of target_v. Sounding labels are axis-aligned boxes
+        and are tested in one vectorized pass; danger symbols (ellipses and triangles) fall back to Shapely. """
+    overlaps = np.zeros(len(vertices), dtype=bool)
+    target_boxes = symbol_cache.get_boxes(target_v, scale, horiz_spacing, vert_spacing)
+    if target_boxes is None:
+        target_symbol = get_carto_symbol(target_v, scale, horiz_spacing, vert_spacing)[1]
+        for pos, v in enumerate(vertices):
+            overlaps[pos] = target_symbol.intersects(get_carto_symbol(v, scale, horiz_spacing, vert_spacing)[1])
+        return overlaps
+
+    boxes, positions = symbol_cache.get_label_boxes(vertices, scale, horiz_spacing, vert_spacing)
+    overlaps[positions[boxes_intersect(target_boxes[1], boxes)]] = True
+
+    target_label = None
+    for pos, v in enumerate(vertices):
+        if v.s57_type is not None:
+            if target_label is None:
+                target_label = get_carto_symbol(target_v, scale, horiz_spacing, vert_spacing)[1]
+            overlaps[pos] = target_label.intersects(get_carto_symbol(v, scale, horiz_spacing, vert_spacing)[1])
+    return overlaps
+
+
+def get_depth_label(z_value):
+    """ Depth label value: truncated to decimeters below 31 m, to meters otherwise. """
+    n = abs(z_value)
+    if n < 31:
+        number = math.trunc(n * 10.0) / 10.0
+        if number.is_integer():
+            number = int(n)
+    else:
+        number = int(n)
+    return number
+
+
+def rectilinear_boxes(polygon):
+    """ Decomposes a rectilinear polygon into horizontal bands; returns an (n, 4) array of [min_x, min_y, max_x,
+        max_y] boxes whose union is the polygon. """
+    coords = list(polygon.exterior.coords)
+    vertical_edges = [(x1, min(y1, y2), max(y1, y2)) for (x1, y1), (x2, y2) in zip(coords[:-1], coords[1:])
+                      if x1 == x2 and y1 != y2]
+    levels = sorted(set(y for x, y in coords))
+    boxes = list()
+    for bottom, top in zip(levels[:-1], levels[1:]):
+        mid_y = (bottom + top) / 2.0
+        crossings = sorted(x for x, lower, upper in vertical_edges if lower < mid_y < upper)
+        for i in range(0, len(crossings) - 1, 2):
+            boxes.append([crossings[i], bottom, crossings[i + 1], top])
+    return np.array(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def build_carto_symbol(target_v, scale, horiz_spacing=None, vert_spacing=None):
+    """ Builds the carto symbol at the position of target_v without caching. """
 
     if target_v.s57_type is None:  # SOUNDG
         x_spacing = horiz_spacing / 2.0
         y_spacing = vert_spacing / 2.0
 
-        n = abs(target_v.z_value)
-        if n < 31:
-            number = math.trunc(n * 10.0) / 10.0
-            if number.is_integer():
-                number = int(n)
-        else:
-            number = int(n)
+        number = get_depth_label(target_v.z_value)
 
         num_chars = len(str(number).replace('.', ''))
         is_decimal = False
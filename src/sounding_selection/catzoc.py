@@ -1,13 +1,82 @@
-def depth_tolerance(catzoc, depth):
-    if catzoc.upper() == 'A1':  # Encoded value = 1
-        depth_accuracy = 0.5 + (depth * 0.01)
-    elif catzoc.upper() == 'A2':  # Encoded value = 2
-        depth_accuracy = 1 + (depth * 0.02)
-    elif catzoc.upper() == 'B':  # Encoded value = 3
-        depth_accuracy = 1 + (depth * 0.02)
-    elif catzoc.upper() == 'C':  # Encoded value = 4
-        depth_accuracy = 2 + (depth * 0.05)
-    elif catzoc.upper() == 'D' or catzoc.upper() == 'U':  # Encoded value > 4
-        depth_accuracy = None
-
-    return depth_accuracy
+import numpy as np
+
+
+# Depth tolerance (constant, depth factor) indexed by encoded CATZOC value: A1 = 1, A2 = 2, B = 3, C = 4, D = 5, U = 6;
+# D and U have no tolerance
+DEPTH_TOLERANCE_TABLE = np.array([[np.nan, np.nan],
+                                  [0.5, 0.01],
+                                  [1.0, 0.02],
+                                  [1.0, 0.02],
+                                  [2.0, 0.05],
+                                  [np.nan, np.nan],
+                                  [np.nan, np.nan]])
+
+
+def best_catzoc(vertex_catzoc):
+    """ Returns the highest quality (lowest) encoded CATZOC of each row of vertex CATZOC values; rows without a value
+        get U (6). """
+    vertex_catzoc = np.asarray(vertex_catzoc, dtype=np.float64)
+    codes = np.full(len(vertex_catzoc), 6, dtype=np.int64)
+    known = ~np.all(np.isnan(vertex_catzoc), axis=1)
+    codes[known] = np.nanmin(vertex_catzoc[known], axis=1).astype(np.int64)
+    return codes
+
+
+def has_depth_tolerance(catzoc_codes):
+    return ~np.isnan(DEPTH_TOLERANCE_TABLE[catzoc_codes, 0])
+
+
+def depth_tolerance_array(catzoc_codes, depths):
+    """ Depth tolerance of each depth by encoded CATZOC value; NaN where there is no tolerance. """
+    tolerance = DEPTH_TOLERANCE_TABLE[catzoc_codes]
+    return tolerance[..., 0] + (depths * tolerance[..., 1])
+
+
+def surface_deviations(tri_x, tri_y, tri_z, tri_catzoc, point_x, point_y, point_z, point_tri, shallow_only=True):
+    """ Batched evaluation of candidate soundings against the planar surface of their triangles.
+
+        tri_x, tri_y, tri_z: (T, 3) vertex coordinates of the triangles; tri_catzoc: (T,) encoded CATZOC of each
+        triangle. point_x, point_y, point_z: candidate soundings; point_tri: triangle (row) of each candidate.
+
+        Returns the interpolated depth of each candidate, the mask of candidates whose deviation (interpolated minus
+        actual depth, absolute unless shallow_only) exceeds the tolerance, and for each triangle the candidate with
+        the largest deviation among the exceeding ones (the first on ties) or -1. Candidates lying on a vertex of
+        their triangle never exceed. """
+    point_tri = np.asarray(point_tri, dtype=np.int64)
+    p1x, p2x, p3x = tri_x[point_tri, 0], tri_x[point_tri, 1], tri_x[point_tri, 2]
+    p1y, p2y, p3y = tri_y[point_tri, 0], tri_y[point_tri, 1], tri_y[point_tri, 2]
+
+    weight1_numer = ((p2y - p3y) * (point_x - p3x)) + ((p3x - p2x) * (point_y - p3y))
+    weight2_numer = ((p3y - p1y) * (point_x - p3x)) + ((p1x - p3x) * (point_y - p3y))
+    denom = ((p2y - p3y) * (p1x - p3x)) + ((p3x - p2x) * (p1y - p3y))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight1 = weight1_numer / denom
+        weight2 = weight2_numer / denom
+    weight3 = 1 - weight1 - weight2
+    interp_z = (tri_z[point_tri, 0] * weight1) + (tri_z[point_tri, 1] * weight2) + (tri_z[point_tri, 2] * weight3)
+
+    difference = interp_z - point_z
+    deviation = difference if shallow_only else np.abs(difference)
+    with np.errstate(invalid='ignore'):
+        exceeds = deviation > depth_tolerance_array(tri_catzoc[point_tri], point_z)
+    on_vertex = ((point_x == p1x) & (point_y == p1y)) | ((point_x == p2x) & (point_y == p2y)) | \
+                ((point_x == p3x) & (point_y == p3y))
+    exceeds &= ~on_vertex
+
+    # Largest (signed) difference per triangle: sort exceeding candidates by triangle, decreasing difference, position
+    largest = np.full(len(tri_x), -1, dtype=np.int64)
+    candidates = np.flatnonzero(exceeds)
+    if len(candidates) > 0:
+        order = candidates[np.lexsort((candidates, -difference[candidates], point_tri[candidates]))]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = point_tri[order][1:] != point_tri[order][:-1]
+        largest[point_tri[order[first]]] = order[first]
+
+    return interp_z, exceeds, largest
+
+
+def triangle_arrays(tin, triangle_ids=None):
+    """ Returns the (T, 3) x, y, z and CATZOC arrays of the vertices of the TIN triangles. """
+    triangles = tin.get_triangles() if triangle_ids is None else tin.get_triangles()[triangle_ids]
+    store, ids = tin.get_store(), tin.get_ids()[triangles]
+    return store.x[ids], store.y[ids], store.z[ids], store.catzoc[ids]
@@ -0,0 +1,325 @@
+import triangle
+import numpy as np
+from fractions import Fraction
+from sounding_selection.tin import TIN
+from sounding_selection.topology import Topology, triangle_neighbors
+from sounding_selection.reader import Reader
+from sounding_selection.utilities import triangulate
+from sounding_selection.logger import log
+from sounding_selection.metrics import metrics
+
+
+class ConstrainedTIN(object):
+    """ Constrained Delaunay TIN of a changing set of soundings over fixed contour and boundary segments.
+
+        Soundings are inserted and deleted by re-triangulating only the region in conflict with the change: the
+        Bowyer-Watson cavities of the inserted soundings (triangles whose circumcircle contains them, reached without
+        crossing a constraint) and the stars of the deleted ones. The region is re-triangulated with its boundary and
+        the constraints inside it as segments, which gives the triangles a full triangulation would have there. Every
+        update returns the ids of the triangles it created; the other triangles keep their ids. Updates that would
+        split or merge a constraint segment, or change the extent of the TIN, fall back to a full triangulation.
+
+        Soundings sharing coordinates share a TIN vertex, represented (as in Reader.read_triangulation) by the first
+        sounding, or by the segment vertex when no sounding is left. """
+
+    def __init__(self, soundings, segments, segments_idx, holes, store):
+        self.__store = store
+        self.__segments, self.__segments_idx, self.__holes = segments, segments_idx, holes
+        self.__tin = None
+        self.__soundings = dict()  # sounding id -> vertex position, in insertion order
+        self.__build(store.add_vertices(soundings))
+
+    def get_tin(self):
+        return self.__tin
+
+    def get_soundings(self):
+        return self.__store.get_vertices(self.__soundings)
+
+    def get_soundings_num(self):
+        return len(self.__soundings)
+
+    def set_soundings(self, soundings):
+        """ Inserts and deletes soundings so that the TIN is the triangulation of soundings; returns the new
+            triangles. """
+        s_ids = dict.fromkeys(int(s_id) for s_id in self.__store.add_vertices(soundings))
+        inserted = [s_id for s_id in s_ids if s_id not in self.__soundings]
+        deleted = [s_id for s_id in self.__soundings if s_id not in s_ids]
+        return self.update(self.__store.get_vertices(inserted), self.__store.get_vertices(deleted))
+
+    def insert(self, soundings):
+        return self.update(inserted=soundings)
+
+    def delete(self, soundings):
+        return self.update(deleted=soundings)
+
+    def update(self, inserted=(), deleted=()):
+        """ Deletes, then inserts soundings and returns the ids of the new triangles (all of them after a full
+            triangulation). """
+        store = self.__store
+        metrics.count('tin_updates')
+
+        # Vertex bookkeeping: a vertex is deleted with its last sounding and created with the first one
+        touched = set()
+        for s_id in store.add_vertices(deleted):
+            pos = self.__soundings.pop(int(s_id), None)
+            if pos is not None:
+                self.__references[pos].remove(int(s_id))
+                touched.add(pos)
+        created = list()
+        for s_id in store.add_vertices(inserted):
+            s_id = int(s_id)
+            if s_id in self.__soundings:
+                continue
+            key = (float(store.x[s_id]), float(store.y[s_id]))
+            pos = self.__coordinates.get(key)
+            if pos is None:
+                pos = len(self.__references)
+                self.__coordinates[key] = pos
+                self.__references.append([s_id])
+                self.__segment_ids.append(-1)
+                created.append(pos)
+            else:
+                self.__references[pos].append(s_id)
+                touched.add(pos)
+            self.__soundings[s_id] = pos
+
+        removed = np.array(sorted(p for p in touched if len(self.__references[p]) == 0 and self.__segment_ids[p] < 0),
+                           dtype=np.int64)
+        old_ids = self.__ids
+        self.__ids = np.concatenate((old_ids, np.zeros(len(created), dtype=np.int64)))
+        for pos in list(touched) + created:
+            self.__ids[pos] = self.__vertex_id(pos)
+        # Vertices now represented by another sounding
+        relabeled = np.array([p for p in touched if p < len(old_ids) and self.__ids[p] != old_ids[p]], dtype=np.int64)
+        relabeled = np.setdiff1d(relabeled, removed)
+        if len(removed) == 0 and len(created) == 0:
+            changed = np.flatnonzero(np.isin(self.__triangles, relabeled).any(axis=1))
+        else:
+            changed = self.__retriangulate(removed, np.array(created, dtype=np.int64), old_ids, relabeled)
+            if changed is None:
+                metrics.count('tin_rebuilds')
+                self.__build(list(self.__soundings))
+                return np.arange(len(self.__triangles))
+
+        self.__tin = TIN(store, self.__ids, self.__triangles)
+        self.__tin.compute_domain()
+        self.__tin.set_topology(Topology(self.__tin.get_triangles(), len(self.__ids), self.__neighbors.copy()))
+        metrics.count('tin_changed_triangles', len(changed))
+        return changed
+
+    def __vertex_id(self, pos):
+        references = self.__references[pos]
+        return references[0] if len(references) > 0 else self.__segment_ids[pos]
+
+    def __build(self, s_ids):
+        """ Triangulates the soundings and the segments from scratch. """
+        store = self.__store
+        soundings, segments = store.get_vertices(s_ids), self.__segments
+        triangulation = triangulate(soundings, segments, self.__segments_idx, self.__holes)
+        self.__tin = Reader.read_triangulation(triangulation, soundings + segments, store)
+
+        ids = self.__tin.get_ids()
+        self.__coordinates = {key: pos for pos, key in enumerate(zip(store.x[ids].tolist(), store.y[ids].tolist()))}
+        self.__references = [list() for _ in range(len(ids))]
+        self.__segment_ids = [-1] * len(ids)
+        self.__soundings = dict()
+        for s_id in store.add_vertices(segments):
+            pos = self.__coordinates[(float(store.x[s_id]), float(store.y[s_id]))]
+            if self.__segment_ids[pos] < 0:
+                self.__segment_ids[pos] = int(s_id)
+        for s_id in s_ids:
+            s_id = int(s_id)
+            if s_id not in self.__soundings:
+                pos = self.__coordinates[(float(store.x[s_id]), float(store.y[s_id]))]
+                self.__references[pos].append(s_id)
+                self.__soundings[s_id] = pos
+        self.__ids = ids
+
+        self.__triangles = self.__tin.get_triangles().astype(np.int64)
+        self.__neighbors = triangle_neighbors(self.__triangles)
+        self.__constrained = np.zeros(self.__triangles.shape, dtype=bool)
+        subsegments = np.asarray(triangulation.get('segments', np.empty((0, 2))), dtype=np.int64).reshape(-1, 2)
+        if len(subsegments) > 0:
+            vertices_num = len(ids)
+            segment_keys = np.min(subsegments, axis=1) * vertices_num + np.max(subsegments, axis=1)
+            for k in range(3):
+                a, b = self.__triangles[:, (k + 1) % 3], self.__triangles[:, (k + 2) % 3]
+                self.__constrained[:, k] = np.isin(np.minimum(a, b) * vertices_num + np.maximum(a, b), segment_keys)
+        # Without constraints all around, a sounding outside the TIN would extend it
+        self.__open = bool(np.any((self.__neighbors < 0) & ~self.__constrained))
+        self.__tin.set_topology(Topology(self.__tin.get_triangles(), len(ids), self.__neighbors.copy()))
+
+    def __retriangulate(self, removed, created, old_ids, relabeled):
+        """ Re-triangulates the region in conflict with the removed and created vertex positions and returns the new
+            triangles, together with the ones having a relabeled vertex, or None when the update cannot be done
+            locally. """
+        store, triangles, neighbors, constrained = self.__store, self.__triangles, self.__neighbors, self.__constrained
+        # Removed vertices have no sounding left; their coordinates are the ones of their former sounding
+        vertex_ids = self.__ids.copy()
+        vertex_ids[removed] = old_ids[removed]
+        x, y = store.x[vertex_ids], store.y[vertex_ids]
+
+        # Stars of the removed vertices; edges leaving a removed vertex must be unconstrained and inside the TIN
+        is_removed = np.isin(triangles, removed)
+        region = set(np.flatnonzero(is_removed.any(axis=1)).tolist())
+        star = np.array(sorted(region), dtype=np.int64)
+        for k in range(3):
+            leaving = is_removed[star, (k + 1) % 3] | is_removed[star, (k + 2) % 3]
+            if np.any(leaving & (constrained[star, k] | (neighbors[star, k] < 0))):
+                return None
+
+        # Cavities of the created vertices, grown from the triangles containing them
+        inside = np.zeros(len(created), dtype=bool)
+        if len(created) > 0:
+            offsets, point_index = self.__tin.locate_points(x[created], y[created])
+            containing = np.repeat(np.arange(len(triangles)), np.diff(offsets))
+            inside[point_index] = True
+            if self.__open and not np.all(inside):
+                return None
+            seeds = dict()
+            for t_id, p in zip(containing.tolist(), point_index.tolist()):
+                seeds.setdefault(p, list()).append(t_id)
+            for p, cavity in seeds.items():
+                px, py = x[created[p]], y[created[p]]
+                region.update(cavity)
+                visited, stack = set(cavity), list(cavity)
+                while len(stack) > 0:
+                    t_id = stack.pop()
+                    for k in range(3):
+                        n_id = neighbors[t_id, k]
+                        if n_id < 0 or n_id in visited or constrained[t_id, k]:
+                            continue
+                        visited.add(n_id)
+                        if in_circumcircle(x[triangles[n_id]], y[triangles[n_id]], px, py):
+                            region.add(n_id)
+                            stack.append(n_id)
+        if len(region) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        # Region boundary edges and constrained edges inside the region are the segments of the local triangulation
+        region = np.array(sorted(region), dtype=np.int64)
+        in_region = np.zeros(len(triangles), dtype=bool)
+        in_region[region] = True
+        region_neighbors = neighbors[region]
+        boundary = (region_neighbors < 0) | ~in_region[np.maximum(region_neighbors, 0)]
+        edges, edge_info = dict(), dict()
+        for r, k in zip(*np.nonzero(boundary | constrained[region])):
+            t_id = region[r]
+            a, b = int(triangles[t_id, (k + 1) % 3]), int(triangles[t_id, (k + 2) % 3])
+            key = (min(a, b), max(a, b))
+            edges[key] = bool(constrained[t_id, k])
+            if boundary[r, k]:
+                # The triangle across the edge and the position of the edge in it
+                n_id = int(region_neighbors[r, k])
+                edge_info[key] = (n_id, -1 if n_id < 0 else int(np.flatnonzero(neighbors[n_id] == t_id)[0]))
+
+        kept = np.setdiff1d(triangles[region].ravel(), removed)
+        local = np.union1d(kept, created[inside])
+        segments = np.searchsorted(local, np.array(list(edges), dtype=np.int64).reshape(-1, 2))
+        triangulation = triangle.triangulate({'vertices': np.column_stack((x[local], y[local])),
+                                              'segments': segments}, 'pCSi')
+        if len(triangulation['vertices']) != len(local) or len(triangulation.get('segments', [])) != len(segments):
+            # A created vertex lies on a constraint or on the TIN boundary
+            return None
+
+        # Triangulation of the region only: drop the triangles filling the holes and concavities around it
+        new_triangles = local[np.asarray(triangulation.get('triangles', np.empty((0, 3))), dtype=np.int64)]
+        region_vertices, region_triangles = np.unique(triangles[region], return_inverse=True)
+        region_tin = TIN(store, old_ids[region_vertices], region_triangles.reshape(-1, 3))
+        centroid_index = region_tin.locate_points(x[new_triangles].mean(axis=1), y[new_triangles].mean(axis=1))[1]
+        new_triangles = new_triangles[np.isin(np.arange(len(new_triangles)), centroid_index)]
+        if not np.isclose(triangle_areas(x, y, new_triangles).sum(), triangle_areas(x, y, triangles[region]).sum(),
+                          rtol=1e-9, atol=0.0):
+            log.debug('Local Re-triangulation Does Not Cover the Conflict Region')
+            return None
+
+        # New triangles fill the slots of the region, then extend the arrays
+        slots = np.concatenate((region, np.arange(len(triangles), len(triangles) + len(new_triangles) - len(region),
+                                                  dtype=np.int64)))[:len(new_triangles)]
+        extra = len(new_triangles) - len(region)
+        if extra > 0:
+            triangles = np.vstack((triangles, np.zeros((extra, 3), dtype=np.int64)))
+            neighbors = np.vstack((neighbors, np.full((extra, 3), -1, dtype=np.int64)))
+            constrained = np.vstack((constrained, np.zeros((extra, 3), dtype=bool)))
+        triangles[slots], neighbors[slots] = new_triangles, -1
+        new_edges = dict()
+        for i, t_id in enumerate(slots.tolist()):
+            for k in range(3):
+                a, b = int(new_triangles[i, (k + 1) % 3]), int(new_triangles[i, (k + 2) % 3])
+                key = (min(a, b), max(a, b))
+                constrained[t_id, k] = edges.get(key, False)
+                if key in edge_info:
+                    n_id, n_k = edge_info[key]
+                    neighbors[t_id, k] = n_id
+                    if n_id >= 0:
+                        neighbors[n_id, n_k] = t_id
+                elif key in new_edges:
+                    n_id, n_k = new_edges.pop(key)
+                    neighbors[t_id, k], neighbors[n_id, n_k] = n_id, t_id
+                else:
+                    new_edges[key] = (t_id, k)
+
+        # Unused slots are filled with the last triangles; moved triangles are reported as new
+        unused = region[len(new_triangles):]
+        triangles_num = len(triangles) - len(unused)
+        holes = unused[unused < triangles_num]
+        moved = np.setdiff1d(np.arange(triangles_num, len(triangles)), unused)
+        t_map = np.arange(len(triangles))
+        t_map[moved] = holes
+        triangles[holes], neighbors[holes], constrained[holes] = triangles[moved], neighbors[moved], constrained[moved]
+        triangles, constrained = triangles[:triangles_num], constrained[:triangles_num]
+        neighbors = np.where(neighbors[:triangles_num] < 0, -1, t_map[neighbors[:triangles_num]])
+        changed = np.union1d(t_map[slots], holes)
+
+        if len(relabeled) > 0:
+            changed = np.union1d(changed, np.flatnonzero(np.isin(triangles, relabeled).any(axis=1)))
+
+        # Removed positions are filled with the last vertices
+        if len(removed) > 0:
+            vertices_num = len(self.__ids) - len(removed)
+            holes = removed[removed < vertices_num]
+            moved = np.setdiff1d(np.arange(vertices_num, len(self.__ids)), removed)
+            v_map = np.arange(len(self.__ids))
+            v_map[moved] = holes
+            triangles = v_map[triangles]
+            for pos in removed.tolist():
+                del self.__coordinates[(float(x[pos]), float(y[pos]))]
+            for old, new in zip(moved.tolist(), holes.tolist()):
+                self.__coordinates[(float(x[old]), float(y[old]))] = new
+                self.__references[new], self.__segment_ids[new] = self.__references[old], self.__segment_ids[old]
+                for s_id in self.__references[new]:
+                    self.__soundings[s_id] = new
+            del self.__references[vertices_num:], self.__segment_ids[vertices_num:]
+            self.__ids[holes] = self.__ids[moved]
+            self.__ids = self.__ids[:vertices_num]
+
+        self.__triangles, self.__neighbors, self.__constrained = triangles, neighbors, constrained
+        return changed
+
+
+def triangle_areas(x, y, triangles):
+    t_x, t_y = x[triangles], y[triangles]
+    return np.abs((t_x[:, 1] - t_x[:, 0]) * (t_y[:, 2] - t_y[:, 0]) - (t_x[:, 2] - t_x[:, 0]) * (t_y[:, 1] - t_y[:, 0]))
+
+
+def in_circumcircle(t_x, t_y, px, py):
+    """ Whether (px, py) lies strictly inside the circumcircle of the triangle; coordinates are taken relative to the
+        point, and determinants within the floating point error bound are evaluated exactly. """
+    ax, ay, bx, by, cx, cy = [float(c) for c in (t_x[0] - px, t_y[0] - py, t_x[1] - px, t_y[1] - py, t_x[2] - px,
+                                                 t_y[2] - py)]
+    a_lift, b_lift, c_lift = ax * ax + ay * ay, bx * bx + by * by, cx * cx + cy * cy
+    det = a_lift * (bx * cy - cx * by) + b_lift * (cx * ay - ax * cy) + c_lift * (ax * by - bx * ay)
+    permanent = a_lift * (abs(bx * cy) + abs(cx * by)) + b_lift * (abs(cx * ay) + abs(ax * cy)) + \
+        c_lift * (abs(ax * by) + abs(bx * ay))
+    orientation = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+    if abs(det) <= 1e-14 * permanent or orientation == 0:
+        # Coordinate differences are not exact in floating point either: recompute from the original coordinates
+        t = [(Fraction(float(t_x[i])) - Fraction(float(px)), Fraction(float(t_y[i])) - Fraction(float(py)))
+             for i in range(3)]
+        (ax, ay), (bx, by), (cx, cy) = t
+        det = (ax * ax + ay * ay) * (bx * cy - cx * by) + (bx * bx + by * by) * (cx * ay - ax * cy) + \
+            (cx * cx + cy * cy) * (ax * by - bx * ay)
+        orientation = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+    if orientation < 0:
+        det = -det
+    return det > 0
@@ -0,0 +1,91 @@
+import numpy as np
+from shapely.geometry import Polygon
+from sounding_selection.utilities import points_in_polygon, point_polygon_pairs
+from sounding_selection.metrics import metrics
+
+
+class ContourTree(object):
+    """ Containment tree of the closed depth contours of a DepthsL FeatureLayer.
+
+        The parent of a contour is the smallest closed contour enclosing it (on equal areas, the later record), and
+        the roots are the contours enclosed by none. Contours are assumed not to cross, as depth contours do not, so
+        the contours holding a point form a path of the tree: a point is assigned to the innermost of them by testing
+        it against the children of its current contour only, and the points inside a contour are the points assigned
+        to its subtree. A point on the boundary shared by two sibling contours is assigned to the first of them. """
+
+    def __init__(self, depth_contours):
+        self.__contours, self.__polygons = list(), list()
+        for c_id, line in enumerate(depth_contours.get_geometries()):
+            contour_x, contour_y = line.coords.xy
+            if contour_x[0] == contour_x[-1] and contour_y[0] == contour_y[-1]:
+                self.__contours.append(c_id)
+                self.__polygons.append(Polygon(line))
+        contours_num = len(self.__polygons)
+
+        # Enclosing contours are the ones holding an interior point of the contour and ranking after it by area
+        areas = np.array([polygon.area for polygon in self.__polygons], dtype=np.float64)
+        rank = np.empty(contours_num, dtype=np.int64)
+        rank[np.lexsort((np.arange(contours_num), areas))] = np.arange(contours_num)
+        inner_points = np.array([polygon.representative_point().coords[0] for polygon in self.__polygons],
+                                dtype=np.float64).reshape(-1, 2)
+        inner, outer = point_polygon_pairs(self.__polygons, inner_points[:, 0], inner_points[:, 1])
+        enclosing = rank[outer] > rank[inner]
+        inner, outer = inner[enclosing], outer[enclosing]
+        self.__parents = np.full(contours_num, -1, dtype=np.int64)
+        for contour, parent in zip(inner, outer):
+            if self.__parents[contour] < 0 or rank[parent] < rank[self.__parents[contour]]:
+                self.__parents[contour] = parent
+
+        # Children by contour; the roots are the children of the last entry
+        self.__children = [list() for _ in range(contours_num + 1)]
+        for contour, parent in enumerate(self.__parents):
+            self.__children[parent].append(contour)
+        # Breadth-first order: parents before their children
+        self.__order = list()
+        level = self.__children[-1]
+        while len(level) > 0:
+            self.__order.extend(level)
+            level = [child for contour in level for child in self.__children[contour]]
+        metrics.count('closed_contours', contours_num)
+
+    def get_contours_num(self):
+        return len(self.__polygons)
+
+    def get_contour_ids(self):
+        """ Returns the record positions of the closed contours in the depth contour layer. """
+        return self.__contours
+
+    def get_parents(self):
+        return self.__parents
+
+    def assign_points(self, x, y):
+        """ Returns the innermost closed contour (tree position) holding each of the x, y points, -1 for none. """
+        contours = np.full(len(x), -1, dtype=np.int64)
+        pending = [(-1, np.arange(len(x)))]
+        while len(pending) > 0:
+            contour, points = pending.pop()
+            for child in self.__children[contour]:
+                if len(points) == 0:
+                    break
+                inside = points_in_polygon(self.__polygons[child], x[points], y[points])
+                contours[points[inside]] = child
+                pending.append((child, points[inside]))
+                points = points[~inside]
+        return contours
+
+    def least_depths(self, x, y, z):
+        """ Returns for each closed contour the position of the shallowest x, y, z point inside it (the first one on
+            equal depths), -1 for none. The shallowest point assigned to each contour is propagated up the tree, so a
+            contour takes the shallowest point of its subtree. """
+        contours = self.assign_points(x, y)
+        # The last entry gathers the points outside every contour, as the roots' parent
+        least = np.full(len(self.__polygons) + 1, -1, dtype=np.int64)
+        order = np.lexsort((np.arange(len(z)), z))
+        assigned, first = np.unique(contours[order], return_index=True)
+        least[assigned] = order[first]
+
+        for contour in reversed(self.__order):
+            parent, candidate = self.__parents[contour], least[contour]
+            if candidate >= 0 and (least[parent] < 0 or (z[candidate], candidate) < (z[least[parent]], least[parent])):
+                least[parent] = candidate
+        return least[:-1]
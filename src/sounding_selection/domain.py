@@ -1,5 +1,70 @@
 from sounding_selection.point import Point
-from shapely.geometry import Polygon
+from shapely.geometry import Polygon, box
+from shapely.geometry import Point as Shapely_Point
+from shapely.prepared import prep
+from sounding_selection.metrics import metrics
+
+# Number of polygon predicates answered from bounding boxes only and number evaluated exactly with Shapely
+predicate_counts = {'bounds': 0, 'exact': 0}
+metrics.register('polygon_predicates', predicate_counts)
+
+
+class QueryPolygon(object):
+    """ Query polygon of a quadtree traversal. Its bounds are computed once and most node tests are decided by
+        coordinate comparisons; exact predicates run on a prepared geometry, shared by the whole traversal, only for
+        nodes straddling the polygon boundary. """
+
+    def __init__(self, polygon):
+        self.__polygon = polygon
+        self.__min_x, self.__min_y, self.__max_x, self.__max_y = polygon.bounds
+        self.__has_area = polygon.area > 0
+        self.__prepared = None
+
+    def get_polygon(self):
+        return self.__polygon
+
+    def get_bounds(self):
+        return self.__min_x, self.__min_y, self.__max_x, self.__max_y
+
+    def __get_prepared(self):
+        if self.__prepared is None:
+            self.__prepared = prep(self.__polygon)
+        return self.__prepared
+
+    def __bounds_within(self, min_x, min_y, max_x, max_y):
+        return min_x <= self.__min_x and self.__max_x <= max_x and min_y <= self.__min_y and self.__max_y <= max_y
+
+    def __bounds_disjoint(self, min_x, min_y, max_x, max_y):
+        return max_x < self.__min_x or self.__max_x < min_x or max_y < self.__min_y or self.__max_y < min_y
+
+    def contained_by_box(self, min_x, min_y, max_x, max_y):
+        """ Same result as box(min_x, min_y, max_x, max_y).contains(polygon). """
+        within = self.__bounds_within(min_x, min_y, max_x, max_y)
+        if within is False or self.__has_area:
+            # A polygon with area whose bounds lie in the closed box is contained by it
+            predicate_counts['bounds'] += 1
+            return within
+        predicate_counts['exact'] += 1
+        return box(min_x, min_y, max_x, max_y).contains(self.__polygon)
+
+    def intersects_box(self, min_x, min_y, max_x, max_y):
+        """ Same result as polygon.intersects(box(min_x, min_y, max_x, max_y)). """
+        if self.__bounds_disjoint(min_x, min_y, max_x, max_y):
+            predicate_counts['bounds'] += 1
+            return False
+        if self.__bounds_within(min_x, min_y, max_x, max_y) and not self.__polygon.is_empty:
+            predicate_counts['bounds'] += 1
+            return True
+        predicate_counts['exact'] += 1
+        return self.__get_prepared().intersects(box(min_x, min_y, max_x, max_y))
+
+    def intersects_point(self, x, y):
+        """ Same result as polygon.intersects(Point(x, y)). """
+        if x < self.__min_x or self.__max_x < x or y < self.__min_y or self.__max_y < y:
+            predicate_counts['bounds'] += 1
+            return False
+        predicate_counts['exact'] += 1
+        return self.__get_prepared().intersects(Shapely_Point(x, y))
 
 
 class Domain(object):
@@ -32,20 +97,16 @@ class Domain(object):
         return True
 
     def intersects_polygon(self, polygon):
-        node_rectangle = Polygon([(self.__min.x_value, self.__min.y_value),
-                                  (self.__min.x_value, self.__max.y_value),
-                                  (self.__max.x_value, self.__max.y_value),
-                                  (self.__max.x_value, self.__min.y_value)])
-
-        return polygon.intersects(node_rectangle)
+        """ Takes a Shapely polygon or a QueryPolygon; the latter is tested against the domain bounds first """
+        if not isinstance(polygon, QueryPolygon):
+            polygon = QueryPolygon(polygon)
+        return polygon.intersects_box(self.__min.x_value, self.__min.y_value, self.__max.x_value, self.__max.y_value)
 
     def contains_polygon(self, polygon):
-        node_rectangle = Polygon([(self.__min.x_value, self.__min.y_value),
-                                  (self.__min.x_value, self.__max.y_value),
-                                  (self.__max.x_value, self.__max.y_value),
-                                  (self.__max.x_value, self.__min.y_value)])
-
-        return node_rectangle.contains(polygon)
+        if not isinstance(polygon, QueryPolygon):
+            polygon = QueryPolygon(polygon)
+        return polygon.contained_by_box(self.__min.x_value, self.__min.y_value, self.__max.x_value,
+                                        self.__max.y_value)
 
     def coord_in_range(self, c, min_c, max_c, abs_max_c):
         if max_c == abs_max_c:
@@ -0,0 +1,92 @@
+import shapefile
+import numpy as np
+from shapely.geometry import shape
+from sounding_selection.utilities import build_strtree, query_strtree
+from sounding_selection.metrics import metrics
+
+# Attributes read from each ENC layer
+DEPTH_AREA_FIELDS = ('DRVAL1', 'DRVAL2', 'FCSubtype')
+DEPTH_CONTOUR_FIELDS = ('VALDCO',)
+DANGER_FIELDS = ('VALSOU', 'WATLEV', 'FCSUBTYPE', 'CATWRK')
+
+
+class FeatureLayer(object):
+    """ Features of a shapefile read once: Shapely geometries and attribute columns in record order, and an STRtree
+        over the geometries built on the first query. """
+
+    def __init__(self, path, fields):
+        self.__path = path
+        self.__geometries = list()
+        columns = [list() for _ in fields]
+        reader = shapefile.Reader(path)
+        try:
+            for shape_record in reader.iterShapeRecords(fields=list(fields)):
+                self.__geometries.append(shape(shape_record.shape.__geo_interface__))
+                for column, value in zip(columns, shape_record.record):
+                    column.append(value)
+        finally:
+            reader.close()
+        self.__attributes = {field: np.asarray(column) for field, column in zip(fields, columns)}
+        self.__tree = None
+        self.__segments = None
+        metrics.count('enc_features_read', len(self.__geometries))
+
+    def __getstate__(self):
+        # Sent to validation workers without the tree, which is rebuilt on demand
+        state = self.__dict__.copy()
+        state['_FeatureLayer__tree'] = None
+        return state
+
+    def get_path(self):
+        return self.__path
+
+    def get_features_num(self):
+        return len(self.__geometries)
+
+    def get_geometries(self):
+        return self.__geometries
+
+    def get_geometry(self, f_id):
+        return self.__geometries[f_id]
+
+    def get_attribute(self, field):
+        return self.__attributes[field]
+
+    def get_segments(self):
+        """ Returns the segments of the lines of the layer as an (n, 4) array of [x0, y0, x1, y1] rows, and the
+            feature of each segment; computed once. """
+        if self.__segments is None:
+            segments, features = [np.empty((0, 4))], [np.empty(0, dtype=np.int64)]
+            for f_id, line in enumerate(self.__geometries):
+                coords = np.asarray(line.coords, dtype=np.float64)[:, :2]
+                if len(coords) > 1:
+                    segments.append(np.hstack((coords[:-1], coords[1:])))
+                    features.append(np.full(len(coords) - 1, f_id, dtype=np.int64))
+            self.__segments = (np.concatenate(segments), np.concatenate(features))
+        return self.__segments
+
+    def query(self, geometry):
+        """ Returns the positions of the features whose envelope intersects the one of geometry, in record order. """
+        if self.__tree is None:
+            self.__tree = build_strtree(self.__geometries)
+        return query_strtree(self.__tree, geometry)
+
+
+class FeatureStore(object):
+    """ ENC features of a run: depth areas (DepthsA), depth contours (DepthsL), and dangers to navigation (DangersP),
+        each read once from its shapefile. """
+
+    def __init__(self, depth_areas, depth_contours, dangers=None):
+        self.__depth_areas = FeatureLayer(depth_areas, DEPTH_AREA_FIELDS)
+        self.__depth_contours = FeatureLayer(depth_contours, DEPTH_CONTOUR_FIELDS)
+        self.__dangers = None if dangers is None else FeatureLayer(dangers, DANGER_FIELDS)
+
+    def get_depth_areas(self):
+        return self.__depth_areas
+
+    def get_depth_contours(self):
+        return self.__depth_contours
+
+    def get_dangers(self):
+        """ Returns the dangers to navigation layer, or None if none was provided. """
+        return self.__dangers
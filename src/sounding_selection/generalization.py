@@ -0,0 +1,78 @@
+import numpy as np
+from sounding_selection.metrics import metrics
+
+
+class Generalization(object):
+    """ Shoal-biased generalization over a fixed depth order of soundings.
+
+        Soundings are sorted once by depth (stable, so equal depths keep the input order) and an alive mask flags the
+        ones not yet selected nor suppressed; soundings are addressed by their store id, so suppressing one and
+        skipping it are O(1) instead of a search and a deletion in a sorted list. select() repeatedly takes the
+        shoalest alive sounding and suppresses the soundings a conflict predicate reports for it; suppress() also
+        serves loops whose targets come from elsewhere. A conflict predicate takes the target sounding and returns the
+        soundings in conflict with it, see dcm_conflicts and radius_conflicts. """
+    def __init__(self, soundings):
+        z = np.fromiter((v.z_value for v in soundings), dtype=np.float64, count=len(soundings))
+        order = np.argsort(z, kind='stable')
+        self.__soundings = [soundings[i] for i in order]
+        self.__positions = {v.sounding_id: pos for pos, v in reversed(list(enumerate(self.__soundings)))}
+        self.__alive = np.ones(len(soundings), dtype=bool)
+        self.__cursor = 0
+
+    def get_alive_num(self):
+        return int(np.count_nonzero(self.__alive))
+
+    def get_alive(self):
+        """ Returns the soundings that are neither selected nor suppressed, shallow to deep. """
+        return [self.__soundings[pos] for pos in np.flatnonzero(self.__alive)]
+
+    def is_alive(self, v):
+        pos = self.__positions.get(v.sounding_id)
+        return pos is not None and bool(self.__alive[pos])
+
+    def next(self):
+        """ Returns the shoalest alive sounding, or None when there is none left. """
+        while self.__cursor < len(self.__soundings) and not self.__alive[self.__cursor]:
+            self.__cursor += 1
+        return self.__soundings[self.__cursor] if self.__cursor < len(self.__soundings) else None
+
+    def suppress(self, soundings):
+        """ Marks the soundings as no longer alive; soundings outside the generalization are ignored. """
+        for v in soundings:
+            pos = self.__positions.get(v.sounding_id)
+            if pos is not None:
+                self.__alive[pos] = False
+        metrics.count('generalization_suppressed', len(soundings))
+
+    def select(self, conflicts):
+        """ Selects the shoalest alive sounding and suppresses its conflicts until no sounding is left; returns the
+            selected soundings, shallow to deep. """
+        selected = list()
+        target = self.next()
+        while target is not None:
+            self.suppress(conflicts(target))
+            self.__alive[self.__cursor] = False
+            selected.append(target)
+            target = self.next()
+        metrics.count('generalization_selected', len(selected))
+        return selected
+
+
+def dcm_conflicts(tree, point_set, scale, h_spacing, v_spacing):
+    """ Conflict predicate of label-based generalization: the soundings of the tree whose label (digital cartographic
+        model symbol) overplots the label of the target; they are deleted from the tree. """
+    def conflicts(target_v):
+        delete_list = list()
+        tree.generalization(target_v, point_set, delete_list, scale, h_spacing, v_spacing)
+        return delete_list
+    return conflicts
+
+
+def radius_conflicts(grid, point_set, radius_lookup):
+    """ Conflict predicate of radius-based generalization: the soundings of the grid within the radius of the target,
+        looked up by sounding id; they are deleted from the grid. """
+    def conflicts(target_v):
+        delete_list = list()
+        grid.radius_generalization(target_v, radius_lookup[target_v.sounding_id], point_set, delete_list)
+        return delete_list
+    return conflicts
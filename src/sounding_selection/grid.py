@@ -0,0 +1,124 @@
+import numpy as np
+from sounding_selection.tree import unique_points_mask
+from sounding_selection.metrics import metrics
+
+# Number of radius queries and of points they tested
+grid_counts = {'queries': 0, 'points_tested': 0}
+metrics.register('grid', grid_counts)
+
+
+class Grid(object):
+    """ Uniform grid (spatial hash) over the points of a point set, for radius queries no larger than the cell size.
+
+        Points are bucketed by the cell holding them and stored cell after cell, so a query gathers the points of the
+        3 x 3 cells around its center and tests their squared distance on coordinate arrays. Deleted points are
+        flagged, not removed. As in Tree, only the first of the points sharing coordinates is indexed. """
+    def __init__(self, cell_size):
+        self.__cell_size = float(cell_size)
+        self.__x = self.__y = self.__z = None
+        self.__min_x = self.__min_y = 0.0
+        self.__order = None
+        self.__cells = dict()  # Cell key -> (start, end) in order
+        self.__alive = None
+
+    def get_cell_size(self):
+        return self.__cell_size
+
+    def build_point_grid(self, point_set):
+        store, ids = point_set.get_store(), point_set.get_ids()
+        self.__x, self.__y, self.__z = store.x[ids], store.y[ids], store.z[ids]
+        self.__alive = unique_points_mask(self.__x, self.__y)
+        self.__cells = dict()
+        if len(ids) == 0:
+            self.__order = np.empty(0, dtype=np.int64)
+            return
+        self.__min_x, self.__min_y = float(self.__x.min()), float(self.__y.min())
+        keys = self.__cell_keys(self.__x, self.__y)
+        self.__order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[self.__order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], len(sorted_keys)]
+        self.__cells = dict(zip(sorted_keys[starts].tolist(), zip(starts.tolist(), ends.tolist())))
+
+    def __cell_keys(self, x, y):
+        """ Cell (column, row) of each point, packed in one integer. """
+        cols = np.floor((x - self.__min_x) / self.__cell_size).astype(np.int64)
+        rows = np.floor((y - self.__min_y) / self.__cell_size).astype(np.int64)
+        return (rows << 32) + cols
+
+    def delete(self, v_id):
+        self.__alive[v_id] = False
+
+    def radius_query(self, x, y, radius):
+        """ Returns the positions of the indexed points within radius of (x, y), boundary included. """
+        col = int(np.floor((x - self.__min_x) / self.__cell_size))
+        row = int(np.floor((y - self.__min_y) / self.__cell_size))
+        rings = max(int(np.ceil(radius / self.__cell_size)), 1)
+        spans = [self.__cells.get(((r << 32) + c)) for r in range(row - rings, row + rings + 1)
+                 for c in range(col - rings, col + rings + 1)]
+        spans = [span for span in spans if span is not None]
+        grid_counts['queries'] += 1
+        if len(spans) == 0:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.concatenate([self.__order[start:end] for start, end in spans])
+        candidates = candidates[self.__alive[candidates]]
+        grid_counts['points_tested'] += len(candidates)
+        dx, dy = self.__x[candidates] - x, self.__y[candidates] - y
+        return candidates[dx * dx + dy * dy <= radius * radius]
+
+    def radius_generalization(self, target_v, radius, point_set, delete_list):
+        """ Deletes the points within radius of target_v that are not shallower than it (z-value precision: '<=')
+            and appends them to delete_list; points sharing the target coordinates are kept. """
+        x, y, z = target_v.x_value, target_v.y_value, target_v.z_value
+        positions = self.radius_query(x, y, radius)
+        positions = positions[((self.__x[positions] != x) | (self.__y[positions] != y)) & (z <= self.__z[positions])]
+        for v_id in np.sort(positions):
+            self.delete(v_id)
+            delete_list.append(point_set.get_vertex(int(v_id)))
+
+
+def envelope_pairs(boxes, other_boxes, cell_size):
+    """ Returns the (i, j) pairs of boxes[i] and other_boxes[j] that intersect, boxes being (n, 4) arrays of [min_x,
+        min_y, max_x, max_y] rows (closed, so touching boxes intersect). Both sets are registered in the cells of a
+        uniform grid that they cover, and joined on the cell keys. """
+    if len(boxes) == 0 or len(other_boxes) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    min_x = min(boxes[:, 0].min(), other_boxes[:, 0].min())
+    min_y = min(boxes[:, 1].min(), other_boxes[:, 1].min())
+    keys, ids = _box_cells(boxes, min_x, min_y, cell_size)
+    other_keys, other_ids = _box_cells(other_boxes, min_x, min_y, cell_size)
+    order = np.argsort(other_keys, kind='stable')
+    other_keys, other_ids = other_keys[order], other_ids[order]
+
+    # Every box meets the other boxes registered in the same cells
+    starts = np.searchsorted(other_keys, keys, side='left')
+    counts = np.searchsorted(other_keys, keys, side='right') - starts
+    cell_keys = np.repeat(keys, counts)
+    i = np.repeat(ids, counts)
+    j = other_ids[np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())]
+
+    # Boxes sharing several cells are reported once, by the cell holding the lower left corner of their intersection
+    hits = (boxes[i, 0] <= other_boxes[j, 2]) & (other_boxes[j, 0] <= boxes[i, 2]) & \
+           (boxes[i, 1] <= other_boxes[j, 3]) & (other_boxes[j, 1] <= boxes[i, 3])
+    i, j, cell_keys = i[hits], j[hits], cell_keys[hits]
+    corners = np.column_stack((np.maximum(boxes[i, 0], other_boxes[j, 0]), np.maximum(boxes[i, 1], other_boxes[j, 1])))
+    cols, rows = _cells(corners[:, 0], corners[:, 1], min_x, min_y, cell_size)
+    first = (rows << 32) + cols == cell_keys
+    return i[first], j[first]
+
+
+def _cells(x, y, min_x, min_y, cell_size):
+    """ Column and row of the grid cell holding each point. """
+    return np.floor((x - min_x) / cell_size).astype(np.int64), np.floor((y - min_y) / cell_size).astype(np.int64)
+
+
+def _box_cells(boxes, min_x, min_y, cell_size):
+    """ Returns the keys of the grid cells covered by each box, and the box of each key. """
+    cols_0, rows_0 = _cells(boxes[:, 0], boxes[:, 1], min_x, min_y, cell_size)
+    cols_1, rows_1 = _cells(boxes[:, 2], boxes[:, 3], min_x, min_y, cell_size)
+    cols, rows = cols_1 - cols_0 + 1, rows_1 - rows_0 + 1
+    counts = cols * rows
+    ids = np.repeat(np.arange(len(boxes), dtype=np.int64), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    keys = ((rows_0[ids] + local // cols[ids]) << 32) + cols_0[ids] + local % cols[ids]
+    return keys, ids
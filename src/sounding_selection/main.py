@@ -1,44 +1,73 @@
-import shapefile
+import numpy as np
 from math import ceil
 from sounding_selection.utilities import *
 from sounding_selection.reader import Reader
 from sounding_selection.writer import Writer
 from sounding_selection.tree import Tree
+from sounding_selection.grid import Grid
+from sounding_selection.node import extract_fill_soundings
+from sounding_selection.constrained_tin import ConstrainedTIN
+from sounding_selection.contour_tree import ContourTree
+from sounding_selection.generalization import Generalization, dcm_conflicts, radius_conflicts
+from sounding_selection.sounding_store import SoundingStore, get_coordinates
+from sounding_selection.cache import StageCache
+from sounding_selection.features import FeatureStore
+from sounding_selection.registry import SoundingRegistry
+from sounding_selection import stages
 from sounding_selection.validation import *
-from sounding_selection.logger import log
-from shapely.geometry import shape, Polygon, Point
+from sounding_selection.logger import log, output_file_handler
+from sounding_selection.metrics import metrics, report_path
 
 
 def main():
 
     # Read input arguments
     source, scale, validation_method, existing_soundings, depth_areas, depth_contours, danger_points, starting_radius, \
-        ending_radius, horiz_spacing, vert_spacing = Reader.read_arguments()
+        ending_radius, horiz_spacing, vert_spacing, validation_workers, cache_dir, cache_size, cache_verify = \
+        Reader.read_arguments()
 
 ########################################################################################################################
 
     # Source bathymetry (ENC/input survey) surface model analysis
     log.info('-Generating Bathymetric Surface Model')
+    metrics.reset()
+    metrics.start_stage('surface_model')
+
+    # Columnar store shared by every sounding, contour, and boundary vertex of the run
+    store = SoundingStore()
+
+    # Stages independent of the scale, label spacing, and radius bounds are loaded from the cache when their inputs
+    # did not change
+    cache = StageCache(cache_dir, cache_size, cache_verify)
+    if cache.is_enabled():
+        log.info('\t--Using Stage Cache in ' + cache.get_dir())
 
     # Read input depth areas and extract boundary to constrain the triangulation of source and existing ENC soundings
     log.info('\t--Reading Bathymetric Extent and Depth Contours')
-    depth_polygons = shapefile.Reader(depth_areas)
-    contours = shapefile.Reader(depth_contours)
-    boundary_segment_vertices, boundary_idx_list, holes, bathy_extent, dredged_extent = get_feature_segments(contours, depth_polygons)
+    # ENC features are read once; every later use queries their geometries, attributes, and STRtrees
+    features = FeatureStore(depth_areas, depth_contours, danger_points)
+    depth_polygons = features.get_depth_areas()
+    contours = features.get_depth_contours()
+    # The boundary of the bathymetric extent is computed once, for the surface model and the selection triangulations
+    bathymetric_boundary = get_bathymetric_boundary(contours, depth_polygons)
+    boundary_segment_vertices, boundary_idx_list, holes, bathy_extent, dredged_extent, boundary_key = \
+        stages.feature_segments(cache, contours, depth_polygons, bathymetric_boundary, store=store)
 
     Writer.write_wkt_file('bathymetric_extent.txt', bathy_extent)
 
     # Read source sounding x,y,z file into vertex list
     log.info('\t--Reading Source Soundings File')
-    source_all = Reader.read_xyz_to_vertex_list(source)
-    source_soundings = [v for v in source_all if Point(v.x_value, v.y_value).intersects(bathy_extent) is True]
-    source_pointset = Reader.read_vertex_list_to_pointset(source_soundings)
+    # Soundings are clipped to the bathymetric extent chunk by chunk, before they are added to the store
+    source_soundings = stages.source_soundings(cache, source, bathy_extent, boundary_key, store)[0]
+    source_pointset = Reader.read_vertex_list_to_pointset(source_soundings, store)
     Writer.write_soundings_file('source_soundings', source_soundings)
 
     # Read chart sounding x,y,z file into vertex list and PR-Quadtree
     log.info('\t--Reading Chart Soundings File')
-    chart_soundings_pointset = Reader.read_xyz_to_pointset(existing_soundings)
-    chart_soundings = [v for v in chart_soundings_pointset.get_all_vertices() if Point(v.x_value, v.y_value).intersects(bathy_extent) is True]
+    chart_soundings_pointset = Reader.read_xyz_to_pointset(existing_soundings, store)
+    chart_ids = chart_soundings_pointset.get_ids()
+    chart_inside = points_in_polygon(bathy_extent, store.x[chart_ids], store.y[chart_ids])
+    chart_soundings = [v for v, inside in zip(chart_soundings_pointset.get_all_vertices(), chart_inside) if inside]
 
     log.info('\t\t--Building PR-Quadtree for Chart Soundings')
     chart_soundings_capacity = int(ceil(len(chart_soundings) * 0.004))
@@ -47,9 +76,15 @@ def main():
 
     # Read dangers to navigation point file into vertex list
     log.info('\t--Reading Dangers to Navigation File')
-    dangers_p = shapefile.Reader(danger_points)
-    dangers = Reader.read_dtons_to_vertex_list(dangers_p)
-    dangers_with_depth = [danger for danger in dangers if danger.z_value is not None and Point(danger.x_value, danger.y_value).intersects(bathy_extent) is True]
+    dangers = Reader.read_dtons_to_vertex_list(features.get_dangers(), store)
+    dangers_inside = points_in_polygon(bathy_extent, *get_coordinates(dangers).T)
+    dangers_with_depth = [danger for danger, inside in zip(dangers, dangers_inside)
+                          if danger.z_value is not None and inside]
+    # Roles of the soundings from now on are kept in the registry, by sounding id
+    registry = SoundingRegistry(store)
+    registry.add(source_soundings, 'source')
+    registry.add(chart_soundings, 'chart')
+    registry.add(dangers_with_depth, 'danger')
     for d in dangers:
         target_label = get_carto_symbol(d, scale)[1]
         Writer.write_wkt_file('DTON_DCM_WKT.txt', target_label.wkt)
@@ -57,31 +92,26 @@ def main():
     # Triangulate and build TIN tree
     log.info('\t--Triangulating Danger to Navigation Points, Source Soundings, and Existing ENC Soundings')
     source_chart_dangers = source_soundings + chart_soundings + dangers_with_depth
-    source_chart_dangers_boundary = source_chart_dangers + boundary_segment_vertices
-    source_chart_dangers_tri = triangulate(source_chart_dangers, boundary_segment_vertices, boundary_idx_list, holes)
-    source_chart_dangers_tin = Reader.read_triangulation(source_chart_dangers_tri, source_chart_dangers_boundary)
-
-    log.info('\t\t--Building TIN PR-Quadtree')
+    source_chart_dangers_tin = stages.surface_tin(cache, source_chart_dangers, boundary_segment_vertices,
+                                                  boundary_idx_list, holes, store)[0]
     source_chart_dangers_capacity = int(ceil(len(source_chart_dangers) * 0.004))
-    source_chart_dangers_tin_tree = Tree(source_chart_dangers_capacity)
-    source_chart_dangers_tin_tree.build_tin_tree(source_chart_dangers_tin)
 
     # Write output TIN
     log.info('\t\t--Writing Danger to Navigation Points, Source Soundings, and Existing ENC Sounding TIN File')
     Writer.write_tin_file(source_chart_dangers_tin, 'Bathymetric_Surface_Model_TIN')
 
     log.info('\t--Analyzing Characteristics of Bathymetric Surface Model')
+    metrics.start_stage('critical_points')
     # Identify shoal, supporting, and deep soundings (critical points) from input (source) bathymetry
     log.info('\t\t--Identifying Critical Points')
 
-    # Extract critical points of combined source and existing sounding triangulation
-    source_chart_dangers_tin_tree.crit_query(source_chart_dangers_tin_tree.get_root(), 0,
-                                             source_chart_dangers_tin.get_domain(), source_chart_dangers_tin)
+    # Extract critical points of combined source and existing sounding triangulation (through a TIN PR-Quadtree)
+    stages.critical_points(cache, source_chart_dangers_tin, source_chart_dangers_capacity)
 
     # Report counts of shoal, supporting, and deep soundings
-    source_surface_model_maxima = [v for v in source_chart_dangers if v.sounding_type is 'Maxima']
-    source_surface_model_saddle = [v for v in source_chart_dangers if v.sounding_type is 'Saddle']
-    source_surface_model_minima = [v for v in source_chart_dangers if v.sounding_type is 'Minima']
+    source_surface_model_maxima = [v for v in source_chart_dangers if v.sounding_type == 'Maxima']
+    source_surface_model_saddle = [v for v in source_chart_dangers if v.sounding_type == 'Saddle']
+    source_surface_model_minima = [v for v in source_chart_dangers if v.sounding_type == 'Minima']
     log.info('\t\t\t--Bathymetric Surface Model Maxima Count: ' + str(len(source_surface_model_maxima)))
     log.info('\t\t\t--Bathymetric Surface Model Saddle Count: ' + str(len(source_surface_model_saddle)))
     log.info('\t\t\t--Bathymetric Surface Model Minima Count: ' + str(len(source_surface_model_minima)))
@@ -96,6 +126,7 @@ def main():
 
     # Cartographic model analysis (hydrographic sounding selection)
     log.info('-Processing Hydrographic Sounding Selection')
+    metrics.start_stage('hydrographic_selection')
 
     # Initialize Tree class
     log.info('\t--Building PR-Quadtree for Source Soundings')
@@ -105,22 +136,16 @@ def main():
 
     # Remove legibility issues with danger to navigation points
     log.info('\t--Removing Legibility Violations with Danger to Navigation Points')
-    source_soundings.sort(key=lambda k: k.z_value)
-    while len(dangers) > 0:
-        legibility_violations = list()
-        source_tree.generalization(source_tree.get_root(), 0, source_pointset.get_domain(), dangers[0], source_pointset,
-                                   legibility_violations, 'DCM', scale, horiz_spacing, vert_spacing)
-
-        # Delete generalized soundings from sorted vertex list
-        for legibility_violation in legibility_violations:
-            delete_idx = modified_binary_search(source_soundings, legibility_violation)
-            del source_soundings[delete_idx]
-        del dangers[0]
+    source_generalization = Generalization(source_soundings)
+    danger_conflicts = dcm_conflicts(source_tree, source_pointset, scale, horiz_spacing, vert_spacing)
+    for danger in dangers:
+        source_generalization.suppress(danger_conflicts(danger))
+    source_soundings = source_generalization.get_alive()
 
     # Read combined source and chart soundings into point set; removes legibility issues near survey boundary
     log.info('\t--Combining Source and Chart Soundings')
     source_chart = source_soundings + chart_soundings
-    source_chart_pointset = Reader.read_vertex_list_to_pointset(source_chart)
+    source_chart_pointset = Reader.read_vertex_list_to_pointset(source_chart, store)
 
     # Initialize Tree class
     log.info('\t\t--Building PR-Quadtree')
@@ -128,12 +153,6 @@ def main():
     source_chart_tree = Tree(source_chart_capacity)
     source_chart_tree.build_point_tree(source_chart_pointset)
 
-    # Sort list of source/chart soundings from low to high
-    source_chart_sorted = sorted(source_chart, key=lambda k: k.z_value)
-
-    # list to store hydrographic selection
-    hydro_chart_soundings = list()
-
     log.info('\t--Selecting Label-Based Hydrographic Sounding Selection from Source and Chart Soundings')
     if horiz_spacing == 0.75:
         log.info('\t\t--Horizontal Character Spacing Set to Default 0.75 mm')
@@ -145,30 +164,22 @@ def main():
     else:
         log.info('\t\t--Vertical Character Spacing Set to {} mm'.format(vert_spacing))
 
-    # Label-based generalization
-    while len(source_chart_sorted) > 0:
-        delete_list = list()
-        source_chart_tree.generalization(source_chart_tree.get_root(), 0, source_chart_pointset.get_domain(),
-                                         source_chart_sorted[0], source_chart_pointset, delete_list, 'DCM',
-                                         scale, horiz_spacing, vert_spacing)
-
-        # Delete generalized soundings from sorted vertex list
-        for i in delete_list:
-            delete_idx = modified_binary_search(source_chart_sorted, i)  # Binary search increases performance
-            del source_chart_sorted[delete_idx]
-        hydro_chart_soundings.append(source_chart_sorted[0])
-        del source_chart_sorted[0]
+    # Label-based generalization of source/chart soundings from low to high
+    source_chart_generalization = Generalization(source_chart)
+    hydro_chart_soundings = source_chart_generalization.select(dcm_conflicts(source_chart_tree, source_chart_pointset,
+                                                                             scale, horiz_spacing, vert_spacing))
 
     # Remove chart soundings from hydrographic selection
-    hydro_soundings = [sounding for sounding in hydro_chart_soundings if sounding not in chart_soundings]
+    hydro_soundings = registry.exclude(hydro_chart_soundings, 'chart')
+    registry.add(hydro_soundings, 'hydro')
 
     log.info('\t\t--Hydrographic Sounding Selection Count: ' + str(len(hydro_soundings)))
 
     log.info('\t\t--Extracting Generalized ENC Soundings')
-    generalized_chart_soundings = [sounding for sounding in hydro_chart_soundings if sounding in chart_soundings]
+    generalized_chart_soundings = registry.select(hydro_chart_soundings, 'chart')
     Writer.write_soundings_file('generalized_chart', generalized_chart_soundings)
 
-    generalized_chart_pointset = Reader.read_vertex_list_to_pointset(generalized_chart_soundings)
+    generalized_chart_pointset = Reader.read_vertex_list_to_pointset(generalized_chart_soundings, store)
     generalized_chart = generalized_chart_pointset.get_all_vertices()
     for vertex in generalized_chart_soundings:
         target_label = get_carto_symbol(vertex, scale, horiz_spacing, vert_spacing)[1]
@@ -194,54 +205,44 @@ def main():
     # Cartographic model analysis (cartographic sounding selection)
     log.info('-Processing Cartographic Sounding Selection')
     log.info('\t--Selecting Least Depth Soundings')
+    metrics.start_stage('least_depths')
 
     log.info('\t\t--Building PR-Quadtree for Danger to Navigation Points, Source Soundings, and Existing ENC Soundings')
     source_chart_dangers_tree = Tree(source_chart_dangers_capacity)
-    source_chart_dangers_pointset = Reader.read_vertex_list_to_pointset(source_chart_dangers)
+    source_chart_dangers_pointset = Reader.read_vertex_list_to_pointset(source_chart_dangers, store)
     source_chart_dangers_tree.build_point_tree(source_chart_dangers_pointset)
 
-    # Select shallowest sounding inside each closed depth contour if no legibility violations with existing soundings
+    # Select shallowest sounding inside each closed depth contour if no legibility violations with existing soundings;
+    # the shallowest soundings of all the contours come from one pass over their containment tree
+    contour_tree = ContourTree(contours)
+    indexed_positions = source_chart_dangers_tree.get_indexed_vertices()
+    indexed_ids = source_chart_dangers_pointset.get_ids()[indexed_positions]
+    contour_least_depths = contour_tree.least_depths(store.x[indexed_ids], store.y[indexed_ids], store.z[indexed_ids])
     least_depths = list()
-    for shape_record in contours.iterShapeRecords(fields=['VALDCO']):
-        contour_geojson = shape_record.shape.__geo_interface__
-        contour_linestring = shape(contour_geojson)
-        contour_x, contour_y = contour_linestring.coords.xy
-        inside_contour_soundings = list()
-
-        # Proceed if contour is closed
-        if contour_x[0] == contour_x[-1] and contour_y[0] == contour_y[-1]:
-            contour_polygon = Polygon(contour_linestring)
-            source_chart_dangers_tree.points_in_polygon(source_chart_dangers_tree.get_root(), 0,
-                                                        source_chart_dangers_pointset.get_domain(), contour_polygon,
-                                                        source_chart_dangers_pointset, inside_contour_soundings)
-
-            # Shallowest maxima inside closed depth contour
-            if len(inside_contour_soundings) > 0:
-                inside_contour_soundings.sort(key=lambda k: k.z_value)
-                least_depth = inside_contour_soundings[0]
-
-                legibility_violations = check_vertex_legibility(least_depth, generalized_chart_tree,
-                                                                generalized_chart_pointset, scale, horiz_spacing,
-                                                                vert_spacing)
-
-                # Select least depth sounding if no legibility violation with ENC or shallower than ENC sounding
-                if len(legibility_violations) > 0:
-                    legibility_violations.sort(key=lambda k: k.z_value)
-                    if legibility_violations[0].z_value > least_depth.z_value:
-                        if least_depth not in least_depths:  # Nested contours can result in duplicates
-                            if least_depth.s57_type is None:
-                                least_depth.sounding_type = 'least_depth'
-                                least_depths.append(least_depth)
-                else:
-                    if least_depth not in least_depths:  # Nested contours can result in duplicates
-                        if least_depth.s57_type is None:
-                            least_depth.sounding_type = 'least_depth'
-                            least_depths.append(least_depth)
+    for least_depth_position in contour_least_depths:
+        if least_depth_position >= 0:
+            least_depth = source_chart_dangers_pointset.get_vertex(indexed_positions[least_depth_position])
+
+            legibility_violations = check_vertex_legibility(least_depth, generalized_chart_tree,
+                                                            generalized_chart_pointset, scale, horiz_spacing,
+                                                            vert_spacing)
+
+            # Select least depth sounding if no legibility violation with ENC or shallower than ENC sounding
+            if len(legibility_violations) > 0:
+                legibility_violations.sort(key=lambda k: k.z_value)
+                selected = legibility_violations[0].z_value > least_depth.z_value
+            else:
+                selected = True
+            # Nested contours can share their least depth
+            if selected and not registry.has(least_depth, 'least_depth') and least_depth.s57_type is None:
+                least_depth.sounding_type = 'least_depth'
+                least_depths.append(least_depth)
+                registry.add([least_depth], 'least_depth')
 
     # Evaluate legibility constraint for least depth soundings
     least_depth_capacity = int(ceil(len(least_depths) * 0.004))
     least_depth_tree = Tree(least_depth_capacity)
-    least_depth_pointset = Reader.read_vertex_list_to_pointset(least_depths)
+    least_depth_pointset = Reader.read_vertex_list_to_pointset(least_depths, store)
     least_depth_tree.build_point_tree(least_depth_pointset)
 
     least_depth_legibility_violations = validate_legibility_constraint(least_depths, least_depth_tree,
@@ -256,16 +257,17 @@ def main():
 
     # Select shoal, supporting, and deep soundings present in the hydrographic selection
     log.info('\t--Selecting Shoal, Supporting, and Deep Soundings')
-    hydro_shoal_soundings = [v for v in source_chart if v.sounding_type is 'Maxima' and v in hydro_soundings
-                             and v.sounding_type != 'least_depth']
+    metrics.start_stage('shoal_supporting_deep')
+    source_chart_hydro = registry.select(source_chart, 'hydro')
+    hydro_shoal_soundings = [v for v in source_chart_hydro if v.sounding_type == 'Maxima']
     for hydro_shoal in hydro_shoal_soundings:
         hydro_shoal.sounding_type = 'shoal'
 
-    hydro_supporting_soundings = [v for v in source_chart if v.sounding_type is 'Saddle' and v in hydro_soundings]
+    hydro_supporting_soundings = [v for v in source_chart_hydro if v.sounding_type == 'Saddle']
     for hydro_supporting in hydro_supporting_soundings:
         hydro_supporting.sounding_type = 'supporting'
 
-    hydro_deep_soundings = [v for v in source_chart if v.sounding_type is 'Minima' and v in hydro_soundings]
+    hydro_deep_soundings = [v for v in source_chart_hydro if v.sounding_type == 'Minima']
     for hydro_deep in hydro_deep_soundings:
         hydro_deep.sounding_type = 'deep'
 
@@ -279,11 +281,12 @@ def main():
 
         if len(legibility_violations) == 0:
             selection.append(critical_point)
+            registry.add([critical_point], critical_point.sounding_type)
 
     # Report counts
-    shoal_soundings = [v for v in selection if v in hydro_shoal_soundings]
-    supporting_soundings = [v for v in selection if v in hydro_supporting_soundings]
-    deep_soundings = [v for v in selection if v in hydro_deep_soundings]
+    shoal_soundings = registry.select(selection, 'shoal')
+    supporting_soundings = registry.select(selection, 'supporting')
+    deep_soundings = registry.select(selection, 'deep')
     log.info('\t\t\t--Shoal Sounding Count: ' + str(len(shoal_soundings)))
     log.info('\t\t\t--Supporting Sounding Count: ' + str(len(supporting_soundings)))
     log.info('\t\t\t--Deep Sounding Count: ' + str(len(deep_soundings)))
@@ -295,6 +298,7 @@ def main():
 
     # Select fill soundings using variable length radius-based method
     log.info('\t\t--Selecting Fill Soundings (Radius)')
+    metrics.start_stage('radius_fill')
 
     # Sort hydrographic selection from shallow to deep
     potential_radius_fill_sorted = sorted(hydro_soundings, key=lambda k: k.z_value)
@@ -306,32 +310,18 @@ def main():
 
     radius_dict = dict()
     for i in range(potential_radius_fill_count):
-        radius_dict[potential_radius_fill_sorted[i].__str__()] = radius_lengths[i]
-
-    # Radius-based generalization
-    potential_radius_fill_point_set = Reader.read_vertex_list_to_pointset(potential_radius_fill_sorted)
-    potential_radius_fill_capacity = int(ceil(potential_radius_fill_point_set.get_vertices_num() * 0.0004))
-    potential_radius_fill_tree = Tree(potential_radius_fill_capacity)
-    potential_radius_fill_tree.build_point_tree(potential_radius_fill_point_set)
-
-    radius_fill = list()
-    while len(potential_radius_fill_sorted) > 0:
-        delete_list = list()
-        potential_radius_fill_tree.generalization(potential_radius_fill_tree.get_root(), 0,
-                                                  potential_radius_fill_point_set.get_domain(),
-                                                  potential_radius_fill_sorted[0], potential_radius_fill_point_set,
-                                                  delete_list, 'Radius', radius_lookup=radius_dict)
-
-        # Delete generalized soundings from sorted vertex list
-        for delete in delete_list:
-            delete_idx = modified_binary_search(potential_radius_fill_sorted, delete)
-            if delete_idx is not None:  # Depth precision issue where radius increases but same depth
-                del potential_radius_fill_sorted[delete_idx]
-        radius_fill.append(potential_radius_fill_sorted[0])
-        del potential_radius_fill_sorted[0]
+        radius_dict[potential_radius_fill_sorted[i].sounding_id] = radius_lengths[i]
+
+    # Radius-based generalization; radii never exceed the ending radius, the grid cell size
+    potential_radius_fill_point_set = Reader.read_vertex_list_to_pointset(potential_radius_fill_sorted, store)
+    potential_radius_fill_grid = Grid(max(float(starting_radius), float(ending_radius)))
+    potential_radius_fill_grid.build_point_grid(potential_radius_fill_point_set)
+
+    radius_fill = Generalization(potential_radius_fill_sorted).select(
+        radius_conflicts(potential_radius_fill_grid, potential_radius_fill_point_set, radius_dict))
 
     least_depth_shoal_supporting_deep = least_depths + shoal_soundings + supporting_soundings + deep_soundings
-    radius_fill_soundings = [fill for fill in radius_fill if fill not in least_depth_shoal_supporting_deep]
+    radius_fill_soundings = registry.exclude(radius_fill, 'least_depth', 'shoal', 'supporting', 'deep')
 
     # Select fill soundings that do not overplot with least depth soundings
     for radius_fill in radius_fill_soundings:
@@ -340,75 +330,65 @@ def main():
         if len(legibility_violations) == 0:
             radius_fill.sounding_type = 'fill_radius'
             selection.append(radius_fill)
+            registry.add([radius_fill], 'fill_radius')
 
     # Report count of fill soundings (radius)
     radius_fill_count = len(selection) - len(least_depth_shoal_supporting_deep)
     log.info('\t\t--Fill Soundings (Radius) Count: ' + str(radius_fill_count))
 
     # Extract edges for constraining the triangulation
-    all_segment_vertices, all_idx_list, holes, bathy_extent, dredged_extent = get_feature_segments(contours,
-                                                                                                   depth_polygons,
-                                                                                                   boundary=False)
+    all_segment_vertices, all_idx_list, holes, bathy_extent, dredged_extent = \
+        stages.feature_segments(cache, contours, depth_polygons, bathymetric_boundary, boundary=False,
+                                store=store)[:5]
 
     # Triangulate shoal, supporting, deep, radius-fill, existing ENC soundings, and depth contours
+    metrics.start_stage('catzoc_fill')
     log.info('\t\t\t--Triangulating Current Selection, Generalized ENC Soundings, Danger to Navigation Points,'
              ' and Depth Contours')
+    # The TIN is updated in place from now on; only the triangles of each update are re-evaluated
     selection_chart_dangers = selection + generalized_chart + dangers_with_depth
-    selection_chart_dangers_contour = selection_chart_dangers + all_segment_vertices
-    selection_chart_dangers_contour_tri = triangulate(selection_chart_dangers, all_segment_vertices, all_idx_list,
-                                                      holes)
-    selection_chart_dangers_contour_tin = Reader.read_triangulation(selection_chart_dangers_contour_tri,
-                                                                    selection_chart_dangers_contour)
-    selection_chart_dangers_contour_capacity = int(ceil(len(selection_chart_dangers) * 0.004))
-    selection_chart_dangers_contour_tree = Tree(selection_chart_dangers_contour_capacity)
-    selection_chart_dangers_contour_tree.build_tin_tree(selection_chart_dangers_contour_tin)
+    selection_chart_dangers_contour_ctin = ConstrainedTIN(selection_chart_dangers, all_segment_vertices, all_idx_list,
+                                                          holes, store)
+    selection_chart_dangers_contour_tin = selection_chart_dangers_contour_ctin.get_tin()
 
     log.info('\t\t\t--Selecting Fill Soundings (CATZOC)')
-    hydro_point_set = Reader.read_vertex_list_to_pointset(hydro_soundings)
+    hydro_point_set = Reader.read_vertex_list_to_pointset(hydro_soundings, store)
     hydro_capacity = int(ceil(hydro_point_set.get_vertices_num() * 0.0004))
     hydro_tree = Tree(hydro_capacity)
     hydro_tree.build_point_tree(hydro_point_set)
 
     catzoc_fill_soundings = list()
-    selection_chart_dangers_contour_tree.calculate_fill_soundings(selection_chart_dangers_contour_tree.get_root(), 0,
-                                                                  selection_chart_dangers_contour_tin.get_domain(),
-                                                                  hydro_tree, hydro_point_set,
-                                                                  selection_chart_dangers_contour_tin,
-                                                                  catzoc_fill_soundings)
+    extract_fill_soundings(selection_chart_dangers_contour_tin,
+                           np.arange(selection_chart_dangers_contour_tin.get_triangles_num()), hydro_point_set,
+                           hydro_tree, catzoc_fill_soundings)
 
     # Select soundings that do not have legibility issues with least depth soundings
-    catzoc_fill_legibility_violations = list()
+    catzoc_fill_legibility_violations = set()
     if len(catzoc_fill_soundings) > 0:
         while len(catzoc_fill_soundings) > 0:
             for catzoc_fill in catzoc_fill_soundings:
-                if catzoc_fill not in catzoc_fill_legibility_violations:
+                if catzoc_fill.sounding_id not in catzoc_fill_legibility_violations:
                     legibility_violations = check_vertex_legibility(catzoc_fill, least_depth_tree,
                                                                     least_depth_pointset, scale, horiz_spacing,
                                                                     vert_spacing)
                     if len(legibility_violations) == 0:
                         catzoc_fill.sounding_type = 'fill_catzoc'
                         selection.append(catzoc_fill)
+                        registry.add([catzoc_fill], 'fill_catzoc')
                     else:
-                        catzoc_fill_legibility_violations.append(catzoc_fill)
+                        catzoc_fill_legibility_violations.add(catzoc_fill.sounding_id)
 
             selection_chart_dangers = selection + generalized_chart + dangers_with_depth
-            selection_chart_dangers_contour = selection_chart_dangers + all_segment_vertices
-            selection_chart_dangers_contour_tri = triangulate(selection_chart_dangers, all_segment_vertices,
-                                                              all_idx_list, holes)
-
-            selection_chart_dangers_contour_tin = Reader.read_triangulation(selection_chart_dangers_contour_tri,
-                                                                            selection_chart_dangers_contour)
-            selection_chart_dangers_contour_tree = Tree(selection_chart_dangers_contour_capacity)
-            selection_chart_dangers_contour_tree.build_tin_tree(selection_chart_dangers_contour_tin)
+            changed_triangles = selection_chart_dangers_contour_ctin.set_soundings(selection_chart_dangers)
+            selection_chart_dangers_contour_tin = selection_chart_dangers_contour_ctin.get_tin()
 
+            # Unchanged triangles would only yield their legibility violations again
             fill_soundings = list()
-            selection_chart_dangers_contour_tree.calculate_fill_soundings(selection_chart_dangers_contour_tree.get_root(), 0,
-                                                                          selection_chart_dangers_contour_tin.get_domain(),
-                                                                          hydro_tree,  hydro_point_set,
-                                                                          selection_chart_dangers_contour_tin,
-                                                                          fill_soundings)
+            extract_fill_soundings(selection_chart_dangers_contour_tin, changed_triangles, hydro_point_set, hydro_tree,
+                                   fill_soundings)
 
-            catzoc_fill_soundings = [f for f in fill_soundings if f not in catzoc_fill_legibility_violations]
+            catzoc_fill_soundings = [fill for fill in fill_soundings
+                                     if fill.sounding_id not in catzoc_fill_legibility_violations]
 
     # Report fill (CATZOC) sounding count
     non_catzoc_count = len(least_depth_shoal_supporting_deep) + radius_fill_count
@@ -420,49 +400,39 @@ def main():
 
     # Evaluate functionality constraint for non-adjusted soundings
     log.info('\t--Adjusting Cartographic Selection for Legibility and Functionality Violations')
+    metrics.start_stage('adjustment')
 
     log.info('\t\t--Adjusting Cartographic Selection for Legibility Violations with Sounding Labels and Depth Contours')
     # Select fill soundings that do not overplot with depth contours or least depth soundings
-    contour_overplot = list()
-    for sounding in selection:
-        if sounding not in least_depths:
-            label_no_spacing = get_carto_symbol(sounding, scale, 0, 0)[1]
-            for shape_record in contours.iterShapeRecords(fields=['VALDCO']):
-                contour_depth = shape_record.record[0]
-                if sounding.z_value >= contour_depth:
-                    contour_geojson = shape_record.shape.__geo_interface__
-                    contour_linestring = shape(contour_geojson)
-                    if label_no_spacing.intersects(contour_linestring):
-                        contour_overplot.append(sounding)
-                        break
-
-    for overplot_sounding in contour_overplot:
-        selection.remove(overplot_sounding)
-
-    outside_range = list()
-    for shape_record in depth_polygons.iterShapeRecords(fields=['DRVAL2']):
-        drval2 = shape_record.record[0]
-        depare_geojson = shape_record.shape.__geo_interface__
-        depare_polygon = shape(depare_geojson)
-        for sounding in selection:
-            if sounding.z_value > drval2:
-                if depare_polygon.intersects(Point(sounding.x_value, sounding.y_value)):
-                    outside_range.append(sounding)
-
-    for i in outside_range:
-        selection.remove(i)
+    overplot_candidates = ~registry.mask(selection, 'least_depth')
+    overplot = np.zeros(len(selection), dtype=bool)
+    overplot[overplot_candidates] = get_contour_overplots(registry.exclude(selection, 'least_depth'), contours, scale)
+    selection = [sounding for sounding, flag in zip(selection, overplot) if not flag]
+
+    # Remove soundings deeper than the maximum depth of a depth area they fall in
+    selection_xyz = get_coordinates(selection, with_z=True)
+    sounding_ids, area_ids = point_polygon_pairs(depth_polygons.get_geometries(), selection_xyz[:, 0],
+                                                 selection_xyz[:, 1])
+    outside_range = np.zeros(len(selection), dtype=bool)
+    drval2 = depth_polygons.get_attribute('DRVAL2')
+    outside_range[sounding_ids[selection_xyz[sounding_ids, 2] > drval2[area_ids]]] = True
+    selection = [sounding for sounding, outside in zip(selection, outside_range) if not outside]
 
     log.info('\t--Evaluating Cartographic Constraint Violations for Preliminary Selection')
+    # The validation workers are started once, for all the validations of the adjustment
+    validation_pool = ValidationPool(validation_workers, depth_polygons)
 
     selection_chart_dangers_contour_funct_viol = validate_functionality_constraint(selection_chart_dangers_contour_tin,
                                                                                    source_chart_dangers_tree,
                                                                                    source_chart_dangers_pointset,
-                                                                                   depth_polygons, validation_method)
+                                                                                   depth_polygons, validation_method,
+                                                                                   validation_pool)
 
-    # Evaluate legibility constraint for currently selected soundings
+    # Evaluate legibility constraint for currently selected soundings; the selection tree follows the selection from
+    # now on through insertions and deletions
     selection_capacity = int(ceil(len(selection) * 0.004))
     selection_tree = Tree(selection_capacity)
-    selection_pointset = Reader.read_vertex_list_to_pointset(selection)
+    selection_pointset = Reader.read_vertex_list_to_pointset(selection, store)
     selection_tree.build_point_tree(selection_pointset)
 
     selection_legibility_violations = validate_legibility_constraint(selection, selection_tree, selection_pointset,
@@ -485,64 +455,58 @@ def main():
         functionality_violations_sorted = sorted(selection_chart_dangers_contour_funct_viol, key=lambda k: k.z_value)
         iteration_count = 0
         functionality_violation_count = list()
+        selection_conflicts = dcm_conflicts(selection_tree, selection_pointset, scale, horiz_spacing, vert_spacing)
         while len(functionality_violations_sorted) > 0:
-            selection.sort(key=lambda k: k.z_value)
+            selection_generalization = Generalization(selection)
             functionality_violations = functionality_violations_sorted[:]
             # Label-based generalization
-            while len(functionality_violations_sorted) > 0:
-                legibility_violations = list()
-                selection_tree.generalization(selection_tree.get_root(), 0, selection_pointset.get_domain(),
-                                              functionality_violations_sorted[0], selection_pointset,
-                                              legibility_violations, 'DCM', scale, horiz_spacing, vert_spacing)
-
-                # Delete generalized soundings from sorted vertex list
-                for legibility_violation in legibility_violations:
-                    if legibility_violation not in least_depths:
-                        delete_idx = modified_binary_search(selection, legibility_violation)
-                        del selection[delete_idx]
-                del functionality_violations_sorted[0]
+            generalized_least_depths = list()
+            for functionality_violation in functionality_violations:
+                legibility_violations = selection_conflicts(functionality_violation)
+                generalized_least_depths.extend(v for v in legibility_violations if registry.has(v, 'least_depth'))
+                selection_generalization.suppress(registry.exclude(legibility_violations, 'least_depth'))
+            selection = selection_generalization.get_alive()
 
-            for violation in functionality_violations:
-                selection_tree = Tree(selection_capacity)
-                selection_pointset = Reader.read_vertex_list_to_pointset(selection)
-                selection_tree.build_point_tree(selection_pointset)
+            # Least depths stay selected: index them again
+            for least_depth in generalized_least_depths:
+                selection_tree.insert_vertex(least_depth, selection_pointset)
 
+            for violation in functionality_violations:
                 legibility_violations = check_vertex_legibility(violation, selection_tree, selection_pointset, scale,
                                                                 horiz_spacing, vert_spacing)
 
                 if len(legibility_violations) == 0:
                     violation.sounding_type = 'adjustment'
                     selection.append(violation)
+                    registry.add([violation], 'adjustment')
+                    selection_tree.insert_vertex(violation, selection_pointset)
                 else:
                     if iteration_count >= 3 and functionality_violation_count[-1] == functionality_violation_count[-2]:
                         violation.sounding_type = 'adjustment'
                         selection.append(violation)
+                        registry.add([violation], 'adjustment')
+                        selection_tree.insert_vertex(violation, selection_pointset)
                         break
                     elif iteration_count >= 5:
                         violation.sounding_type = 'adjustment'
                         selection.append(violation)
+                        registry.add([violation], 'adjustment')
+                        selection_tree.insert_vertex(violation, selection_pointset)
                         break
             selection_chart_dangers = selection + generalized_chart + dangers_with_depth
-            selection_chart_dangers_contour = selection_chart_dangers + all_segment_vertices
-            selection_chart_dangers_contour_tri = triangulate(selection_chart_dangers, all_segment_vertices,
-                                                              all_idx_list, holes)
-            selection_chart_dangers_contour_tin = Reader.read_triangulation(selection_chart_dangers_contour_tri,
-                                                                            selection_chart_dangers_contour)
+            selection_chart_dangers_contour_ctin.set_soundings(selection_chart_dangers)
+            selection_chart_dangers_contour_tin = selection_chart_dangers_contour_ctin.get_tin()
 
             selection_chart_dangers_contour_funct_viol = validate_functionality_constraint(selection_chart_dangers_contour_tin,
                                                                                            source_chart_dangers_tree,
                                                                                            source_chart_dangers_pointset,
                                                                                            depth_polygons,
-                                                                                           validation_method)
+                                                                                           validation_method,
+                                                                                           validation_pool)
 
             functionality_violations_sorted = sorted(selection_chart_dangers_contour_funct_viol, key=lambda k: k.z_value)
             functionality_violation_count.append(len(functionality_violations_sorted))
 
-            selection_capacity = int(ceil(len(selection) * 0.004))
-            selection_tree = Tree(selection_capacity)
-            selection_pointset = Reader.read_vertex_list_to_pointset(selection)
-            selection_tree.build_point_tree(selection_pointset)
-
             selection_legibility_violations = validate_legibility_constraint(selection, selection_tree,
                                                                              selection_pointset, scale, horiz_spacing,
                                                                              vert_spacing)
@@ -553,42 +517,37 @@ def main():
             log.info('\t\t--Legibility Violations: ' + str(len(selection_legibility_violations)))
 
         # Evaluate legibility constraint for adjusted sounding set
-        selection_capacity = int(ceil(len(selection) * 0.004))
-        selection_tree = Tree(selection_capacity)
-        selection_pointset = Reader.read_vertex_list_to_pointset(selection)
-        selection_tree.build_point_tree(selection_pointset)
-
         selection_legibility_violations = validate_legibility_constraint(selection, selection_tree, selection_pointset,
                                                                          scale, horiz_spacing, vert_spacing)
 
         selection_chart_dangers = selection + generalized_chart + dangers_with_depth
-        selection_chart_dangers_contour = selection_chart_dangers + all_segment_vertices
-        selection_chart_dangers_contour_tri = triangulate(selection_chart_dangers, all_segment_vertices,
-                                                          all_idx_list, holes)
-        selection_chart_dangers_contour_tin = Reader.read_triangulation(selection_chart_dangers_contour_tri,
-                                                                        selection_chart_dangers_contour)
+        selection_chart_dangers_contour_ctin.set_soundings(selection_chart_dangers)
+        selection_chart_dangers_contour_tin = selection_chart_dangers_contour_ctin.get_tin()
 
         selection_chart_dangers_contour_funct_viol_tri = validate_functionality_constraint(selection_chart_dangers_contour_tin,
                                                                                        source_chart_dangers_tree,
                                                                                        source_chart_dangers_pointset,
                                                                                        depth_polygons,
-                                                                                       validation_method)
+                                                                                       validation_method,
+                                                                                       validation_pool)
 
         selection_chart_dangers_contour_funct_viol_surf = validate_functionality_constraint(selection_chart_dangers_contour_tin,
                                                                                        source_chart_dangers_tree,
                                                                                        source_chart_dangers_pointset,
                                                                                        depth_polygons,
-                                                                                       'SURFACE')
+                                                                                       'SURFACE', validation_pool)
 
         log.info('\t\t--Final Triangle Functionality Violations: ' + str(len(selection_chart_dangers_contour_funct_viol_tri)))
         log.info('\t\t--Final Shallow Surface Functionality Violations: ' + str(len(selection_chart_dangers_contour_funct_viol_surf)))
         log.info('\t\t--Final Legibility Violations: ' + str(len(selection_legibility_violations)))
         log.info('\t\t--Final Cartographic Selection Count: ' + str(len(selection)))
+    validation_pool.close()
 
 ########################################################################################################################
 
     # Write output files
     log.info('\t--Writing Cartograhic Output Files')
+    metrics.start_stage('output')
     if len(selection_legibility_violations) > 0:
         Writer.write_soundings_file('Cartographic_Selection_Legibility_Violations', selection_legibility_violations)
     if len(selection_chart_dangers_contour_funct_viol) > 0:  # Should always be zero
@@ -596,21 +555,20 @@ def main():
                                     selection_chart_dangers_contour_funct_viol)
 
     carto_out_name = str(source).split('.')[0] + '_CartoSelect'
-    carto_selection = [sounding for sounding in selection if sounding not in dangers_with_depth]
+    carto_selection = registry.exclude(selection, 'danger')
     Writer.write_soundings_file(carto_out_name, carto_selection)
     for vertex in carto_selection:
         target_label = get_carto_symbol(vertex, scale, horiz_spacing, vert_spacing)[1]
         Writer.write_wkt_file(carto_out_name + '_DCM_WKT.txt', target_label.wkt)
 
     selection_chart_dangers = selection + generalized_chart + dangers_with_depth
-    selection_chart_dangers_contour = selection_chart_dangers + all_segment_vertices
-    selection_chart_dangers_contour_tri = triangulate(selection_chart_dangers, all_segment_vertices,
-                                                      all_idx_list, holes)
-    selection_chart_dangers_contour_tin = Reader.read_triangulation(selection_chart_dangers_contour_tri,
-                                                                    selection_chart_dangers_contour)
+    selection_chart_dangers_contour_ctin.set_soundings(selection_chart_dangers)
+    selection_chart_dangers_contour_tin = selection_chart_dangers_contour_ctin.get_tin()
 
     Writer.write_tin_file(selection_chart_dangers_contour_tin, carto_out_name + 'Selection_TIN')
 
+    metrics.end_stage()
+    metrics.write_report(report_path(output_file_handler))
     return
 
 
@@ -0,0 +1,74 @@
+import json
+import os
+import time
+
+
+class Metrics(object):
+    """ Per-stage wall/CPU time and work counters of a run. Counters are running totals, either incremented through
+        count() or kept by other modules in registered dicts (cheap to update on hot paths); a stage records how much
+        every counter grew while it was the current stage. """
+
+    def __init__(self):
+        self.__counters = dict()
+        self.__sources = dict()
+        self.__stages = list()
+        self.__current = None
+
+    def register(self, name, source):
+        """ Registers a dict of counters, or a function returning one, reported with the name as prefix. """
+        self.__sources[name] = source
+
+    def count(self, name, value=1):
+        self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def get_counters(self):
+        counters = dict(self.__counters)
+        for prefix, source in self.__sources.items():
+            values = source() if callable(source) else source
+            for name, value in values.items():
+                counters[prefix + '_' + name] = value
+        return counters
+
+    def start_stage(self, name):
+        """ Ends the current stage, if any, and starts a new one. """
+        self.end_stage()
+        self.__current = {'name': name, 'wall': time.perf_counter(), 'cpu': time.process_time(),
+                          'counters': self.get_counters()}
+
+    def end_stage(self):
+        if self.__current is None:
+            return
+        counters = self.get_counters()
+        start = self.__current['counters']
+        self.__stages.append({'stage': self.__current['name'],
+                              'wall_time_s': time.perf_counter() - self.__current['wall'],
+                              'cpu_time_s': time.process_time() - self.__current['cpu'],
+                              'counters': {name: value - start.get(name, 0) for name, value in counters.items()
+                                           if value - start.get(name, 0) != 0}})
+        self.__current = None
+
+    def get_stages(self):
+        return self.__stages
+
+    def get_report(self):
+        return {'stages': self.__stages,
+                'wall_time_s': sum(stage['wall_time_s'] for stage in self.__stages),
+                'cpu_time_s': sum(stage['cpu_time_s'] for stage in self.__stages),
+                'counters': self.get_counters()}
+
+    def write_report(self, file_name):
+        with open(file_name, 'w') as outfile:
+            json.dump(self.get_report(), outfile, indent=2)
+
+    def reset(self):
+        self.__counters = dict()
+        self.__stages = list()
+        self.__current = None
+
+
+metrics = Metrics()
+
+
+def report_path(log_handler):
+    """ The metrics report is written next to the log file of the given handler. """
+    return os.path.join(os.path.dirname(log_handler.baseFilename), 'sounding_selection_metrics.json')
@@ -1,5 +1,7 @@
 class Point(object):
     """ Creates Class Point. """
+    __slots__ = ('__coords',)
+
     def __init__(self, x=0, y=0):
         """ Defines x and y Variables. """
         self.__coords = [x, y]
@@ -38,7 +40,7 @@ class Point(object):
         return len(self.__coords)
 
     def __eq__(self, other):
-        return self.__coords[0] == other.__coords[0] and self.__coords[1] == other.__coords[1]
+        return self.x_value == other.x_value and self.y_value == other.y_value
 
     def __ne__(self, other):
         return not self == other
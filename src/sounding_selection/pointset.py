@@ -1,29 +1,68 @@
+import numpy as np
+from sounding_selection.point import Point
 from sounding_selection.domain import Domain
+from sounding_selection.sounding_store import SoundingStore, VertexView
 
 
 class PointSet(object):
+    """ Ordered set of soundings of a SoundingStore; position i of the set holds sounding id get_ids()[i]. """
 
-    def __init__(self):
-        self.__vertices = []
+    def __init__(self, store=None, ids=None):
+        self.__store = SoundingStore() if store is None else store
+        # Growable array of sounding ids: the first __size entries are the vertices
+        self.__ids = np.empty(0, dtype=np.int64) if ids is None else np.array(ids, dtype=np.int64).reshape(-1)
+        self.__size = len(self.__ids)
+        self.__positions = None  # Sounding id -> first position, built on the first get_position
         self.__domain = Domain()
 
+    def get_store(self):
+        return self.__store
+
     def get_vertex(self, pos):
         try:
-            return self.__vertices[pos]
+            return self.__store.get_vertex(self.get_ids()[pos])
         except IndexError as e:
             raise e
 
     def get_vertices_num(self):
-        return len(self.__vertices)
+        return self.__size
 
     def get_all_vertices(self):
-        return self.__vertices
+        return self.__store.get_vertices(self.get_ids())
+
+    def get_ids(self):
+        # A view of the ids, valid until the next add_vertex
+        return self.__ids[:self.__size]
 
     def get_domain(self):
         return self.__domain
 
     def add_vertex(self, v):
-        self.__vertices.append(v)
+        if self.__size == len(self.__ids):
+            grown = np.empty(max(2 * self.__size, 16), dtype=np.int64)
+            grown[:self.__size] = self.__ids
+            self.__ids = grown
+        self.__ids[self.__size] = self.__store.add_vertex(v)
+        if self.__positions is not None:
+            self.__positions.setdefault(int(self.__ids[self.__size]), self.__size)
+        self.__size += 1
+
+    def get_position(self, v):
+        """ Returns the (first) position of the set holding the store sounding viewed by v, or None. """
+        if not isinstance(v, VertexView) or v.get_store() is not self.__store:
+            return None
+        if self.__positions is None:
+            self.__positions = dict()
+            for pos, s_id in enumerate(self.get_ids().tolist()):
+                self.__positions.setdefault(s_id, pos)
+        return self.__positions.get(v.sounding_id)
 
     def set_domain(self, min_p, max_p):
         self.__domain = Domain(min_p, max_p)
+
+    def compute_domain(self):
+        """ Sets the domain to the bounding box of the point set. """
+        if self.__size > 0:
+            ids = self.get_ids()
+            x, y = self.__store.x[ids], self.__store.y[ids]
+            self.set_domain(Point(float(x.min()), float(y.min())), Point(float(x.max()), float(y.max())))
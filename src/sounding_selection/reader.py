@@ -1,15 +1,20 @@
 import sys
 import getopt
-import csv
+import itertools
+import numpy as np
 import shapely
 from shapely import wkt
 from shapely.ops import unary_union
-from shapely.geometry import Polygon, MultiPolygon, shape
-from sounding_selection.vertex import Vertex
+from shapely.geometry import Polygon, MultiPolygon
+from sounding_selection.sounding_store import SoundingStore, VertexView
 from sounding_selection.pointset import PointSet
 from sounding_selection.tin import TIN
-from sounding_selection.triangles import Triangle
 from sounding_selection.logger import log
+from sounding_selection.metrics import metrics
+from sounding_selection.cache import DEFAULT_CACHE_SIZE_MB
+
+# Rows of an X,Y,Z,C file parsed at a time
+XYZ_CHUNK_SIZE = 500000
 
 
 class Reader(object):
@@ -27,19 +32,25 @@ class Reader(object):
         ending_radius = None
         horiz_spacing = 0.75
         vert_spacing = 0.75
+        workers = 1
+        cache_dir = None
+        cache_size = DEFAULT_CACHE_SIZE_MB
+        cache_verify = False
 
         try:
-            options, remainder = getopt.getopt(sys.argv[1:], "hi:r:v:c:a:d:n:s:e:x:y:")
+            options, remainder = getopt.getopt(sys.argv[1:], "hi:r:v:c:a:d:n:s:e:x:y:w:k:m:t")
         except getopt.GetoptError:
             print(sys.argv[0], ' -i <inputfile> -r <scale> -v <validation> -c <chart_soundings> -a <depth_areas>'
                                ' -d <depth_contours> -n <dangers_to_navigation> -s <starting_radius_length>'
-                               ' -e <ending_radius_length> -x <horizontal_spacing> -y <vertical_spacing>')
+                               ' -e <ending_radius_length> -x <horizontal_spacing> -y <vertical_spacing>'
+                               ' -w <validation_workers> -k <cache_directory> -m <cache_size_mb> -t')
             sys.exit(2)
         for opt, arg in options:
             if opt == '-h':
                 print(sys.argv[0], ' -i <inputfile> -r <scale> -v <validation> -c <chart_soundings> -a <depth_areas>'
                                    ' -d <depth_contours> -s <starting_radius_length> -e <ending_radius_length>'
-                                   ' -x <horizontal_spacing> -y <vertical_spacing>')
+                                   ' -x <horizontal_spacing> -y <vertical_spacing> -w <validation_workers>'
+                                   ' -k <cache_directory> -m <cache_size_mb> -t')
                 sys.exit()
             elif opt in "-i":
                 input_file = str(arg)
@@ -63,6 +74,14 @@ class Reader(object):
                 horiz_spacing = float(arg)
             elif opt in "-y":
                 vert_spacing = float(arg)
+            elif opt in "-w":
+                workers = int(arg)
+            elif opt in "-k":
+                cache_dir = str(arg)
+            elif opt in "-m":
+                cache_size = float(arg)
+            elif opt in "-t":
+                cache_verify = True
 
         if input_file is None:
             log.critical('Source Sounding File Not Provided')
@@ -97,73 +116,90 @@ class Reader(object):
         if validation is not None and validation not in ['TRIANGLE', 'SURFACE']:
             log.critical('Provide Valid Functionality Constraint Validation Method: TRIANGLE or SURFACE')
             sys.exit()
+        if workers < 1:
+            log.critical('Provide Valid Number of Validation Workers: 1 or More')
+            sys.exit()
+        if cache_dir is None and cache_verify:
+            log.warning('Cache Verification Requested Without a Cache Directory')
+        if cache_size <= 0:
+            log.critical('Provide Valid Cache Size: More Than 0 MB')
+            sys.exit()
 
         return input_file, scale, validation, enc_soundings, depth_areas, depth_contours, dangers, starting_radius, \
-            ending_radius, horiz_spacing, vert_spacing
+            ending_radius, horiz_spacing, vert_spacing, workers, cache_dir, cache_size, cache_verify
 
     @staticmethod
-    def read_xyz_to_pointset(url_in):
-        with open(url_in) as infile:
-            point_set = PointSet()
-            reader = csv.reader(infile, delimiter=',')
-            for index, value in enumerate(reader):
-                if float(value[2]) < 0:
-                    v = Vertex(x=float(value[0]), y=float(value[1]), z=abs(float(value[2])), catzoc=float(value[3]))
-                    point_set.add_vertex(v)
-                    if index == 0:
-                        point_set.set_domain(v, v)
-                    else:
-                        point_set.get_domain().resize(v)
-        infile.close()
+    def read_xyz_to_pointset(url_in, store=None):
+        if store is None:
+            store = SoundingStore()
+        ids = [store.add_soundings(x, y, z, catzoc) for x, y, z, catzoc in Reader.read_xyz_chunks(url_in)]
+        point_set = PointSet(store, np.concatenate(ids) if len(ids) > 0 else None)
+        point_set.compute_domain()
         return point_set
 
     @staticmethod
-    def read_vertex_list_to_pointset(vertex_list):
-        point_set = PointSet()
-        for index, vertex in enumerate(vertex_list):
+    def read_vertex_list_to_pointset(vertex_list, store=None):
+        if store is None and len(vertex_list) > 0 and isinstance(vertex_list[0], VertexView):
+            store = vertex_list[0].get_store()
+        point_set = PointSet(store)
+        for vertex in vertex_list:
             point_set.add_vertex(vertex)
-            if index == 0:
-                point_set.set_domain(vertex, vertex)
-            else:
-                point_set.get_domain().resize(vertex)
+        point_set.compute_domain()
         return point_set
 
     @staticmethod
-    def read_xyz_to_vertex_list(url_in):
+    def read_xyz_to_vertex_list(url_in, store=None):
+        if store is None:
+            store = SoundingStore()
         vertex_list = list()
-        with open(url_in) as infile:
-            reader = csv.reader(infile, delimiter=',')
-            for point in reader:
-                if float(point[2]) < 0:
-                    v = Vertex(x=float(point[0]), y=float(point[1]), z=abs(float(point[2])), catzoc=float(point[3]))
-                    vertex_list.append(v)
-        infile.close()
+        for x, y, z, catzoc in Reader.read_xyz_chunks(url_in):
+            vertex_list.extend(store.get_vertices(store.add_soundings(x, y, z, catzoc)))
         return vertex_list
 
     @staticmethod
-    def read_dtons_to_vertex_list(dangers_p):
+    def read_xyz_chunks(url_in, chunk_size=XYZ_CHUNK_SIZE):
+        """ Streams an X,Y,Z,C text file as (x, y, z, catzoc) arrays of up to chunk_size rows each. Only soundings
+            below the datum (negative z) are kept, with depths made positive. """
+        with open(url_in) as infile:
+            while True:
+                lines = list(itertools.islice(infile, chunk_size))
+                if len(lines) == 0:
+                    break
+                rows = np.loadtxt(lines, delimiter=',', usecols=(0, 1, 2, 3), ndmin=2)
+                rows = rows[rows[:, 2] < 0]
+                metrics.count('xyz_rows_read', len(lines))
+                if len(rows) > 0:
+                    yield rows[:, 0], rows[:, 1], np.abs(rows[:, 2]), rows[:, 3]
+
+    @staticmethod
+    def read_dtons_to_vertex_list(dangers, store=None):
+        """ Returns the obstructions, underwater rocks, and wrecks of a dangers to navigation FeatureLayer (None if no
+            layer was provided) as vertices. """
+        if store is None:
+            store = SoundingStore()
         vertex_list = list()
-        for shape_record in dangers_p.iterShapeRecords(fields=['VALSOU', 'WATLEV', 'FCSUBTYPE', 'CATWRK']):
-            s57_subtype = shape_record.record[2]
+        if dangers is None:
+            return vertex_list
+        columns = [dangers.get_attribute(field).tolist() for field in ['VALSOU', 'WATLEV', 'FCSUBTYPE', 'CATWRK']]
+        for danger_point, valsou, watlev, s57_subtype, catwrk in zip(dangers.get_geometries(), *columns):
             if s57_subtype == 35 or s57_subtype == 20 or s57_subtype == 45:
-                danger_geojson = shape_record.shape.__geo_interface__
-                danger_point = shape(danger_geojson)
                 x, y = danger_point.x, danger_point.y
 
-                if shape_record.record[0] == -32767:  # Null value
+                if valsou == -32767:  # Null value
                     z = None
-                elif shape_record.record[0] < 0:
+                elif valsou < 0:
                     z = 0.0
                 else:
-                    z = float(shape_record.record[0])
+                    z = float(valsou)
 
                 if s57_subtype == 35 or s57_subtype == 20:
-                    s57_condtn = shape_record.record[1]
+                    s57_condtn = watlev
                 else:
-                    s57_condtn = shape_record.record[3]
+                    s57_condtn = catwrk
 
-                v = Vertex(x=float(x), y=float(y), z=z, s57_type=float(s57_subtype), s57_condition=float(s57_condtn))
-                vertex_list.append(v)
+                s_id = store.add_sounding(x=float(x), y=float(y), z=z, s57_type=float(s57_subtype),
+                                          s57_condition=float(s57_condtn))
+                vertex_list.append(store.get_vertex(s_id))
 
         return vertex_list
 
@@ -187,29 +223,37 @@ class Reader(object):
         return poly
 
     @staticmethod
-    def read_triangulation(triangulation, vertex_list):
-        vertices = triangulation['vertices']
-        triangles = triangulation['triangles']
-
-        v_list = vertex_list[:]
-        xy_list = [[float(v.x_value), float(v.y_value)] for v in v_list]
+    def read_triangulation(triangulation, vertex_list, store=None):
+        """ Builds a TIN from the output of utilities.triangulate. Each output vertex is mapped back to the first
+            vertex of vertex_list with the same coordinates; output vertices matching no input vertex (Steiner points)
+            are added to the store without a depth. """
+        vertices = np.asarray(triangulation['vertices'], dtype=np.float64).reshape(-1, 2)
+        triangles = triangulation.get('triangles', np.empty((0, 3), dtype=np.int32))
 
-        tin = TIN()
-        for i, v in enumerate(vertices):
-            index = xy_list.index([float(v[0]), float(v[1])])
-            sounding_vertex = v_list[index]
+        if store is None and len(vertex_list) > 0 and isinstance(vertex_list[0], VertexView):
+            store = vertex_list[0].get_store()
+        if store is None:
+            store = SoundingStore()
+        input_ids = store.add_vertices(vertex_list)
+        input_xy = np.column_stack((store.x[input_ids], store.y[input_ids]))
 
-            del xy_list[index]
-            del v_list[index]
-
-            tin.add_vertex(sounding_vertex)
-            if i == 0:
-                tin.set_domain(sounding_vertex, sounding_vertex)
-            else:
-                tin.get_domain().resize(sounding_vertex)
-
-        for tri in triangles:
-            t = Triangle(int(tri[0]), int(tri[1]), int(tri[2]))
-            tin.add_triangle(t)
+        if len(vertices) <= len(input_xy) and np.array_equal(vertices, input_xy[:len(vertices)]):
+            # Output vertices follow the input ordering
+            ids = input_ids[:len(vertices)]
+        else:
+            # Coordinate lookup: group equal coordinate pairs and take the first input vertex of each group
+            _, groups = np.unique(np.concatenate((input_xy, vertices)), axis=0, return_inverse=True)
+            groups = groups.ravel()
+            input_groups, first = np.unique(groups[:len(input_xy)], return_index=True)
+            first_input = np.full(len(groups), -1, dtype=np.int64)
+            first_input[input_groups] = input_ids[first]
+            ids = first_input[groups[len(input_xy):]]
+            for i in np.flatnonzero(ids < 0):
+                log.warning('Triangulation Vertex Not in Input: {}, {}'.format(vertices[i, 0], vertices[i, 1]))
+                ids[i] = store.add_sounding(x=float(vertices[i, 0]), y=float(vertices[i, 1]), z=None)
 
+        tin = TIN(store, ids, triangles)
+        tin.compute_domain()
+        metrics.count('tin_vertices', tin.get_vertices_num())
+        metrics.count('tin_triangles', tin.get_triangles_num())
         return tin
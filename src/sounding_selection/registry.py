@@ -0,0 +1,60 @@
+import numpy as np
+
+# Roles of a sounding in a run (bit = position in tuple)
+ROLES = ('source', 'chart', 'danger', 'hydro', 'least_depth', 'shoal', 'supporting', 'deep', 'fill_radius',
+         'fill_catzoc', 'adjustment')
+ROLE_BITS = {role: 1 << bit for bit, role in enumerate(ROLES)}
+
+
+class SoundingRegistry(object):
+    """ Roles of the soundings of a SoundingStore, kept as one bitmask per sounding addressed by its (stable) store id.
+        Testing whether a sounding plays a role is O(1) and filtering a list of soundings by role is one vectorized
+        pass, where list membership tests scanned the role lists. Soundings added to the store later have no role. """
+
+    def __init__(self, store):
+        self.__store = store
+        self.__roles = np.zeros(store.get_soundings_num(), dtype=np.uint16)
+
+    def __reserve(self):
+        missing = self.__store.get_soundings_num() - len(self.__roles)
+        if missing > 0:
+            self.__roles = np.concatenate((self.__roles, np.zeros(missing, dtype=np.uint16)))
+
+    def add(self, vertices, role):
+        self.__reserve()
+        self.__roles[get_ids(vertices)] |= ROLE_BITS[role]
+
+    def discard(self, vertices, role):
+        self.__reserve()
+        self.__roles[get_ids(vertices)] &= ~np.uint16(ROLE_BITS[role])
+
+    def clear(self, role):
+        self.__roles &= ~np.uint16(ROLE_BITS[role])
+
+    def has(self, v, *roles):
+        """ Returns True if the sounding plays any of the roles. """
+        return v.sounding_id < len(self.__roles) and bool(self.__roles[v.sounding_id] & role_mask(roles))
+
+    def mask(self, vertices, *roles):
+        """ Flags the vertices playing any of the roles. """
+        self.__reserve()
+        return (self.__roles[get_ids(vertices)] & role_mask(roles)) != 0
+
+    def select(self, vertices, *roles):
+        """ Returns the vertices playing any of the roles, in order. """
+        return [v for v, flag in zip(vertices, self.mask(vertices, *roles)) if flag]
+
+    def exclude(self, vertices, *roles):
+        """ Returns the vertices playing none of the roles, in order. """
+        return [v for v, flag in zip(vertices, self.mask(vertices, *roles)) if not flag]
+
+
+def role_mask(roles):
+    mask = 0
+    for role in roles:
+        mask |= ROLE_BITS[role]
+    return mask
+
+
+def get_ids(vertices):
+    return np.fromiter((v.sounding_id for v in vertices), dtype=np.int64, count=len(vertices))
@@ -0,0 +1,231 @@
+import numpy as np
+from sounding_selection.vertex import Vertex
+
+# Sounding type legend (encoded value = position in tuple):
+#   None = 0, Maxima = 1, Saddle = 2, Minima = 3, least_depth = 4, shoal = 5, supporting = 6, deep = 7,
+#   fill_radius = 8, fill_catzoc = 9, adjustment = 10
+SOUNDING_TYPES = (None, 'Maxima', 'Saddle', 'Minima', 'least_depth', 'shoal', 'supporting', 'deep', 'fill_radius',
+                  'fill_catzoc', 'adjustment')
+SOUNDING_TYPE_CODES = {s_type: code for code, s_type in enumerate(SOUNDING_TYPES)}
+
+
+class SoundingStore(object):
+    """ Columnar store of sounding attributes. Each sounding is addressed by a stable integer id (its row); missing
+        z/catzoc/s57 values are encoded as NaN. """
+
+    def __init__(self, capacity=1024):
+        capacity = max(int(capacity), 1)
+        self.__size = 0
+        self.__x = np.empty(capacity, dtype=np.float64)
+        self.__y = np.empty(capacity, dtype=np.float64)
+        self.__z = np.empty(capacity, dtype=np.float64)
+        self.__catzoc = np.empty(capacity, dtype=np.float64)
+        self.__s57_type = np.empty(capacity, dtype=np.float64)
+        self.__s57_condition = np.empty(capacity, dtype=np.float64)
+        self.__sounding_type = np.empty(capacity, dtype=np.int8)
+
+    def __reserve(self, count):
+        required = self.__size + count
+        capacity = len(self.__x)
+        if required <= capacity:
+            return
+        while capacity < required:
+            capacity *= 2
+        for name in ('x', 'y', 'z', 'catzoc', 's57_type', 's57_condition', 'sounding_type'):
+            attribute = '_SoundingStore__' + name
+            column = getattr(self, attribute)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.__size] = column[:self.__size]
+            setattr(self, attribute, grown)
+
+    def add_sounding(self, x, y, z, catzoc=None, s57_type=None, s57_condition=None, sounding_type=None):
+        self.__reserve(1)
+        s_id = self.__size
+        self.__x[s_id] = x
+        self.__y[s_id] = y
+        self.__z[s_id] = np.nan if z is None else z
+        self.__catzoc[s_id] = np.nan if catzoc is None else catzoc
+        self.__s57_type[s_id] = np.nan if s57_type is None else s57_type
+        self.__s57_condition[s_id] = np.nan if s57_condition is None else s57_condition
+        self.__sounding_type[s_id] = SOUNDING_TYPE_CODES[sounding_type]
+        self.__size += 1
+        return s_id
+
+    def add_soundings(self, x, y, z, catzoc=None, s57_type=None, s57_condition=None):
+        """ Appends columns of soundings and returns the array of their ids. """
+        count = len(x)
+        self.__reserve(count)
+        start, end = self.__size, self.__size + count
+        self.__x[start:end] = x
+        self.__y[start:end] = y
+        self.__z[start:end] = z
+        self.__catzoc[start:end] = np.nan if catzoc is None else catzoc
+        self.__s57_type[start:end] = np.nan if s57_type is None else s57_type
+        self.__s57_condition[start:end] = np.nan if s57_condition is None else s57_condition
+        self.__sounding_type[start:end] = 0
+        self.__size = end
+        return np.arange(start, end, dtype=np.int64)
+
+    def add_vertex(self, v):
+        """ Copies a standalone Vertex into the store and returns its id. """
+        if isinstance(v, VertexView) and v.get_store() is self:
+            return v.sounding_id
+        return self.add_sounding(v.x_value, v.y_value, v.z_value, v.catzoc_value, v.s57_type, v.s57_condition,
+                                 v.sounding_type)
+
+    def add_vertices(self, vertices):
+        """ Returns the ids of a list of vertices; only vertices that are not views of this store are copied. """
+        return np.fromiter((self.add_vertex(v) for v in vertices), dtype=np.int64, count=len(vertices))
+
+    def get_soundings_num(self):
+        return self.__size
+
+    def get_vertex(self, s_id):
+        return VertexView(self, int(s_id))
+
+    def get_vertices(self, s_ids):
+        return [VertexView(self, int(s_id)) for s_id in s_ids]
+
+    # Column accessors return views limited to the stored soundings; writes go through to the store. A view is only
+    # valid until the next add, which may reallocate the columns.
+    @property
+    def x(self):
+        return self.__x[:self.__size]
+
+    @property
+    def y(self):
+        return self.__y[:self.__size]
+
+    @property
+    def z(self):
+        return self.__z[:self.__size]
+
+    @property
+    def catzoc(self):
+        return self.__catzoc[:self.__size]
+
+    @property
+    def s57_type(self):
+        return self.__s57_type[:self.__size]
+
+    @property
+    def s57_condition(self):
+        return self.__s57_condition[:self.__size]
+
+    @property
+    def sounding_type(self):
+        return self.__sounding_type[:self.__size]
+
+
+def get_coordinates(vertices, with_z=False):
+    """ Returns the (n, 2) array of x, y coordinates (n, 3 with the depths, NaN if missing) of a list of vertices,
+        gathered from the store columns when they are all views of the same store. """
+    if len(vertices) > 0 and isinstance(vertices[0], VertexView):
+        store = vertices[0].get_store()
+        if all(isinstance(v, VertexView) and v.get_store() is store for v in vertices):
+            ids = np.fromiter((v.sounding_id for v in vertices), dtype=np.int64, count=len(vertices))
+            if with_z:
+                return np.column_stack((store.x[ids], store.y[ids], store.z[ids]))
+            return np.column_stack((store.x[ids], store.y[ids]))
+    if with_z:
+        return np.array([[v.x_value, v.y_value, np.nan if v.z_value is None else v.z_value] for v in vertices],
+                        dtype=np.float64).reshape(-1, 3)
+    return np.array([[v.x_value, v.y_value] for v in vertices], dtype=np.float64).reshape(-1, 2)
+
+
+def _to_value(value):
+    return None if value != value else float(value)  # NaN encodes a missing value
+
+
+class VertexView(Vertex):
+    """ Thin Vertex view of one sounding in a SoundingStore; reads and writes go through to the store columns. """
+    __slots__ = ('__store', '__id')
+
+    def __init__(self, store, s_id):
+        self.__store = store
+        self.__id = s_id
+
+    @property
+    def sounding_id(self):
+        return self.__id
+
+    def get_store(self):
+        return self.__store
+
+    @property
+    def x_value(self):
+        return float(self.__store.x[self.__id])
+
+    @x_value.setter
+    def x_value(self, x):
+        self.__store.x[self.__id] = x
+
+    @property
+    def y_value(self):
+        return float(self.__store.y[self.__id])
+
+    @y_value.setter
+    def y_value(self, y):
+        self.__store.y[self.__id] = y
+
+    @property
+    def z_value(self):
+        return _to_value(self.__store.z[self.__id])
+
+    @z_value.setter
+    def z_value(self, z):
+        self.__store.z[self.__id] = np.nan if z is None else z
+
+    @property
+    def s57_type(self):
+        return _to_value(self.__store.s57_type[self.__id])
+
+    @s57_type.setter
+    def s57_type(self, feature):
+        self.__store.s57_type[self.__id] = np.nan if feature is None else feature
+
+    @property
+    def s57_condition(self):
+        return _to_value(self.__store.s57_condition[self.__id])
+
+    @s57_condition.setter
+    def s57_condition(self, condition):
+        self.__store.s57_condition[self.__id] = np.nan if condition is None else condition
+
+    @property
+    def catzoc_value(self):
+        return _to_value(self.__store.catzoc[self.__id])
+
+    @catzoc_value.setter
+    def catzoc_value(self, catzoc):
+        self.__store.catzoc[self.__id] = np.nan if catzoc is None else catzoc
+
+    @property
+    def sounding_type(self):
+        return SOUNDING_TYPES[self.__store.sounding_type[self.__id]]
+
+    @sounding_type.setter
+    def sounding_type(self, s_type):
+        self.__store.sounding_type[self.__id] = SOUNDING_TYPE_CODES[s_type]
+
+    def get_c(self, pos):
+        if pos == 0:
+            return self.x_value
+        elif pos == 1:
+            return self.y_value
+        # Same positional layout as Vertex.get_c
+        return (self.z_value, self.s57_type, self.s57_condition, self.catzoc_value, self.sounding_type)[pos]
+
+    def set_c(self, pos, c):
+        if pos == 0:
+            self.x_value = c
+        elif pos == 1:
+            self.y_value = c
+        else:
+            raise IndexError('Store-backed vertices have a fixed set of fields')
+
+    def get_coordinates_num(self):
+        return 2
+
+    def get_fields_num(self):
+        return 5
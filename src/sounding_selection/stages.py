@@ -0,0 +1,100 @@
+""" Pipeline stages whose outputs do not depend on the scale, the label spacing, or the radius bounds, computed through
+    a StageCache: each stage turns its output into arrays, and rebuilds the objects main() works with from arrays,
+    whether they were computed or loaded. """
+import numpy as np
+from shapely import wkb
+from sounding_selection.reader import Reader
+from sounding_selection.sounding_store import SoundingStore, get_coordinates
+from sounding_selection.tin import TIN
+from sounding_selection.tree import Tree
+from sounding_selection.utilities import get_feature_segments, points_in_polygon, triangulate
+from sounding_selection.writer import Writer
+
+
+def feature_segments(cache, depth_contours, depth_areas, bathymetric_boundary, boundary=True, store=None):
+    """ Cached get_feature_segments of the contours and the bathymetric boundary of the depth areas (FeatureLayer
+        objects, keyed by their shapefiles); also returns the stage key. """
+    key = cache.key('feature_segments', depth_contours.get_path(), depth_areas.get_path(), boundary)
+
+    def compute():
+        segment_vertices, index_list, holes, bathy_extent, dredged_extent = \
+            get_feature_segments(depth_contours, bathymetric_boundary, boundary, store=SoundingStore())
+        return {'segment_vertices': get_coordinates(segment_vertices, with_z=True),
+                'index_list': np.asarray(index_list, dtype=np.int64).reshape(-1, 2),
+                'holes': np.asarray(holes, dtype=np.float64).reshape(-1, 2),
+                'bathymetric_extent': np.frombuffer(bathy_extent.wkb, dtype=np.uint8),
+                'dredged_extent': np.frombuffer(dredged_extent.wkb, dtype=np.uint8)}
+
+    arrays = cache.run('feature_segments', key, compute)
+    store = SoundingStore() if store is None else store
+    xyz = arrays['segment_vertices']
+    segment_vertices = store.get_vertices(store.add_soundings(xyz[:, 0], xyz[:, 1], xyz[:, 2]))
+    # Written here only, whether the segments were computed or loaded
+    Writer.write_soundings_file('boundary_points', segment_vertices)
+    return segment_vertices, arrays['index_list'].tolist(), arrays['holes'].tolist(), \
+        wkb.loads(arrays['bathymetric_extent'].tobytes()), wkb.loads(arrays['dredged_extent'].tobytes()), key
+
+
+def source_soundings(cache, source, bathy_extent, extent_key, store):
+    """ Reads the source soundings inside the bathymetric extent (given by the key of the stage it comes from) into the
+        store; returns them with the stage key. """
+    key = cache.key('source_soundings', source, extent_key)
+
+    def compute():
+        # Soundings are clipped to the bathymetric extent chunk by chunk
+        chunks = [np.empty((0, 4))]
+        for x, y, z, catzoc in Reader.read_xyz_chunks(source):
+            inside = points_in_polygon(bathy_extent, x, y)
+            chunks.append(np.column_stack((x, y, z, catzoc))[inside])
+        return {'soundings': np.concatenate(chunks)}
+
+    soundings = cache.run('source_soundings', key, compute)['soundings']
+    ids = store.add_soundings(soundings[:, 0], soundings[:, 1], soundings[:, 2], soundings[:, 3])
+    return store.get_vertices(ids), key
+
+
+def surface_tin(cache, sounding_vertices, segment_vertices, index_list, holes, store):
+    """ Constrained triangulation of the soundings and segments, as Reader.read_triangulation builds it; the key is
+        the content of the triangulation input. """
+    vertex_list = sounding_vertices + segment_vertices
+    key = cache.key('surface_tin', get_coordinates(vertex_list), np.asarray(index_list, dtype=np.int64),
+                    np.asarray(holes, dtype=np.float64), len(sounding_vertices))
+    input_ids = store.add_vertices(vertex_list)
+
+    def compute():
+        triangulation = triangulate(sounding_vertices, segment_vertices, index_list, holes)
+        tin = Reader.read_triangulation(triangulation, vertex_list, store)
+        # Output vertices as positions in vertex_list, -1 for Steiner points (added to the store, without a depth)
+        ids = tin.get_ids()
+        unique_ids, first = np.unique(input_ids, return_index=True)
+        positions = np.full(store.get_soundings_num(), -1, dtype=np.int64)
+        positions[unique_ids] = first
+        positions = positions[ids]
+        steiner = positions < 0
+        return {'triangles': tin.get_triangles(), 'positions': positions,
+                'steiner_points': np.column_stack((store.x[ids[steiner]], store.y[ids[steiner]]))}
+
+    arrays = cache.run('surface_tin', key, compute)
+    positions, steiner_points = arrays['positions'], arrays['steiner_points']
+    ids = input_ids[np.maximum(positions, 0)]
+    for pos, (x, y) in zip(np.flatnonzero(positions < 0), steiner_points):
+        ids[pos] = store.add_sounding(x=float(x), y=float(y), z=None)
+    tin = TIN(store, ids, arrays['triangles'])
+    tin.compute_domain()
+    return tin, key
+
+
+def critical_points(cache, tin, capacity):
+    """ Classifies the critical points of the TIN (see Tree.crit_query), writing their sounding types to the store;
+        the key is the content of the TIN. """
+    store, ids = tin.get_store(), tin.get_ids()
+    key = cache.key('critical_points', np.column_stack((store.x[ids], store.y[ids], store.z[ids])),
+                    tin.get_triangles())
+
+    def compute():
+        tin_tree = Tree(capacity)
+        tin_tree.build_tin_tree(tin)
+        tin_tree.crit_query(tin)
+        return {'sounding_types': store.sounding_type[ids].copy()}
+
+    store.sounding_type[ids] = cache.run('critical_points', key, compute)['sounding_types']
@@ -1,27 +1,48 @@
+import numpy as np
+from sounding_selection.point import Point
 from sounding_selection.domain import Domain
+from sounding_selection.sounding_store import SoundingStore
+from sounding_selection.triangles import Triangle
+from sounding_selection.topology import Topology
+from shapely.geometry import Polygon
+from shapely.geometry import Point as Shapely_Point
+from sounding_selection.metrics import metrics
 
 
 class TIN(object):
-    """Creates Class TIN"""
-    def __init__(self):
-        self.__vertices = []
-        self.__triangles = []
+    """ TIN over soundings of a SoundingStore; position i holds sounding id get_ids()[i] and triangles are rows of an
+        int32 array of vertex positions. """
+    def __init__(self, store=None, ids=None, triangles=None):
+        self.__store = SoundingStore() if store is None else store
+        # Growable array of sounding ids: the first __size entries are the vertices
+        self.__ids = np.empty(0, dtype=np.int64) if ids is None else np.array(ids, dtype=np.int64).reshape(-1)
+        self.__size = len(self.__ids)
+        self.__triangles = np.empty((0, 3), dtype=np.int32) if triangles is None else \
+            np.asarray(triangles, dtype=np.int32).reshape(-1, 3)
         self.__domain = Domain()
+        self.__topology = None
+
+    def get_store(self):
+        return self.__store
 
     def get_vertex(self, pos):
         try:
-            return self.__vertices[pos]
+            return self.__store.get_vertex(self.get_ids()[pos])
         except IndexError as e:
             raise e
 
     def get_vertices_num(self):
-        return len(self.__vertices)
+        return self.__size
 
     def get_triangle(self, pos):
         try:
-            return self.__triangles[pos]
+            t = self.__triangles[pos]
         except IndexError as e:
             raise e
+        return Triangle(int(t[0]), int(t[1]), int(t[2]))
+
+    def get_triangles(self):
+        return self.__triangles
 
     def get_triangles_num(self):
         return len(self.__triangles)
@@ -30,13 +51,119 @@ class TIN(object):
         return self.__domain
 
     def add_vertex(self, v):
-        self.__vertices.append(v)
+        if self.__size == len(self.__ids):
+            grown = np.empty(max(2 * self.__size, 16), dtype=np.int64)
+            grown[:self.__size] = self.__ids
+            self.__ids = grown
+        self.__ids[self.__size] = self.__store.add_vertex(v)
+        self.__size += 1
 
     def get_vertices(self):
-        return self.__vertices
+        return self.__store.get_vertices(self.get_ids())
+
+    def get_ids(self):
+        # A view of the ids, valid until the next add_vertex
+        return self.__ids[:self.__size]
 
     def add_triangle(self, t):
-        self.__triangles.append(t)
+        self.__triangles = np.vstack((self.__triangles, [[t.get_tv(0), t.get_tv(1), t.get_tv(2)]])).astype(np.int32)
+        self.__topology = None
+
+    def get_topology(self):
+        """ Returns the VT, VV and TT relations of the TIN, built on first use. """
+        if self.__topology is None:
+            self.__topology = Topology(self.__triangles, self.__size)
+        return self.__topology
+
+    def set_topology(self, topology):
+        self.__topology = topology
 
     def set_domain(self, min_p, max_p):
         self.__domain = Domain(min_p, max_p)
+
+    def compute_domain(self):
+        """ Sets the domain to the bounding box of the TIN vertices. """
+        if self.__size > 0:
+            ids = self.get_ids()
+            x, y = self.__store.x[ids], self.__store.y[ids]
+            self.set_domain(Point(float(x.min()), float(y.min())), Point(float(x.max()), float(y.max())))
+
+    def locate_points(self, x, y, chunk_size=4096):
+        """ Assigns points to the triangles containing them, boundary included, through a uniform grid bucketing the
+            points. Returns a CSR table: the points of triangle t are point_index[offsets[t]:offsets[t + 1]], in
+            increasing index order; a point on an edge or vertex belongs to every triangle sharing it. """
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        triangles_num = len(self.__triangles)
+        if len(x) == 0 or triangles_num == 0:
+            return np.zeros(triangles_num + 1, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        # Grid of about one point per cell over the points bounding box
+        min_x, min_y, max_x, max_y = x.min(), y.min(), x.max(), y.max()
+        width, height = max(max_x - min_x, 1e-12), max(max_y - min_y, 1e-12)
+        cell_size = max(np.sqrt(width * height / len(x)), max(width, height) / 4096.0)
+        cols, rows = int(width // cell_size) + 1, int(height // cell_size) + 1
+        point_cells = (((y - min_y) // cell_size).astype(np.int64) * cols + ((x - min_x) // cell_size).astype(np.int64))
+        by_cell = np.argsort(point_cells, kind='stable')
+        cell_start = np.searchsorted(point_cells[by_cell], np.arange(cols * rows + 1))
+
+        ids = self.get_ids()[self.__triangles]
+        tri_x, tri_y = self.__store.x[ids], self.__store.y[ids]
+        tri_points, point_index = list(), list()
+        for start in range(0, triangles_num, chunk_size):
+            t_x, t_y = tri_x[start:start + chunk_size], tri_y[start:start + chunk_size]
+            # Cells covered by the bounding box of each triangle, clipped to the grid
+            c0 = np.clip(((t_x.min(axis=1) - min_x) // cell_size).astype(np.int64), 0, cols - 1)
+            c1 = np.clip(((t_x.max(axis=1) - min_x) // cell_size).astype(np.int64), 0, cols - 1)
+            r0 = np.clip(((t_y.min(axis=1) - min_y) // cell_size).astype(np.int64), 0, rows - 1)
+            r1 = np.clip(((t_y.max(axis=1) - min_y) // cell_size).astype(np.int64), 0, rows - 1)
+            outside = (t_x.max(axis=1) < min_x) | (t_x.min(axis=1) > max_x) | \
+                      (t_y.max(axis=1) < min_y) | (t_y.min(axis=1) > max_y)
+            cells_num = np.where(outside, 0, (c1 - c0 + 1) * (r1 - r0 + 1))
+            pair_tri = np.repeat(np.arange(len(t_x)), cells_num)
+            rank = np.arange(len(pair_tri)) - np.repeat(np.cumsum(cells_num) - cells_num, cells_num)
+            width_cells = (c1 - c0 + 1)[pair_tri]
+            cell = (r0[pair_tri] + rank // width_cells) * cols + c0[pair_tri] + rank % width_cells
+
+            # Candidate (triangle, point) pairs from the points of each covered cell
+            counts = cell_start[cell + 1] - cell_start[cell]
+            cand_tri = np.repeat(pair_tri, counts)
+            rank = np.arange(len(cand_tri)) - np.repeat(np.cumsum(counts) - counts, counts)
+            cand_point = by_cell[np.repeat(cell_start[cell], counts) + rank]
+
+            inside = _in_triangles(t_x[cand_tri], t_y[cand_tri], x[cand_point], y[cand_point])
+            tri_points.append(cand_tri[inside] + start)
+            point_index.append(cand_point[inside])
+
+        tri_points, point_index = np.concatenate(tri_points), np.concatenate(point_index)
+        order = np.lexsort((point_index, tri_points))
+        offsets = np.zeros(triangles_num + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(tri_points, minlength=triangles_num))
+        return offsets, point_index[order]
+
+
+def _orientation(ax, ay, bx, by, px, py):
+    """ Orientation of p with respect to the directed line a -> b and its floating point error bound (Shewchuk,
+        1997). """
+    det_left, det_right = (ax - px) * (by - py), (ay - py) * (bx - px)
+    return det_left - det_right, 1e-15 * (np.abs(det_left) + np.abs(det_right))
+
+
+def _in_triangles(t_x, t_y, x, y):
+    """ Tests each point against its (n, 3) triangle, boundary included; points whose orientation with respect to an
+        edge is within the floating point error, and degenerate triangles, fall back to an exact Shapely test. """
+    area, area_error = _orientation(t_x[:, 0], t_y[:, 0], t_x[:, 1], t_y[:, 1], t_x[:, 2], t_y[:, 2])
+    sign = np.sign(area)
+    inside = np.ones(len(x), dtype=bool)
+    uncertain = np.abs(area) <= area_error
+    for i, j in ((0, 1), (1, 2), (2, 0)):
+        o, error = _orientation(t_x[:, i], t_y[:, i], t_x[:, j], t_y[:, j], x, y)
+        o = o * sign
+        inside &= o >= -error
+        uncertain |= (np.abs(o) <= error) & (error > 0)  # both products are exactly 0 when error is 0
+    exact_tests = np.flatnonzero(uncertain & (inside | (sign == 0)))
+    metrics.count('point_location_tests', len(x))
+    metrics.count('point_location_exact_tests', len(exact_tests))
+    for k in exact_tests:
+        triangle = Polygon(list(zip(t_x[k], t_y[k])))
+        inside[k] = triangle.intersects(Shapely_Point(x[k], y[k]))
+    return inside
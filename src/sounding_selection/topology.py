@@ -0,0 +1,151 @@
+import numpy as np
+from sounding_selection.sounding_store import SOUNDING_TYPE_CODES
+from sounding_selection.metrics import metrics
+
+
+class Topology(object):
+    """ Topological relations of a triangle mesh, built once from its (T, 3) array of vertex positions in O(T log T).
+
+        Vertex-triangle (VT) and vertex-vertex (VV) relations are compressed sparse rows: the triangles of vertex v are
+        vt_ids[vt_offsets[v]:vt_offsets[v + 1]], in increasing order, and likewise its adjacent vertices. Triangle
+        adjacency (TT) is a (T, 3) array of the triangle across the edge opposite each vertex, -1 on the boundary.
+        Each relation is computed on first use. """
+    def __init__(self, triangles, vertices_num=None, neighbors=None):
+        self.__triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+        if vertices_num is None:
+            vertices_num = int(self.__triangles.max()) + 1 if len(self.__triangles) > 0 else 0
+        self.__vertices_num = vertices_num
+        self.__vt = self.__vv = None
+        self.__neighbors = neighbors
+
+    def get_vertices_num(self):
+        return self.__vertices_num
+
+    def get_triangles_num(self):
+        return len(self.__triangles)
+
+    def get_vt(self):
+        """ Returns the (offsets, triangle ids) CSR arrays of the VT relation. """
+        if self.__vt is None:
+            self.__vt = vertex_triangles(self.__triangles, self.__vertices_num)
+        return self.__vt
+
+    def get_vv(self):
+        """ Returns the (offsets, vertex ids) CSR arrays of the VV relation. """
+        if self.__vv is None:
+            self.__vv = vertex_vertices(self.__triangles, self.__vertices_num)
+        return self.__vv
+
+    def get_neighbors(self):
+        if self.__neighbors is None:
+            self.__neighbors = triangle_neighbors(self.__triangles)
+        return self.__neighbors
+
+    def get_vertex_triangles(self, v_id):
+        offsets, t_ids = self.get_vt()
+        return t_ids[offsets[v_id]:offsets[v_id + 1]]
+
+    def get_vertex_vertices(self, v_id):
+        offsets, v_ids = self.get_vv()
+        return v_ids[offsets[v_id]:offsets[v_id + 1]]
+
+
+def vertex_triangles(triangles, vertices_num):
+    """ Returns the CSR arrays (offsets, triangle ids) of the triangles incident in each vertex. """
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    flat = triangles.ravel()
+    # A stable sort of the flattened array keeps the triangles of each vertex in increasing order
+    order = np.argsort(flat, kind='stable')
+    offsets = np.zeros(vertices_num + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(flat, minlength=vertices_num))
+    return offsets, order // 3
+
+
+def vertex_vertices(triangles, vertices_num):
+    """ Returns the CSR arrays (offsets, vertex ids) of the vertices adjacent to each vertex, in increasing order. """
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    # Both directions of every triangle edge; interior edges appear twice and are deduplicated
+    a = np.concatenate([triangles[:, k] for k in range(3)] + [triangles[:, (k + 1) % 3] for k in range(3)])
+    b = np.concatenate([triangles[:, (k + 1) % 3] for k in range(3)] + [triangles[:, k] for k in range(3)])
+    keys = np.unique(a * vertices_num + b)
+    offsets = np.zeros(vertices_num + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(keys // vertices_num, minlength=vertices_num))
+    return offsets, keys % vertices_num
+
+
+def triangle_neighbors(triangles):
+    """ Returns the (T, 3) array of the triangle across the edge opposite each vertex of each triangle, -1 on the
+        boundary. """
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    neighbors = np.full(triangles.shape, -1, dtype=np.int64)
+    if len(triangles) == 0:
+        return neighbors
+    vertices_num = int(triangles.max()) + 1
+    a = np.concatenate([triangles[:, (k + 1) % 3] for k in range(3)])
+    b = np.concatenate([triangles[:, (k + 2) % 3] for k in range(3)])
+    keys = np.minimum(a, b) * vertices_num + np.maximum(a, b)
+    order = np.argsort(keys, kind='stable')
+    shared = np.flatnonzero(keys[order][1:] == keys[order][:-1])
+    first, second = order[shared], order[shared + 1]
+    t_ids, k_ids = np.tile(np.arange(len(triangles)), 3), np.repeat(np.arange(3), len(triangles))
+    neighbors[t_ids[first], k_ids[first]] = t_ids[second]
+    neighbors[t_ids[second], k_ids[second]] = t_ids[first]
+    return neighbors
+
+
+def classify_critical_points(tin, positions=None):
+    """ Classifies TIN vertices (all of them, or the given positions) as Maxima, Minima or Saddle from their link and
+        writes the sounding_type codes to the store; a vertex adjacent to a vertex of equal (or no) depth is in a flat
+        area and keeps its type. A saddle has at least two components both among its upper and its lower link
+        vertices, counted for all the vertices at once by label propagation over the link edges. """
+    store, ids = tin.get_store(), tin.get_ids()
+    vertices_num = len(ids)
+    positions = np.arange(vertices_num) if positions is None else np.asarray(positions, dtype=np.int64)
+    z = store.z[ids]
+    topology = tin.get_topology()
+    vv_offsets, vv_ids = topology.get_vv()
+
+    # One link node per (vertex, adjacent vertex) pair, in VV order
+    owners = np.repeat(np.arange(vertices_num), np.diff(vv_offsets))
+    upper, lower = z[vv_ids] > z[owners], z[vv_ids] < z[owners]
+    flat = np.bincount(owners[~(upper | lower)], minlength=vertices_num) > 0
+    upper_num = np.bincount(owners[upper], minlength=vertices_num)
+    lower_num = np.bincount(owners[lower], minlength=vertices_num)
+    candidates = ~flat & (upper_num > 0) & (lower_num > 0)
+
+    # Link edges of every vertex, as pairs of link nodes, joining two upper or two lower link vertices
+    triangles = np.asarray(tin.get_triangles(), dtype=np.int64)
+    v = np.concatenate([triangles[:, k] for k in range(3)])
+    a = np.concatenate([triangles[:, (k + 1) % 3] for k in range(3)])
+    b = np.concatenate([triangles[:, (k + 2) % 3] for k in range(3)])
+    keep = candidates[v] & (((z[a] > z[v]) & (z[b] > z[v])) | ((z[a] < z[v]) & (z[b] < z[v])))
+    v, a, b = v[keep], a[keep], b[keep]
+    pair_keys = owners * vertices_num + vv_ids
+    node_a = np.searchsorted(pair_keys, v * vertices_num + a)
+    node_b = np.searchsorted(pair_keys, v * vertices_num + b)
+
+    # Every node ends up labelled with the smallest node of its component: hook roots, then compress paths
+    labels = np.arange(len(vv_ids))
+    while True:
+        label_a, label_b = labels[node_a], labels[node_b]
+        joined = label_a != label_b
+        if not np.any(joined):
+            break
+        np.minimum.at(labels, np.maximum(label_a, label_b)[joined], np.minimum(label_a, label_b)[joined])
+        while True:
+            compressed = labels[labels]
+            if np.array_equal(compressed, labels):
+                break
+            labels = compressed
+    roots = labels == np.arange(len(vv_ids))
+    upper_components = np.bincount(owners[roots & upper], minlength=vertices_num)
+    lower_components = np.bincount(owners[roots & lower], minlength=vertices_num)
+
+    types = np.zeros(vertices_num, dtype=np.int8)
+    types[~flat & (upper_num == 0)] = SOUNDING_TYPE_CODES['Minima']
+    types[~flat & (upper_num > 0) & (lower_num == 0)] = SOUNDING_TYPE_CODES['Maxima']
+    types[candidates & (upper_components >= 2) & (lower_components >= 2)] = SOUNDING_TYPE_CODES['Saddle']
+    classified = positions[types[positions] > 0]
+    store.sounding_type[ids[classified]] = types[classified]
+    metrics.count('critical_points', len(classified))
+    return classified
@@ -1,141 +1,346 @@
+import numpy as np
 from sounding_selection.node import Node
+from sounding_selection.point import Point as Domain_Point
+from sounding_selection.domain import Domain, QueryPolygon
+from sounding_selection.metrics import metrics
+from sounding_selection.topology import classify_critical_points
 from sounding_selection.cartographic_model import *
 from sounding_selection.catzoc import *
-from shapely.geometry import Point, Polygon
+
+# Maximum subdivision level; a Morton code stores 2 bits per level in an unsigned 64-bit integer
+MAX_DEPTH = 31
+
+# sons legend:
+#   ne = 0
+#   nw = 1
+#   sw = 2
+#   se = 3
+# Morton digit of each son: 2 * (y >= mid_y) + (x >= mid_x)
+SON_DIGITS = (3, 2, 0, 1)
+# Son (position among the sons) of each Morton digit
+DIGIT_SONS = (2, 3, 1, 0)
+
+# Number of traversals and of nodes they visited
+traversal_counts = {'traversals': 0, 'nodes_visited': 0}
+metrics.register('quadtree', traversal_counts)
+
+
+def morton_codes(x, y, min_x, min_y, max_x, max_y, depth=MAX_DEPTH):
+    """ Computes the Morton code of each point at the given depth. Every level splits the node domain at its centroid
+        exactly as Domain.get_centroid does, and a point lying on a split line goes to the upper side, which
+        reproduces the half-open rule of Domain.contains_point. """
+    codes = np.zeros(len(x), dtype=np.uint64)
+    lo_x, hi_x = np.full(len(x), float(min_x)), np.full(len(x), float(max_x))
+    lo_y, hi_y = np.full(len(y), float(min_y)), np.full(len(y), float(max_y))
+    for _ in range(depth):
+        mid_x = lo_x + (hi_x - lo_x) / 2.0
+        mid_y = lo_y + (hi_y - lo_y) / 2.0
+        upper_x = x >= mid_x
+        upper_y = y >= mid_y
+        codes <<= np.uint64(2)
+        codes |= (upper_y.astype(np.uint64) << np.uint64(1)) | upper_x.astype(np.uint64)
+        np.copyto(lo_x, mid_x, where=upper_x)
+        np.copyto(hi_x, mid_x, where=~upper_x)
+        np.copyto(lo_y, mid_y, where=upper_y)
+        np.copyto(hi_y, mid_y, where=~upper_y)
+    return codes
+
+
+def unique_points_mask(x, y):
+    """ Flags the first occurrence of every (x, y) coordinate pair; later duplicates are not indexed (see
+        Node.is_duplicate). """
+    order = np.lexsort((np.arange(len(x)), y, x))
+    first = np.ones(len(x), dtype=bool)
+    first[1:] = (x[order][1:] != x[order][:-1]) | (y[order][1:] != y[order][:-1])
+    mask = np.empty(len(x), dtype=bool)
+    mask[order] = first
+    return mask
 
 
 class Tree(object):
-    """Creates Class Tree"""
+    """ Linear PR-Quadtree. Nodes live in flat arrays (bounds, Morton prefix, level, first son, parent) and the tree is
+        bulk built from the sorted Morton codes of the indexed points; leaves hold their vertices/triangles in a Node.
+
+        Point trees are also dynamic: a point inserted in a full leaf splits it, and the sons of a node are merged back
+        when a deletion leaves them with no more points than the capacity, so the tree keeps the shape a bulk build of
+        the same points would have. Vertex ids are point set positions and never change; a point outside the domain
+        rebuilds the tree over the extended domain. """
     def __init__(self, c):
-        self.__root = Node()
         self.__capacity = c
-
-    def get_root(self):
-        return self.__root
+        self.__domain = None
+        self.__min_x = self.__min_y = self.__max_x = self.__max_y = None
+        self.__level = self.__code = self.__son = self.__parent = None
+        self.__leaves = dict()
+        self.__free = list()  # First son of the blocks of four nodes released by merges
 
     def get_leaf_threshold(self):
         return self.__capacity
 
+    def get_nodes_num(self):
+        return 0 if self.__son is None else len(self.__son)
+
+    def get_leaves(self):
+        """ Returns the leaf nodes in depth-first order (NE -> NW -> SW -> SE). """
+        return [self.__leaves[n] for n in self.__traverse()]
+
+    def get_indexed_vertices(self):
+        """ Returns the positions of the indexed vertices in the order a polygon query reports them. """
+        positions = [v_id for leaf in self.get_leaves() for v_id in leaf.get_vertices()]
+        return np.asarray(positions, dtype=np.int64)
+
     def build_point_tree(self, point_set):
-        for i in range(point_set.get_vertices_num()):
-            self.insert_vertex(self.__root, 0, point_set.get_domain(), i, point_set)
+        store, ids = point_set.get_store(), point_set.get_ids()
+        self.__build(store.x[ids], store.y[ids], point_set.get_domain())
 
     def build_tin_tree(self, tin):
         # First insert the vertices of the TIN
-        for i in range(tin.get_vertices_num()):
-            self.insert_vertex(self.__root, 0, tin.get_domain(), i, tin)
-        # Then triangles
-        for i in range(tin.get_triangles_num()):
-            self.insert_triangle(self.__root, 0, tin.get_domain(), i, tin)
-
-    def insert_vertex(self, node, node_label, node_domain, v_index, tin):
-        if node_domain.contains_point(tin.get_vertex(v_index), tin.get_domain().get_max_point()):
-            if node.is_leaf():
-                if node.is_duplicate(v_index, tin):
-                    return
-                node.add_vertex(v_index)  # update append list
-                if node.overflow(self.__capacity):
-                    node.init_sons()
-                    for i in node.get_vertices():
-                        self.insert_vertex(node, node_label, node_domain, i, tin)
-                    node.reset_vertices()  # empty the list of the current node
-
-            else:  # Internal
-                mid_point = node_domain.get_centroid()
-                for i in range(4):
-                    s_label, s_domain = node.compute_son_label_and_domain(i, node_label, node_domain, mid_point)
-                    self.insert_vertex(node.get_son(i), s_label, s_domain, v_index, tin)
-
-    def insert_triangle(self, node, node_label, node_domain, triangle_id, tin):
-        tri = tin.get_triangle(triangle_id)
-        if node_domain.contains_triangle(tri, tin):
-            if node.is_leaf():
-                node.add_triangle(triangle_id)  # Update index list
-
-            else:  # Internal
-                mid_point = node_domain.get_centroid()
-                for i in range(4):
-                    s_label, s_domain = node.compute_son_label_and_domain(i, node_label, node_domain, mid_point)
-                    self.insert_triangle(node.get_son(i), s_label, s_domain, triangle_id, tin)
-
-    def generalization(self, node, node_label, node_domain, target_v, point_set, delete_list, algorithm, scale=None,
-                       h_spacing=None, v_spacing=None, radius_lookup=None):
-
-        if node is None:
-            return
-        else:
-            if node.is_leaf():
-                if node.get_vertices_num() == 0:
-                    pass
-                else:
-                    if algorithm is 'DCM':
-                        node.carto_model_generalization(target_v, point_set, delete_list, scale, h_spacing, v_spacing)
-                    else:
-                        node.radius_based_generalization(target_v, point_set, delete_list, radius_lookup)
-
-            else:  # Internal
-                # Visit the sons in the following order: NE -> NW -> SW -> SE
-                mid_point = node_domain.get_centroid()
-                if algorithm is 'DCM':
-                    search_window = get_carto_symbol(target_v, scale, h_spacing, v_spacing)[0]
-                else:
-                    radius_length = radius_lookup[target_v.__str__()]
-                    search_window = Point(target_v.x_value, target_v.y_value).buffer(radius_length)
-                for i in range(4):
-                    s_label, s_domain = node.compute_son_label_and_domain(i, node_label, node_domain, mid_point)
-                    if s_domain.contains_polygon(search_window):
-                        self.generalization(node.get_son(i), s_label, s_domain, target_v, point_set, delete_list,
-                                            algorithm, scale, h_spacing, v_spacing, radius_lookup)
-                        break
-                    elif s_domain.intersects_polygon(search_window):
-                        self.generalization(node.get_son(i), s_label, s_domain, target_v, point_set, delete_list,
-                                            algorithm, scale, h_spacing, v_spacing, radius_lookup)
-
-    def points_in_polygon(self, node, node_label, node_domain, polygon, point_set, point_list):
-        if node is None:
-            return
-        else:
-            if node.is_leaf():
-                if node.get_vertices_num() == 0:
-                    pass
-                else:
-                    node.points_in_polygon(polygon, point_set, point_list)
+        store, ids = tin.get_store(), tin.get_ids()
+        leaf_of_vertex = self.__build(store.x[ids], store.y[ids], tin.get_domain())
+
+        # Then triangles; a leaf indexes every triangle with at least one vertex inside its domain
+        if tin.get_triangles_num() > 0:
+            tri_array = tin.get_triangles().astype(np.int64)
+            leaf_tri = np.unique(np.column_stack((leaf_of_vertex[tri_array].ravel(),
+                                                  np.repeat(np.arange(len(tri_array)), 3))), axis=0)
+            for leaf, t_id in leaf_tri:
+                self.__leaves[int(leaf)].add_triangle(int(t_id))
+
+    def __build(self, x, y, domain, positions=None):
+        """ Bulk builds the tree over the points and returns the leaf containing each point. Leaves index the points
+            by their positions (increasing), by default their rank in x, y. """
+        self.__domain = domain
+        min_p, max_p = domain.get_min_point(), domain.get_max_point()
+        codes = morton_codes(x, y, min_p.x_value, min_p.y_value, max_p.x_value, max_p.y_value)
+        positions = np.arange(len(x)) if positions is None else np.asarray(positions, dtype=np.int64)
+
+        indexed = np.flatnonzero(unique_points_mask(x, y))
+        perm = indexed[np.argsort(codes[indexed], kind='stable')]
+        sorted_codes = codes[perm]
+
+        min_x, min_y, max_x, max_y = [min_p.x_value], [min_p.y_value], [max_p.x_value], [max_p.y_value]
+        level, code, son, parent = [0], [0], [-1], [-1]
+        leaves = dict()
+        stack = [(0, 0, len(perm))]
+        while len(stack) > 0:
+            node, start, end = stack.pop()
+            if end - start > self.__capacity and level[node] < MAX_DEPTH:
+                son[node] = len(son)
+                mid_x = min_x[node] + (max_x[node] - min_x[node]) / 2.0
+                mid_y = min_y[node] + (max_y[node] - min_y[node]) / 2.0
+                shift = np.uint64(2 * (MAX_DEPTH - level[node] - 1))
+                for digit in SON_DIGITS:
+                    s_code = code[node] * 4 + digit
+                    upper_x, upper_y = digit & 1, digit >> 1
+                    min_x.append(mid_x if upper_x else min_x[node])
+                    max_x.append(max_x[node] if upper_x else mid_x)
+                    min_y.append(mid_y if upper_y else min_y[node])
+                    max_y.append(max_y[node] if upper_y else mid_y)
+                    level.append(level[node] + 1)
+                    code.append(s_code)
+                    son.append(-1)
+                    parent.append(node)
+                    s_start = start + int(np.searchsorted(sorted_codes[start:end], np.uint64(s_code) << shift))
+                    s_end = start + int(np.searchsorted(sorted_codes[start:end], np.uint64(s_code + 1) << shift))
+                    stack.append((len(son) - 1, s_start, s_end))
             else:
-                mid_point = node_domain.get_centroid()
-                for i in range(4):
-                    s_label, s_domain = node.compute_son_label_and_domain(i, node_label, node_domain, mid_point)
-                    if s_domain.contains_polygon(polygon):
-                        self.points_in_polygon(node.get_son(i), s_label, s_domain, polygon, point_set, point_list)
-                        break
-                    if s_domain.intersects_polygon(polygon):
-                        self.points_in_polygon(node.get_son(i), s_label, s_domain, polygon, point_set, point_list)
-
-    def crit_query(self, node, node_label, node_domain, tin):
-        if node.is_leaf():
-            # Extract the VV topological relation for all the indexed vertices
-            node.compute_crit(tin)
-        else:  # Internal
-            # we visit the sons in the following order: NE -> NW -> SW -> SE
-            mid_point = node_domain.get_centroid()
-            for i in range(4):
-                s_label, s_domain = node.compute_son_label_and_domain(i, node_label, node_domain, mid_point)
-                self.crit_query(node.get_son(i), s_label, node_domain, tin)
-
-    def calculate_fill_soundings(self, node, node_label, node_domain, point_tree, point_set, tin, fill_soundings):
-
-        if node is None:
+                leaf = Node()
+                for v_id in np.sort(positions[perm[start:end]]):
+                    leaf.add_vertex(int(v_id))
+                leaves[node] = leaf
+
+        self.__min_x, self.__min_y = np.array(min_x), np.array(min_y)
+        self.__max_x, self.__max_y = np.array(max_x), np.array(max_y)
+        self.__level, self.__code, self.__son = np.array(level), np.array(code, dtype=np.uint64), np.array(son)
+        self.__parent = np.array(parent)
+        self.__leaves = leaves
+        self.__free = list()
+
+        # Leaves tile the domain, so each point falls in the leaf whose code range starts at or before its code
+        leaf_ids = np.array(sorted(leaves), dtype=np.int64)
+        leaf_starts = self.__code[leaf_ids] << (np.uint64(2) * (MAX_DEPTH - self.__level[leaf_ids]).astype(np.uint64))
+        order = np.argsort(leaf_starts)
+        return leaf_ids[order][np.searchsorted(leaf_starts[order], codes, side='right') - 1]
+
+    def insert(self, point_set, v_id):
+        """ Indexes position v_id of the point set, splitting the leaf if it overflows. Returns False, without indexing
+            it, for a point with the coordinates of an indexed one (as a bulk build would). """
+        v = point_set.get_vertex(v_id)
+        if self.__son is None or not self.__domain_contains(v.x_value, v.y_value):
+            return self.__extend(point_set, v_id)
+        node = self.__locate(v.x_value, v.y_value)
+        leaf = self.__leaves[node]
+        if leaf.is_duplicate(v_id, point_set):
+            return False
+        leaf.insert_vertex(v_id)
+        self.__split(node, point_set)
+        return True
+
+    def delete(self, point_set, v_id):
+        """ Removes position v_id of the point set from the tree, merging the leaves that underflow. Returns False if
+            the position was not indexed. """
+        v = point_set.get_vertex(v_id)
+        if self.__son is None or not self.__domain_contains(v.x_value, v.y_value):
+            return False
+        node = self.__locate(v.x_value, v.y_value)
+        if v_id not in self.__leaves[node].get_vertices():
+            return False
+        self.__leaves[node].remove_vertex(v_id)
+        self.__merge(self.__parent[node])
+        return True
+
+    def insert_vertex(self, v, point_set):
+        """ Indexes the vertex at its position in the point set, adding it to the point set first if it is not there
+            (e.g. a sounding deleted by a generalization is indexed again at its former position); returns the
+            position. """
+        v_id = point_set.get_position(v)
+        if v_id is None:
+            point_set.add_vertex(v)
+            v_id = point_set.get_vertices_num() - 1
+        self.insert(point_set, v_id)
+        return v_id
+
+    def __domain_contains(self, x, y):
+        min_p, max_p = self.__domain.get_min_point(), self.__domain.get_max_point()
+        return min_p.x_value <= x <= max_p.x_value and min_p.y_value <= y <= max_p.y_value
+
+    def __locate(self, x, y):
+        """ Descends to the leaf whose domain contains the point, with the split rule of morton_codes. """
+        node = 0
+        while self.__son[node] >= 0:
+            mid_x = self.__min_x[node] + (self.__max_x[node] - self.__min_x[node]) / 2.0
+            mid_y = self.__min_y[node] + (self.__max_y[node] - self.__min_y[node]) / 2.0
+            node = self.__son[node] + DIGIT_SONS[2 * int(y >= mid_y) + int(x >= mid_x)]
+        return node
+
+    def __extend(self, point_set, v_id):
+        """ Rebuilds the tree over the indexed points and v_id, on a domain extended to contain them. Returns whether
+            v_id is indexed, looking it up in its leaf only. """
+        positions = np.union1d(self.get_indexed_vertices() if self.__son is not None else [], [v_id]).astype(np.int64)
+        store, ids = point_set.get_store(), point_set.get_ids()[positions]
+        x, y = store.x[ids], store.y[ids]
+        min_x, min_y, max_x, max_y = x.min(), y.min(), x.max(), y.max()
+        if self.__son is not None and len(positions) > 1:
+            min_p, max_p = self.__domain.get_min_point(), self.__domain.get_max_point()
+            min_x, min_y = min(min_x, min_p.x_value), min(min_y, min_p.y_value)
+            max_x, max_y = max(max_x, max_p.x_value), max(max_y, max_p.y_value)
+        domain = Domain(Domain_Point(float(min_x), float(min_y)), Domain_Point(float(max_x), float(max_y)))
+        leaf_of_vertex = self.__build(x, y, domain, positions)
+        return v_id in self.__leaves[int(leaf_of_vertex[np.searchsorted(positions, v_id)])].get_vertices()
+
+    def __split(self, node, point_set):
+        """ Splits an overflowing leaf, and its sons in turn. """
+        leaf = self.__leaves[node]
+        if leaf.get_vertices_num() <= self.__capacity or self.__level[node] >= MAX_DEPTH:
             return
+        if len(self.__free) > 0:
+            first_son = self.__free.pop()
         else:
-            if node.is_leaf():
-                if node.get_vertices_num() == 0 and node.get_triangles_num() == 0:
-                    pass
+            first_son = len(self.__son)
+            self.__min_x, self.__min_y = np.append(self.__min_x, [0.0] * 4), np.append(self.__min_y, [0.0] * 4)
+            self.__max_x, self.__max_y = np.append(self.__max_x, [0.0] * 4), np.append(self.__max_y, [0.0] * 4)
+            self.__level, self.__son = np.append(self.__level, [0] * 4), np.append(self.__son, [-1] * 4)
+            self.__code = np.append(self.__code, np.zeros(4, dtype=np.uint64))
+            self.__parent = np.append(self.__parent, [-1] * 4)
+
+        mid_x = self.__min_x[node] + (self.__max_x[node] - self.__min_x[node]) / 2.0
+        mid_y = self.__min_y[node] + (self.__max_y[node] - self.__min_y[node]) / 2.0
+        for i, digit in enumerate(SON_DIGITS):
+            s = first_son + i
+            upper_x, upper_y = digit & 1, digit >> 1
+            self.__min_x[s] = mid_x if upper_x else self.__min_x[node]
+            self.__max_x[s] = self.__max_x[node] if upper_x else mid_x
+            self.__min_y[s] = mid_y if upper_y else self.__min_y[node]
+            self.__max_y[s] = self.__max_y[node] if upper_y else mid_y
+            self.__level[s] = self.__level[node] + 1
+            self.__code[s] = self.__code[node] * np.uint64(4) + np.uint64(digit)
+            self.__son[s], self.__parent[s] = -1, node
+            self.__leaves[s] = Node()
+        self.__son[node] = first_son
+        del self.__leaves[node]
+
+        # Vertices are distributed in increasing order, so the sons stay sorted
+        for v_id in leaf.get_vertices():
+            v = point_set.get_vertex(v_id)
+            digit = 2 * int(v.y_value >= mid_y) + int(v.x_value >= mid_x)
+            self.__leaves[first_son + DIGIT_SONS[digit]].add_vertex(v_id)
+        for s in range(first_son, first_son + 4):
+            self.__split(s, point_set)
+
+    def __merge(self, node):
+        """ Merges the sons of node, and of its ancestors in turn, while they are leaves holding no more points than
+            the capacity. """
+        while node >= 0:
+            first_son = self.__son[node]
+            sons = range(first_son, first_son + 4)
+            if any(self.__son[s] >= 0 for s in sons):
+                return
+            if sum(self.__leaves[s].get_vertices_num() for s in sons) > self.__capacity:
+                return
+            leaf = Node()
+            for v_id in sorted(v_id for s in sons for v_id in self.__leaves[s].get_vertices()):
+                leaf.add_vertex(v_id)
+            for s in sons:
+                del self.__leaves[s]
+            self.__leaves[node] = leaf
+            self.__son[node] = -1
+            self.__free.append(first_son)
+            node = self.__parent[node]
+
+    def __traverse(self, query_polygon=None):
+        """ Explicit-stack depth-first traversal yielding leaves (NE -> NW -> SW -> SE). When a QueryPolygon is given
+            only sons intersecting it are visited, and a son containing it is the only one visited. """
+        stack = [0]
+        visited = 0
+        try:
+            while len(stack) > 0:
+                node = stack.pop()
+                visited += 1
+                first_son = self.__son[node]
+                if first_son < 0:
+                    yield node
+                    continue
+                if query_polygon is None:
+                    visit = range(first_son, first_son + 4)
                 else:
-                    node.extract_fill_soundings(tin, point_set, point_tree, fill_soundings)
-
-            else:  # Internal
-                # we visit the sons in the following order: NE -> NW -> SW -> SE
-                mid_point = node_domain.get_centroid()
-                for i in range(4):
-                    s_label, s_domain = node.compute_son_label_and_domain(i, node_label, node_domain, mid_point)
-                    self.calculate_fill_soundings(node.get_son(i), s_label, s_domain, point_tree, point_set, tin,
-                                                  fill_soundings)
+                    visit = list()
+                    for s in range(first_son, first_son + 4):
+                        s_bounds = self.__min_x[s], self.__min_y[s], self.__max_x[s], self.__max_y[s]
+                        if query_polygon.contained_by_box(*s_bounds):
+                            visit.append(s)
+                            break
+                        elif query_polygon.intersects_box(*s_bounds):
+                            visit.append(s)
+                stack.extend(reversed(visit))
+        finally:
+            # Counted once per traversal, also when the caller stops early
+            traversal_counts['traversals'] += 1
+            traversal_counts['nodes_visited'] += visited
+
+    def generalization(self, target_v, point_set, delete_list, scale, h_spacing, v_spacing):
+        search_window = get_carto_symbol(target_v, scale, h_spacing, v_spacing)[0]
+
+        underflows = list()
+        for leaf in self.__traverse(QueryPolygon(search_window)):
+            node = self.__leaves[leaf]
+            if node.get_vertices_num() > 0:
+                deletes_num = len(delete_list)
+                node.carto_model_generalization(target_v, point_set, delete_list, scale, h_spacing, v_spacing)
+                if len(delete_list) > deletes_num:
+                    underflows.append(leaf)
+
+        # Generalized soundings are deleted from the leaves; merge the ones left with too few points
+        for leaf in underflows:
+            if leaf in self.__leaves:
+                self.__merge(self.__parent[leaf])
+
+    def points_in_polygon(self, polygon, point_set, point_list):
+        # The query bounds and the prepared geometry are shared by the traversal and the leaf point tests
+        query_polygon = QueryPolygon(polygon)
+        for leaf in self.__traverse(query_polygon):
+            node = self.__leaves[leaf]
+            if node.get_vertices_num() > 0:
+                node.points_in_polygon(query_polygon, point_set, point_list)
+
+    def crit_query(self, tin):
+        # Classify all the indexed vertices at once from the VV relation of the TIN
+        classify_critical_points(tin, self.get_indexed_vertices())
@@ -1,117 +1,86 @@
 import triangle
-from sounding_selection.writer import Writer
+import shapely
+import numpy as np
+from sounding_selection.sounding_store import get_coordinates
+from sounding_selection.metrics import metrics
 from sounding_selection.vertex import Vertex
-from shapely.geometry import shape, Point, Polygon
+from shapely.geometry import Polygon
 from shapely.ops import unary_union
+from shapely.strtree import STRtree
+
+# Distance within which a vertex of the bathymetric extent boundary takes the depth of a shoreline or dredged area
+BOUNDARY_TOLERANCE = 0.001
 
 
 def triangulate(sounding_vertex_list, segments=None, segments_idx=None, holes=None):
     """ Uses a Python wrapper of Triangle (Shechuck, 1996) to triangulate a set of points. Triangulation is
         constrained if bounding vertices are provided; otherwise the triangulation is Delaunay. """
 
-    xy_list = [[v.x_value, v.y_value] for v in sounding_vertex_list]
+    xy_array = get_coordinates(sounding_vertex_list)
+    metrics.count('triangulations')
+    metrics.count('triangulation_input_vertices', len(xy_array) + (0 if segments is None else len(segments)))
 
     if segments is not None and segments_idx is not None and holes is not None:
-        points = [[v.x_value, v.y_value] for v in segments]
-
-        points.extend(xy_list)
+        points = np.concatenate((get_coordinates(segments), xy_array))
+        points, segments_array = unique_vertices(points, np.asarray(segments_idx, dtype=np.int32).reshape(-1, 2))
 
         # Constrained
         if len(holes) > 0:
             triangulation = triangle.triangulate({'vertices': points,
-                                                  'segments': segments_idx,
-                                                  'holes': holes},
+                                                  'segments': segments_array,
+                                                  'holes': np.asarray(holes, dtype=np.float64)},
                                                   'pCSi')
         else:  # Assertion error is raised if empty list passed to triangulate
             triangulation = triangle.triangulate({'vertices': points,
-                                                  'segments': segments_idx},
+                                                  'segments': segments_array},
                                                   'pCSi')
         # p: PSLG; C: Exact arithmetic; S_: Steiner point limit; i: Incremental triangulation algorithm
 
     else:
         # Delaunay
-        triangulation = triangle.triangulate({'vertices': xy_list})
+        triangulation = triangle.triangulate({'vertices': unique_vertices(xy_array)[0]})
 
     return triangulation
 
 
-def get_feature_segments(depth_contours, depth_areas, boundary=True):
+def unique_vertices(points, segments=None):
+    """ Removes repeated coordinates (Triangle may crash on duplicate vertices), keeping the first occurrence of each
+        in input order, and re-indexes the segments, dropping the ones collapsed to a point or repeated. """
+    _, first, inverse = np.unique(points, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    points = points[first[order]]
+    if segments is not None and len(segments) > 0:
+        segments = rank[inverse.ravel()][segments]
+        segments = segments[segments[:, 0] != segments[:, 1]]
+        _, first_segment = np.unique(np.sort(segments, axis=1), axis=0, return_index=True)
+        segments = segments[np.sort(first_segment)]
+    return points, segments
+
+
+def get_feature_segments(depth_contours, bathymetric_boundary, boundary=True, store=None):
     """ Extracts contour and boundary segments and returns the coordinates as Vertex objects along with the associated
-        index list."""
+        index list. Contours are a FeatureLayer, the boundary is the one get_bathymetric_boundary returns. If a
+        SoundingStore is provided the segment vertices are added to it."""
 
     geometry_dict = dict()
     geom_idx = 0
-    depth_polygons, dredged_areas = list(), list()
     contour_depth_field = 'VALDCO'
-    minimum_depth = 'DRVAL1'
-
-    for shape_record in depth_areas.iterShapeRecords(fields=[minimum_depth, 'FCSubtype']):
-        depth_area_geojson = shape_record.shape.__geo_interface__
-        depth_area_polygon = shape(depth_area_geojson)
-        if shape_record.record[1] == 5:
-            controlling_depth = shape_record.record[0]
-            dredged_areas.append([depth_area_polygon, controlling_depth])
-        else:
-            depth_polygons.append(depth_area_polygon)
-
-    bathymetric_extent = unary_union(depth_polygons)
-    dredged_extent = unary_union([dredged_area[0] for dredged_area in dredged_areas])
+    boundary_lines, bathymetric_extent, dredged_extent = bathymetric_boundary
 
     if boundary is False:
-        for contour_shape_record in depth_contours.iterShapeRecords(fields=[contour_depth_field]):
-            if contour_shape_record.record[0] != 0:
-                depth = contour_shape_record.record[0]
-                contour_geojson = contour_shape_record.shape.__geo_interface__
-                contour_linestring = shape(contour_geojson)
+        contour_depths = depth_contours.get_attribute(contour_depth_field).tolist()
+        for contour_linestring, depth in zip(depth_contours.get_geometries(), contour_depths):
+            if depth != 0:
                 contour_x, contour_y = contour_linestring.coords.xy
                 geometry_dict[geom_idx] = list()
                 for i in range(len(contour_x)):
                     geometry_dict[geom_idx].append(Vertex(contour_x[i], contour_y[i], depth))
                 geom_idx += 1
 
-    boundary_lines = list()
-    if bathymetric_extent.geom_type == 'MultiPolygon':
-        for polygon in bathymetric_extent.geoms:
-            boundary = polygon.boundary
-            if boundary.type == 'MultiLineString':
-                for line in boundary.geoms:
-                    boundary_lines.append(line)
-            else:
-                boundary_lines.append(boundary)
-
-    elif bathymetric_extent.geom_type == 'Polygon':
-        boundary = bathymetric_extent.boundary
-        if boundary.type == 'MultiLineString':
-            for line in boundary.geoms:
-                boundary_lines.append(line)
-        else:
-            boundary_lines.append(boundary)
-
-    for boundary_line in boundary_lines:
-        line_x, line_y = boundary_line.coords.xy
-        geometry_dict[geom_idx] = list()
-        for i in range(len(line_x)):
-            boundary_point, shoreline = True, False
-            for contour_shape_record in depth_contours.iterShapeRecords(fields=[contour_depth_field]):
-                if contour_shape_record.record[0] == 0:
-                    contour_geojson = contour_shape_record.shape.__geo_interface__
-                    contour_linestring = shape(contour_geojson)
-                    if Point(line_x[i], line_y[i]).buffer(0.001).intersects(contour_linestring):
-                        geometry_dict[geom_idx].append(Vertex(line_x[i], line_y[i], 0))
-                        boundary_point, shoreline = False, True
-                        break
-            if shoreline is False:
-                dredged_area_intersect = list()
-                for dredged_area in dredged_areas:
-                    if Point(line_x[i], line_y[i]).buffer(0.001).intersects(dredged_area[0]):
-                        dredged_area_intersect.append(dredged_area[1])
-                if len(dredged_area_intersect) > 0:
-                    dredged_area_intersect.sort()
-                    geometry_dict[geom_idx].append(Vertex(line_x[i], line_y[i], dredged_area_intersect[0]))
-                    boundary_point = False
-
-            if boundary_point is True:
-                geometry_dict[geom_idx].append(Vertex(line_x[i], line_y[i], float(-99999)))
+    for line_x, line_y, line_z in boundary_lines:
+        geometry_dict[geom_idx] = [Vertex(line_x[i], line_y[i], line_z[i]) for i in range(len(line_x))]
         geom_idx += 1
 
     segment_vertices, length_list = list(), list()
@@ -121,7 +90,8 @@ def get_feature_segments(depth_contours, depth_areas, boundary=True):
         for p in geometry_dict[geom_idx]:
             segment_vertices.append(p)
 
-    Writer.write_soundings_file('boundary_points', segment_vertices)
+    if store is not None:
+        segment_vertices = store.get_vertices([store.add_vertex(v) for v in segment_vertices])
 
     index_list = list()
     for i in range(len(length_list)):
@@ -154,39 +124,132 @@ def get_feature_segments(depth_contours, depth_areas, boundary=True):
     return segment_vertices, index_list, holes, bathymetric_extent, dredged_extent
 
 
-def create_idx(start, end, closed):
-    """ Creates indexes for contour vertices so that segments can be created for a constrained triangulation. """
+def get_bathymetric_boundary(depth_contours, depth_areas):
+    """ Returns the vertices of the bathymetric extent boundary as (x, y, z) arrays per boundary line, along with the
+        bathymetric and dredged extents. A vertex within BOUNDARY_TOLERANCE of a shoreline (zero depth contour) has
+        depth 0, otherwise the shallowest controlling depth of the dredged areas within tolerance, otherwise -99999
+        (boundary point). """
 
-    if closed is True:
-        return [[i, i + 1] for i in range(start, end)] + [[end, start]]
-    else:
-        return [[i, i + 1] for i in range(start, end)]
-
-
-def modified_binary_search(sorted_vertices, vertex):
-    """ Modified binary search algorithm to increase performance."""
+    area_polygons, minimum_depths = depth_areas.get_geometries(), depth_areas.get_attribute('DRVAL1')
+    is_dredged = depth_areas.get_attribute('FCSubtype') == 5
+    dredged = np.flatnonzero(is_dredged)
+    shoreline = np.flatnonzero(depth_contours.get_attribute('VALDCO') == 0)
 
-    right, left = 0, 0
-    vertices_num = len(sorted_vertices)
+    bathymetric_extent = unary_union([area_polygons[a_id] for a_id in np.flatnonzero(~is_dredged)])
+    dredged_extent = unary_union([area_polygons[a_id] for a_id in dredged])
 
-    while right < vertices_num:
-        i = (right + vertices_num) // 2
-        if vertex.z_value < sorted_vertices[i].z_value:
-            vertices_num = i
+    polygons = list()
+    if bathymetric_extent.geom_type == 'MultiPolygon':
+        polygons = list(bathymetric_extent.geoms)
+    elif bathymetric_extent.geom_type == 'Polygon':
+        polygons = [bathymetric_extent]
+    lines = list()
+    for polygon in polygons:
+        polygon_boundary = polygon.boundary
+        if polygon_boundary.geom_type == 'MultiLineString':
+            lines.extend(polygon_boundary.geoms)
         else:
-            right = i + 1
+            lines.append(polygon_boundary)
+    coords = [np.asarray(line.coords, dtype=np.float64)[:, :2] for line in lines]
+    xy = np.concatenate([np.empty((0, 2))] + coords)
+    metrics.count('boundary_vertices', len(xy))
+
+    # All the vertices are classified at once against STRtrees of the shorelines and of the dredged areas only
+    z = np.full(len(xy), np.inf)
+    point_ids, area_ids = dwithin_pairs([area_polygons[a_id] for a_id in dredged], xy[:, 0], xy[:, 1],
+                                        BOUNDARY_TOLERANCE)
+    np.minimum.at(z, point_ids, minimum_depths[dredged[area_ids]].astype(np.float64))
+    point_ids = dwithin_pairs([depth_contours.get_geometry(c_id) for c_id in shoreline], xy[:, 0], xy[:, 1],
+                              BOUNDARY_TOLERANCE)[0]
+    z[point_ids] = 0
+    z[np.isinf(z)] = -99999.0
+
+    boundary_lines, start = list(), 0
+    for line_xy in coords:
+        end = start + len(line_xy)
+        boundary_lines.append((line_xy[:, 0], line_xy[:, 1], z[start:end]))
+        start = end
+
+    return boundary_lines, bathymetric_extent, dredged_extent
+
+
+def dwithin_pairs(geometries, x, y, distance):
+    """ Returns the (point, geometry) position pairs of the points of the x, y coordinate arrays within distance of
+        each of the geometries, through one STRtree query (Shapely 1.8 and 2 APIs). """
+    if len(geometries) == 0 or len(x) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    tree = build_strtree(geometries)
+    if hasattr(shapely, 'points'):  # Shapely 2: bulk query of all the points
+        pairs = tree.query(shapely.points(x, y), predicate='dwithin', distance=distance)
+        return pairs[0].astype(np.int64), pairs[1].astype(np.int64)
+    from shapely.geometry import Point
+    point_ids, geometry_ids = list(), list()
+    for p_id, (point_x, point_y) in enumerate(zip(x, y)):
+        point = Point(point_x, point_y)
+        for g_id in query_strtree(tree, point.buffer(distance)):
+            if point.distance(geometries[g_id]) <= distance:
+                point_ids.append(p_id)
+                geometry_ids.append(g_id)
+    return np.asarray(point_ids, dtype=np.int64), np.asarray(geometry_ids, dtype=np.int64)
+
+
+def build_strtree(geometries):
+    """ STRtree over the geometries, queried by position with query_strtree (Shapely 1.8 and 2 APIs); None if there
+        are no geometries. """
+    if len(geometries) == 0:
+        return None
+    if hasattr(STRtree, 'query_items'):  # Shapely 1.8: positions are the tree items
+        return STRtree(geometries, range(len(geometries)))
+    return STRtree(geometries)
+
+
+def query_strtree(tree, geometry):
+    """ Returns the positions of the indexed geometries whose envelope intersects the one of geometry, ascending. """
+    if tree is None:
+        return np.empty(0, dtype=np.int64)
+    hits = tree.query_items(geometry) if hasattr(tree, 'query_items') else tree.query(geometry)
+    return np.sort(np.asarray(hits, dtype=np.int64))
+
+
+def points_in_polygon(polygon, x, y):
+    """ Flags the points of the x, y coordinate arrays that are inside or on the boundary of the polygon, as
+        Point(x, y).intersects(polygon) would. Points outside the polygon envelope are rejected first; the others are
+        tested in bulk against the prepared polygon. """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    inside = np.zeros(len(x), dtype=bool)
+    if len(x) == 0 or polygon.is_empty:
+        return inside
+    min_x, min_y, max_x, max_y = polygon.bounds
+    candidates = np.flatnonzero((min_x <= x) & (x <= max_x) & (min_y <= y) & (y <= max_y))
+    if len(candidates) > 0:
+        inside[candidates] = intersects_xy(polygon, x[candidates], y[candidates])
+    metrics.count('points_in_polygon_tests', len(candidates))
+    return inside
+
+
+def point_polygon_pairs(polygons, x, y):
+    """ Returns the (point, polygon) position pairs of the points of the x, y coordinate arrays inside or on the
+        boundary of each of the polygons, by polygon and then by point. """
+    point_ids, polygon_ids = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for polygon_id, polygon in enumerate(polygons):
+        inside = np.flatnonzero(points_in_polygon(polygon, x, y))
+        point_ids.append(inside)
+        polygon_ids.append(np.full(len(inside), polygon_id, dtype=np.int64))
+    return np.concatenate(point_ids), np.concatenate(polygon_ids)
+
+
+def intersects_xy(polygon, x, y):
+    """ Vectorized Point(x, y).intersects(polygon) over coordinate arrays (Shapely 1.8 and 2 APIs). """
+    if hasattr(shapely, 'intersects_xy'):  # Shapely 2: prepared on first use
+        return shapely.intersects_xy(polygon, x, y)
+    from shapely import vectorized
+    return vectorized.contains(polygon, x, y) | vectorized.touches(polygon, x, y)
 
-    vertices_num = right - 1
-    while left < vertices_num:
-        i = (left + vertices_num) // 2
-        if vertex.z_value > sorted_vertices[i].z_value:
-            left = i + 1
-        else:
-            vertices_num = i
 
-    if left == right-1:
-        return left
+def create_idx(start, end, closed):
+    """ Creates indexes for contour vertices so that segments can be created for a constrained triangulation. """
+
+    if closed is True:
+        return [[i, i + 1] for i in range(start, end)] + [[end, start]]
     else:
-        for idx in range(left, right):
-            if sorted_vertices[idx] == vertex:
-                return idx
+        return [[i, i + 1] for i in range(start, end)]
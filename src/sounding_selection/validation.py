@@ -1,144 +1,199 @@
-from shapely.geometry import Polygon, Point, shape
+import multiprocessing
+import numpy as np
+from shapely.geometry import Point
 from sounding_selection.logger import log
 from sounding_selection.catzoc import *
-from sounding_selection.cartographic_model import get_carto_symbol
+from sounding_selection.tree import morton_codes
+from sounding_selection.grid import envelope_pairs
+from sounding_selection.metrics import metrics
+from sounding_selection.cartographic_model import get_carto_symbol, get_overlapping_symbols, symbol_cache, \
+    segments_intersect_boxes
 
 
 def validate_functionality_constraint(generalized_tin, validation_tree, validation_point_set, depth_areas,
-                                      method='TRIANGLE'):
+                                      method='TRIANGLE', pool=None):
+    """ Returns the validation soundings violating the functionality constraint in the triangles of the generalized
+        TIN; depth_areas is the DepthsA FeatureLayer. With a ValidationPool of more than one worker the triangles are
+        split in spatially coherent chunks (Morton order of their centroids) evaluated by the pool; the violations are
+        merged in triangle order, as in the serial run. """
 
-    safety_violations = list()
-    if method == 'TRIANGLE':
-        for t_id in range(generalized_tin.get_triangles_num()):
-            tri = generalized_tin.get_triangle(t_id)
-            tri_points = list()
-            for v in range(tri.get_vertices_num()):
-                v_id = tri.get_tv(v)
-                tri_points.append(generalized_tin.get_vertex(v_id))
-
-            z_vals, triangle = list(), list()
-            for point in tri_points:
-                z_vals.append(point.z_value)
-                triangle.append([point.x_value, point.y_value])
-
-            if float(-99999) not in z_vals:
-                in_triangle_list = list()
-                validation_tree.points_in_polygon(validation_tree.get_root(), 0, validation_point_set.get_domain(),
-                                                  Polygon(triangle), validation_point_set, in_triangle_list)
-
-                if len(in_triangle_list) > 0:
-                    shallow_in_triangle = sorted(in_triangle_list, key=lambda k: k.z_value)[0]
-                    shallow_z = sorted(z_vals)[0]
-                    if shallow_in_triangle.z_value < shallow_z:
-                        if all(z == z_vals[0] for z in z_vals):
-                            for shape_record in depth_areas.iterShapeRecords(fields=['DRVAL1']):
-                                depth_area_geojson = shape_record.shape.__geo_interface__
-                                depth_polygon = shape(depth_area_geojson)
-                                shallow_in_tri_point = Point(shallow_in_triangle.x_value, shallow_in_triangle.y_value)
-                                if shallow_in_tri_point.intersects(depth_polygon):
-                                    drval1 = shape_record.record[0]
-                                    if shallow_in_triangle.z_value < drval1:
-                                        safety_violations.append(shallow_in_triangle)
-                                    break
-
-                        else:
-                            safety_violations.append(shallow_in_triangle)
-
-    elif method == 'SURFACE':
-        catzoc_dict = {1: 'A1',
-                       2: 'A2',
-                       3: 'B',
-                       4: 'C',
-                       5: 'D',
-                       6: 'U'}
-
-        for t_id in range(generalized_tin.get_triangles_num()):
-            tri = generalized_tin.get_triangle(t_id)
-            tri_points = list()
-            for v in range(tri.get_vertices_num()):
-                v_id = tri.get_tv(v)
-                tri_points.append(generalized_tin.get_vertex(v_id))
-
-            triangle, z_vals, catzoc_values = list(), list(), list()
-            for point in tri_points:
-                z_vals.append(point.z_value)
-                triangle.append([point.x_value, point.y_value])
-                catzoc_values.append(point.catzoc_value)
-
-            # Use the highest quality catzoc of the triangle
-            catzoc_sorted = sorted([c for c in catzoc_values if c is not None])
-            if len(catzoc_sorted) > 0:
-                best_catzoc = catzoc_sorted[0]
-                catzoc = catzoc_dict[best_catzoc]
-            else:
-                catzoc = catzoc_dict[6]
-
-            # Skip triangles along boundary; cannot assess triangles with no depth tolerance (D and U)
-            if float(-99999) not in z_vals and catzoc != 'U' and catzoc != 'D':
-                intersect_triangle_list = list()
-                validation_tree.points_in_polygon(validation_tree.get_root(), 0, validation_point_set.get_domain(),
-                                                  Polygon(triangle), validation_point_set, intersect_triangle_list)
-
-                inside_triangle_list = [v for v in intersect_triangle_list if v not in tri_points]
-
-                difference_list = list()
-                for v in inside_triangle_list:
-                    p1, p2, p3 = tri_points[0], tri_points[1], tri_points[2]
-                    weight1_numer = ((p2.y_value - p3.y_value) * (v.x_value - p3.x_value)) + \
-                                    ((p3.x_value - p2.x_value) * (v.y_value - p3.y_value))
-
-                    weight2_numer = ((p3.y_value - p1.y_value) * (v.x_value - p3.x_value)) + \
-                                    ((p1.x_value - p3.x_value) * (v.y_value - p3.y_value))
-
-                    denom = ((p2.y_value - p3.y_value) * (p1.x_value - p3.x_value)) + \
-                            ((p3.x_value - p2.x_value) * (p1.y_value - p3.y_value))
-
-                    weight1 = weight1_numer / denom
-                    weight2 = weight2_numer / denom
-                    weight3 = 1 - weight1 - weight2
-
-                    interp_z = (p1.z_value * weight1) + (p2.z_value * weight2) + (p3.z_value * weight3)
-                    actual_z = v.z_value
-
-                    # if abs(interp_z - actual_z) > depth_tolerance(catzoc, actual_z):  # Shallow and deep violations
-                    if interp_z - actual_z > depth_tolerance(catzoc, actual_z):  # Shallow violations
-                        difference_list.append([v, interp_z - actual_z])
-
-                # Identify soundings with largest difference
-                if len(difference_list) > 0:
-                    diff_sorted = sorted(difference_list, key=lambda k: k[1], reverse=True)
-                    largest_violation = diff_sorted[0][0]
-                    if largest_violation not in safety_violations:  # Triangle can be indexed to multiple nodes
-                        safety_violations.append(largest_violation)
+    if method not in ['TRIANGLE', 'SURFACE']:
+        log.info('Functionality Validation Method Not Provided')
+        return list()
+
+    # Assign the validation soundings to the triangles containing them in one pass; the soundings of each triangle are
+    # listed in the same order as a quadtree polygon query would report them
+    positions = validation_tree.get_indexed_vertices()
+    store, ids = validation_point_set.get_store(), validation_point_set.get_ids()[positions]
+    offsets, point_index = generalized_tin.locate_points(store.x[ids], store.y[ids])
+    tri_x, tri_y, tri_z, tri_catzoc = triangle_arrays(generalized_tin)
 
+    data = {'method': method, 'tri_x': tri_x, 'tri_y': tri_y, 'tri_z': tri_z, 'offsets': offsets,
+            'point_index': point_index, 'x': store.x[ids], 'y': store.y[ids], 'z': store.z[ids]}
+    if method == 'TRIANGLE':
+        data['depth_areas'] = depth_areas
     else:
-        log.info('Functionality Validation Method Not Provided')
+        # Use the highest quality catzoc of the triangle
+        data['catzoc_codes'] = best_catzoc(tri_catzoc)
 
-    return safety_violations
+    triangles_num = generalized_tin.get_triangles_num()
+    metrics.count('functionality_validations')
+    if pool is not None and pool.get_workers() > 1 and triangles_num > 0:
+        violations = pool.validate(data, _spatial_chunks(tri_x, tri_y, pool.get_workers() * 4))
+    else:
+        violations = _functionality_violations(data, np.arange(triangles_num))
+
+    if method == 'SURFACE':
+        # A sounding is reported once, although it can be the largest violation of several triangles; indexed
+        # soundings have distinct coordinates, so they are told apart by position
+        first = np.unique(violations[:, 1], return_index=True)[1]
+        violations = violations[np.sort(first)]
+
+    return [validation_point_set.get_vertex(positions[p]) for p in violations[:, 1]]
+
+
+class ValidationPool(object):
+    """ Process pool of functionality constraint validation, created once for the validations of a run. The workers
+        receive the depth areas when they start; each validation only sends them the arrays of its chunks. Closed on
+        exit when used as a context manager. """
+
+    def __init__(self, workers, depth_areas):
+        self.__workers = max(int(workers), 1)
+        self.__pool = None
+        if self.__workers > 1:
+            self.__pool = multiprocessing.Pool(self.__workers, _init_validation_worker, (depth_areas,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_workers(self):
+        return self.__workers
+
+    def validate(self, data, chunks):
+        """ Evaluates the chunks of triangles of the validation data in the workers; returns the (triangle, sounding)
+            pairs of the violations in triangle order. """
+        chunk_data, chunk_points = zip(*[_chunk_data(data, t_ids) for t_ids in chunks])
+        chunk_violations = [np.empty((0, 2), dtype=np.int64)]
+        for t_ids, points, violations in zip(chunks, chunk_points, self.__pool.map(_validate_chunk, chunk_data)):
+            chunk_violations.append(np.column_stack((t_ids[violations[:, 0]], points[violations[:, 1]])))
+        violations = np.concatenate(chunk_violations)
+        return violations[np.argsort(violations[:, 0], kind='stable')]
+
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+
+_depth_areas = None
+
+
+def _init_validation_worker(depth_areas):
+    global _depth_areas
+    _depth_areas = depth_areas
+
+
+def _validate_chunk(data):
+    if data['method'] == 'TRIANGLE':
+        data['depth_areas'] = _depth_areas
+    return _functionality_violations(data, np.arange(len(data['tri_z'])))
+
+
+def _chunk_data(data, t_ids):
+    """ Returns the validation data restricted to the triangles t_ids and the soundings located in them, renumbered
+        from 0, with the positions of these soundings in the full data. """
+    offsets = data['offsets']
+    counts = offsets[t_ids + 1] - offsets[t_ids]
+    chunk_offsets = np.concatenate(([0], np.cumsum(counts)))
+    points = data['point_index'][np.repeat(offsets[t_ids] - chunk_offsets[:-1], counts) + np.arange(chunk_offsets[-1])]
+    chunk = {'method': data['method'], 'tri_x': data['tri_x'][t_ids], 'tri_y': data['tri_y'][t_ids],
+             'tri_z': data['tri_z'][t_ids], 'offsets': chunk_offsets, 'point_index': np.arange(len(points)),
+             'x': data['x'][points], 'y': data['y'][points], 'z': data['z'][points]}
+    if data['method'] == 'SURFACE':
+        chunk['catzoc_codes'] = data['catzoc_codes'][t_ids]
+    return chunk, points
+
+
+def _spatial_chunks(tri_x, tri_y, chunks_num):
+    """ Splits the triangles in chunks of consecutive Morton codes of their centroids; each chunk is sorted. """
+    c_x, c_y = tri_x.mean(axis=1), tri_y.mean(axis=1)
+    codes = morton_codes(c_x, c_y, c_x.min(), c_y.min(), c_x.max(), c_y.max(), 16)
+    order = np.argsort(codes, kind='stable')
+    return [np.sort(chunk) for chunk in np.array_split(order, min(chunks_num, len(order)))]
+
+
+def _functionality_violations(data, t_ids):
+    """ Evaluates the (sorted) triangles t_ids and returns the (triangle, sounding) pairs of the violations, in
+        triangle order; soundings are positions in the CSR table arrays. """
+    tri_z, offsets, point_index, z = data['tri_z'], data['offsets'], data['point_index'], data['z']
+
+    # Candidate soundings of the triangles, skipping the triangles along the boundary
+    t_ids = t_ids[~np.any(tri_z[t_ids] == float(-99999), axis=1)]
+    if data['method'] == 'SURFACE':
+        # Cannot assess triangles with no depth tolerance (D and U)
+        t_ids = t_ids[has_depth_tolerance(data['catzoc_codes'][t_ids])]
+    counts = offsets[t_ids + 1] - offsets[t_ids]
+    candidate_tri = np.repeat(t_ids, counts)
+    candidates = point_index[np.repeat(offsets[t_ids] - (np.cumsum(counts) - counts), counts) +
+                             np.arange(len(candidate_tri))]
+    violations = list()
+
+    if data['method'] == 'TRIANGLE':
+        # Shallowest sounding of each triangle (the first reported on ties)
+        order = np.lexsort((np.arange(len(candidates)), z[candidates], candidate_tri))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = candidate_tri[order][1:] != candidate_tri[order][:-1]
+        for t_id, shallow in zip(candidate_tri[order[first]], candidates[order[first]]):
+            z_vals = tri_z[t_id]
+            if z[shallow] < z_vals.min():
+                if np.all(z_vals == z_vals[0]):
+                    shallow_in_tri_point = Point(data['x'][shallow], data['y'][shallow])
+                    depth_areas = data['depth_areas']
+                    for a_id in depth_areas.query(shallow_in_tri_point):
+                        if shallow_in_tri_point.intersects(depth_areas.get_geometry(a_id)):
+                            if z[shallow] < depth_areas.get_attribute('DRVAL1')[a_id]:
+                                violations.append((t_id, shallow))
+                            break
+                else:
+                    violations.append((t_id, shallow))
+
+    elif len(candidates) > 0:
+        # Shallow violations only; the largest difference of each triangle is the violation
+        largest = surface_deviations(data['tri_x'], data['tri_y'], tri_z, data['catzoc_codes'], data['x'][candidates],
+                                     data['y'][candidates], z[candidates], candidate_tri, shallow_only=True)[2]
+        for t_id in np.flatnonzero(largest >= 0):
+            violations.append((t_id, candidates[largest[t_id]]))
+
+    return np.array(violations, dtype=np.int64).reshape(-1, 2)
 
 
 def validate_legibility_constraint(soundings, soundings_tree, soundings_point_set, scale, h_spacing, v_spacing):
 
-    legibility_violations = list()
+    # Violations are listed once each, tracked by sounding id
+    legibility_violations, violation_ids = list(), set()
 
     i = 0
     while i < len(soundings):
         target_sounding = soundings[i]
         search_window = get_carto_symbol(target_sounding, scale, h_spacing, v_spacing)[0]
-        target_label = get_carto_symbol(target_sounding, scale, h_spacing, v_spacing)[1]
         point_list = list()
 
-        soundings_tree.points_in_polygon(soundings_tree.get_root(), 0, soundings_point_set.get_domain(), search_window,
-                                         soundings_point_set, point_list)
+        soundings_tree.points_in_polygon(search_window, soundings_point_set, point_list)
 
-        for point in point_list:
-            if point != target_sounding:
-                point_label = get_carto_symbol(point, scale, h_spacing, v_spacing)[1]
-                if target_label.intersects(point_label):
-                    if target_sounding not in legibility_violations:
-                        legibility_violations.append(target_sounding)
-                    if point not in legibility_violations:
-                        legibility_violations.append(point)
+        point_list = [point for point in point_list if point != target_sounding]
+        overlaps = get_overlapping_symbols(target_sounding, point_list, scale, h_spacing, v_spacing)
+        for point, overlap in zip(point_list, overlaps):
+            if overlap:
+                if target_sounding.sounding_id not in violation_ids:
+                    violation_ids.add(target_sounding.sounding_id)
+                    legibility_violations.append(target_sounding)
+                if point.sounding_id not in violation_ids:
+                    violation_ids.add(point.sounding_id)
+                    legibility_violations.append(point)
 
         i += 1
 
@@ -149,16 +204,47 @@ def check_vertex_legibility(vertex, selection_tree, selection_point_set, scale,
     legibility_violations = list()
 
     search_window = get_carto_symbol(vertex, scale, h_spacing, v_spacing)[0]
-    target_label = get_carto_symbol(vertex, scale, h_spacing, v_spacing)[1]
 
     potential_violations = list()
-    selection_tree.points_in_polygon(selection_tree.get_root(), 0, selection_point_set.get_domain(), search_window,
-                                     selection_point_set, potential_violations)
+    selection_tree.points_in_polygon(search_window, selection_point_set, potential_violations)
 
-    for potential_violation in potential_violations:
-        if potential_violation != vertex:
-            potential_violation_label = get_carto_symbol(potential_violation, scale, h_spacing, v_spacing)[1]
-            if target_label.intersects(potential_violation_label):
-                legibility_violations.append(potential_violation)
+    potential_violations = [v for v in potential_violations if v != vertex]
+    overlaps = get_overlapping_symbols(vertex, potential_violations, scale, h_spacing, v_spacing)
+    for potential_violation, overlap in zip(potential_violations, overlaps):
+        if overlap:
+            legibility_violations.append(potential_violation)
 
     return legibility_violations
+
+
+def get_contour_overplots(soundings, depth_contours, scale):
+    """ Flags the soundings whose label, without spacing, intersects a depth contour (DepthsL FeatureLayer) no deeper
+        than the sounding. The label boxes of all the soundings are joined with the contour segments in one pass and
+        the depth filter is applied to the candidate pairs; danger symbols are tested with Shapely. """
+    overplots = np.zeros(len(soundings), dtype=bool)
+    contour_depths = depth_contours.get_attribute('VALDCO')
+    segments, segment_contours = depth_contours.get_segments()
+    boxes, positions = symbol_cache.get_label_boxes(soundings, scale, 0, 0)
+
+    if len(boxes) > 0 and len(segments) > 0:
+        segment_boxes = np.column_stack((np.minimum(segments[:, 0], segments[:, 2]),
+                                         np.minimum(segments[:, 1], segments[:, 3]),
+                                         np.maximum(segments[:, 0], segments[:, 2]),
+                                         np.maximum(segments[:, 1], segments[:, 3])))
+        # Cells about the size of a label
+        cell_size = float(np.median(np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]))) or 1.0
+        box_ids, segment_ids = envelope_pairs(boxes, segment_boxes, cell_size)
+        z = np.array([v.z_value if v.s57_type is None else np.nan for v in soundings], dtype=np.float64)
+        deeper = z[positions[box_ids]] >= contour_depths[segment_contours[segment_ids]]
+        box_ids, segment_ids = box_ids[deeper], segment_ids[deeper]
+        hits = segments_intersect_boxes(segments[segment_ids], boxes[box_ids])
+        overplots[positions[box_ids[hits]]] = True
+        metrics.count('contour_overplot_pairs', len(box_ids))
+
+    for pos, v in enumerate(soundings):
+        if v.s57_type is not None:
+            label = get_carto_symbol(v, scale, 0, 0)[1]
+            overplots[pos] = any(v.z_value >= contour_depths[c_id] and
+                                 label.intersects(depth_contours.get_geometry(c_id))
+                                 for c_id in depth_contours.query(label))
+    return overplots
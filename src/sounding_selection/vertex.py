@@ -3,6 +3,8 @@ from sounding_selection.point import Point
 
 class Vertex(Point):
     """ A Vertex is an extension of Class Point and takes (x,y) attributes and an n number of field values."""
+    __slots__ = ('__field_values',)
+
     def __init__(self, x, y, z, s57_type=None, s57_condition=None, catzoc=None, sounding_type=None):
         Point.__init__(self, x, y)
         self.__field_values = [z, s57_type, s57_condition, catzoc, sounding_type]